@@ -749,7 +749,7 @@ struct Mtz {
       read_stream(MemoryStream(mem.data(), mem.size()), with_data);
     } else {
       fileptr_t f = file_open(input.path().c_str(), "rb");
-      read_stream(FileStream{f.get()}, true);
+      read_stream(FileStream{f.get()}, with_data);
     }
   }
 
@@ -21,7 +21,8 @@ py::class_<T> add_ccp4_common(py::module& m, const char* name) {
     .def("update_ccp4_header", &Map::update_ccp4_header,
          py::arg("mode")=-1, py::arg("update_stats")=true)
     .def("full_cell", &Map::full_cell)
-    .def("write_ccp4_map", &Map::write_ccp4_map, py::arg("filename"))
+    .def("write_ccp4_map", &Map::write_ccp4_map, py::arg("filename"),
+         py::call_guard<py::gil_scoped_release>())
     .def("set_extent", &Map::set_extent)
     .def("__repr__", [=](const Map& self) {
         const SpaceGroup* sg = self.grid.spacegroup;
@@ -83,10 +83,59 @@ Grid<float> interpolate_points(
 
 }
 
+std::vector<Grid<float>> interpolate_points_multiple(
+    const std::vector<Grid<float>>& moving_maps,
+    std::vector<Grid<float>> interpolated_maps,
+    py::array_t<int> point_array,
+    py::array_t<double> fractional_array
+    )
+{
+    if (moving_maps.size() != interpolated_maps.size())
+        fail("interpolate_points_multiple(): map list sizes differ");
+
+    auto points = point_array.unchecked<2>();
+    auto fractionals = fractional_array.unchecked<2>();
+    if (points.shape(0) != fractionals.shape(0))
+        fail("interpolate_points_multiple(): point and position array sizes differ");
+
+    {
+        py::gil_scoped_release release;  // Release gil for threading support
+        for (py::ssize_t i=0; i < points.shape(0); i++)
+        {
+            // Fractional position of the point in the frame of the moving maps
+            Fractional fractional = Fractional(
+                fractionals(i, 0),
+                fractionals(i, 1),
+                fractionals(i, 2)
+                );
+
+            // Interpolate every map from the same position
+            for (std::size_t j=0; j < moving_maps.size(); j++)
+            {
+                float interpolated_value = (float) moving_maps[j].tricubic_interpolation(fractional);
+                interpolated_maps[j].set_value(
+                    points(i, 0),
+                    points(i, 1),
+                    points(i, 2),
+                    interpolated_value
+                    );
+            };
+        };
+    }
+
+    return interpolated_maps;
+
+}
+
 void add_custom(py::module& m) {
       m.def(
         "interpolate_points",
         &interpolate_points,
         "Interpolates a list of points."
     );
+      m.def(
+        "interpolate_points_multiple",
+        &interpolate_points_multiple,
+        "Interpolates several maps at the same precomputed fractional positions."
+    );
 }
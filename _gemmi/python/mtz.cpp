@@ -297,7 +297,8 @@ void add_mtz(py::module& m) {
     .def_readonly("axes", &Mtz::Batch::axes)
     ;
 
-  m.def("read_mtz_file", [](const std::string& path) {
-      return read_mtz(MaybeGzipped(path), true);
-  }, py::arg("path"), py::return_value_policy::move);
+  m.def("read_mtz_file", [](const std::string& path, bool with_data) {
+      return read_mtz(MaybeGzipped(path), with_data);
+  }, py::arg("path"), py::arg("with_data")=true, py::return_value_policy::move,
+     py::call_guard<py::gil_scoped_release>());
 }
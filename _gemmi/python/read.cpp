@@ -52,6 +52,7 @@ void add_read_structure(py::module& m) {
           return st;
         }, py::arg("path"), py::arg("merge_chain_parts")=true,
            py::arg("format")=CoorFormat::Unknown,
+           py::call_guard<py::gil_scoped_release>(),
         "Reads a coordinate file into Structure.");
   m.def("make_structure_from_block", &make_structure_from_block,
         py::arg("block"), "Takes mmCIF block and returns Structure.");
@@ -23,13 +23,15 @@ from pandda_gemmi.args import PanDDAArgs
 from pandda_gemmi.pandda_logging import STDOUTManager, log_arguments, PanDDAConsole
 from pandda_gemmi.dependencies import check_dependencies
 from pandda_gemmi.dataset import Datasets, Reference, StructureFactors, smooth, smooth_ray, DatasetStatistics
-from pandda_gemmi.edalignment import (Grid, Alignments, from_unaligned_dataset_c,
+from pandda_gemmi.edalignment import (Grid, Alignments, AlignmentCache, get_alignment_results,
+                                      from_unaligned_dataset_c,
                                       from_unaligned_dataset_c_flat, from_unaligned_dataset_c_ray,
                                       from_unaligned_dataset_c_flat_ray,
                                       )
 from pandda_gemmi.filters import remove_models_with_large_gaps
 from pandda_gemmi.comparators import get_multiple_comparator_sets, ComparatorCluster
-from pandda_gemmi.shells import get_shells_multiple_models
+from pandda_gemmi.shells import get_shells_multiple_models, get_shells_multiple_models_planned, ShellCostModel, \
+    ShellPlan
 from pandda_gemmi.logs import (
     summarise_grid, save_json_log, summarise_datasets, dump_datasets, pandda_note, pandda_warning, report_removed_datasets
 )
@@ -71,24 +73,27 @@ from pandda_gemmi.tables import (
     EventTable,
     SiteTable,
 )
-from pandda_gemmi.fs import PanDDAFSModel, ShellDirs
+from pandda_gemmi.fs import PanDDAFSModel, ShellDirs, get_writer
+from pandda_gemmi.distribution.payload import SharedArtefacts
 from pandda_gemmi.processing import (
     process_shell,
     process_shell_multiple_models,
     ShellResult,
     analyse_model,
-    analyse_model_ray
+    analyse_model_ray,
+    score_model_events,
+    score_model_events_ray,
+    process_shells_task_graph,
 )
 
 printer = pprint.PrettyPrinter()
 console = PanDDAConsole()
 
 def update_log(shell_log, shell_log_path):
-    if shell_log_path.exists():
-        os.remove(shell_log_path)
-
-    with open(shell_log_path, "w") as f:
-        json.dump(shell_log, f, indent=2)
+    # Snapshot the log now and leave the write to the writer, so the run carries on while it is dumped
+    writer = get_writer()
+    writer.update_log(shell_log, shell_log_path)
+    writer.flush_logs()
 
 pp = pprint.PrettyPrinter(indent=4, compact=False, sort_dicts=True)
 
@@ -212,6 +217,14 @@ def get_analyse_model_func(pandda_args):
     return analyse_model_func
 
 
+def get_score_events_func(pandda_args):
+    if pandda_args.local_processing == "ray":
+        score_events_func = score_model_events_ray
+    else:
+        score_events_func = score_model_events
+    return score_events_func
+
+
 def process_pandda(pandda_args: PanDDAArgs, ):
     ###################################################################
     # # Configuration
@@ -270,6 +283,7 @@ def process_pandda(pandda_args: PanDDAArgs, ):
     load_xmap_func = get_load_xmap_func(pandda_args)
     load_xmap_flat_func = get_load_xmap_flat_func(pandda_args)
     analyse_model_func = get_analyse_model_func(pandda_args)
+    score_events_func = get_score_events_func(pandda_args)
 
     comparators_func = get_comparator_func(
         pandda_args,
@@ -333,9 +347,11 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         # Get datasets
         # with STDOUTManager('Loading datasets ...', 'Loaded datasets!'):
         console.start_load_datasets()
-        datasets_initial: Datasets = Datasets.from_dir(pandda_fs_model, )
-        dataset_statistics = DatasetStatistics(datasets_initial.datasets)
-        console.summarise_datasets(datasets_initial.datasets, dataset_statistics)
+        # Only the headers are read until the filters that do not need the reflections or coordinates have run
+        time_dataset_headers_start = time.time()
+        datasets_initial: Datasets = Datasets.from_dir(pandda_fs_model, header_only=True)
+        time_dataset_headers_finish = time.time()
+        pandda_log[constants.LOG_DATASET_HEADERS_TIME] = time_dataset_headers_finish - time_dataset_headers_start
 
         dump_datasets(datasets_initial)
 
@@ -375,17 +391,13 @@ def process_pandda(pandda_args: PanDDAArgs, ):
             validate_parameterized(datasets_invalid, exception=Exception("Too few datasets after filter: invalid"))
             report_removed_datasets(datasets_initial,datasets_invalid)
 
-        with STDOUTManager('Truncating MTZ columns to only those needed for PanDDA ...','Done!'):
-            datasets_truncated_columns = datasets_invalid.drop_columns(structure_factors)
-            report_removed_datasets(datasets_invalid,datasets_truncated_columns)
-
         with STDOUTManager('Removing datasets with poor low resolution completeness ...','Done!'):
-            datasets_low_res: Datasets = datasets_truncated_columns.remove_low_resolution_datasets(
+            datasets_low_res: Datasets = datasets_invalid.remove_low_resolution_datasets(
                 pandda_args.low_resolution_completeness)
-            pandda_log[constants.LOG_LOW_RES] = [dtag.dtag for dtag in datasets_truncated_columns if
+            pandda_log[constants.LOG_LOW_RES] = [dtag.dtag for dtag in datasets_invalid if
                                                  dtag not in datasets_low_res]
             validate_parameterized(datasets_low_res, exception=Exception("Too few datasets after filter: low res"))
-            report_removed_datasets(datasets_truncated_columns,datasets_low_res)
+            report_removed_datasets(datasets_invalid,datasets_low_res)
 
         if pandda_args.max_rfree < 1:
             with STDOUTManager('Removing datasets with poor rfree ...','Done!'):
@@ -397,11 +409,24 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         else:
             datasets_rfree = datasets_low_res
 
+        with STDOUTManager('Loading reflections and structures of remaining datasets ...','Done!'):
+            time_dataset_loading_start = time.time()
+            datasets_loaded: Datasets = datasets_rfree.load()
+            time_dataset_loading_finish = time.time()
+            pandda_log[constants.LOG_DATASET_LOADING_TIME] = time_dataset_loading_finish - time_dataset_loading_start
+
+            dataset_statistics = DatasetStatistics(datasets_loaded.datasets)
+            console.summarise_datasets(datasets_loaded.datasets, dataset_statistics)
+
+        with STDOUTManager('Truncating MTZ columns to only those needed for PanDDA ...','Done!'):
+            datasets_truncated_columns = datasets_loaded.drop_columns(structure_factors)
+            report_removed_datasets(datasets_loaded,datasets_truncated_columns)
+
         with STDOUTManager('Removing datasets with poor wilson rmsd ...','Done!'):
-            datasets_wilson: Datasets = datasets_rfree.remove_bad_wilson(
+            datasets_wilson: Datasets = datasets_truncated_columns.remove_bad_wilson(
                 pandda_args.max_wilson_plot_z_score)  # TODO
             validate_parameterized(datasets_wilson, exception=Exception("Too few datasets after filter: wilson"))
-            report_removed_datasets(datasets_rfree,datasets_wilson)
+            report_removed_datasets(datasets_truncated_columns,datasets_wilson)
 
         # Select reference
         with STDOUTManager('Deciding on reference dataset ...','Done!'):
@@ -431,11 +456,23 @@ def process_pandda(pandda_args: PanDDAArgs, ):
             report_removed_datasets(datasets_smoother,datasets_diss_struc)
             validate_parameterized(datasets_diss_struc, exception=Exception("Too few datasets after filter: structure"))
 
+        with STDOUTManager('Getting local alignments of the electron density to the reference ...','Done!'):
+            start = time.time()
+            alignment_results = get_alignment_results(
+                reference,
+                datasets_diss_struc,
+                process_local=process_local,
+                log_residues=pandda_args.log_alignment_residues,
+                alignment_cache=AlignmentCache.from_dir(pandda_fs_model.pandda_dir),
+            )
+            finish = time.time()
+            pandda_log["Time to get local alignments"] = finish - start
+
         with STDOUTManager('Removing datasets whose models have large gaps ...','Done!'):
-            datasets_gaps: Datasets = remove_models_with_large_gaps(datasets_diss_struc, reference )
-            for dtag in datasets_gaps:
-                if dtag not in datasets_diss_struc.datasets:
-                    print(f"WARNING: Removed dataset {dtag} due to a large gap")
+            datasets_gaps: Datasets = remove_models_with_large_gaps(datasets_diss_struc, alignment_results)
+            for dtag in datasets_diss_struc:
+                if dtag not in datasets_gaps.datasets:
+                    print(f"WARNING: Removed dataset {dtag} due to a large gap: {alignment_results[dtag].failure}")
             pandda_log[constants.LOG_GAPS] = [dtag.dtag for dtag in datasets_diss_struc if
                                               dtag not in datasets_gaps]
             report_removed_datasets(datasets_diss_struc,datasets_gaps)
@@ -465,11 +502,7 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                                              )
         #pp.pprint(grid.grid)
 
-        with STDOUTManager('Getting local alignments of the electron density to the reference ...','Done!'):
-            alignments: Alignments = Alignments.from_datasets(
-                reference,
-                datasets,
-            )
+        alignments: Alignments = Alignments.from_alignment_results(alignment_results, datasets)
         #pp.pprint(alignments)
 
         update_log(pandda_log, pandda_args.out_dir / constants.PANDDA_LOG_FILE)
@@ -515,7 +548,8 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                            'Done!'):
             if pandda_args.comparison_strategy == "cluster":
                 pandda_note("using comparison strategy = \"cluster\"")
-                shells = get_shells_multiple_models(
+                shell_cost_model = ShellCostModel.from_datasets(datasets, grid)
+                fixed_shells = get_shells_multiple_models(
                     datasets,
                     comparators,
                     pandda_args.min_characterisation_datasets,
@@ -524,6 +558,31 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                     pandda_args.only_datasets,
                     debug=pandda_args.debug,
                 )
+                fixed_shell_plan = ShellPlan.from_shells(fixed_shells, shell_cost_model)
+                if pandda_args.shell_planner == "cost":
+                    pandda_note("using shell planner = \"cost\"")
+                    shells = get_shells_multiple_models_planned(
+                        datasets,
+                        comparators,
+                        pandda_args.min_characterisation_datasets,
+                        pandda_args.high_res_increment,
+                        pandda_args.only_datasets,
+                        shell_cost_model,
+                        pandda_args.max_shell_memory,
+                        debug=pandda_args.debug,
+                    )
+                    shell_plan = ShellPlan.from_shells(shells, shell_cost_model)
+                    pandda_note(
+                        f"fixed shells would load {fixed_shell_plan.num_loads()} xmaps over "
+                        f"{fixed_shell_plan.total():.4g} voxels, planned shells load {shell_plan.num_loads()} "
+                        f"over {shell_plan.total():.4g}"
+                    )
+                else:
+                    shells = fixed_shells
+                    shell_plan = fixed_shell_plan
+                pandda_log[constants.LOG_SHELL_PLAN] = shell_plan.summary()
+                print(shell_plan.report())
+
                 # TODO
                 if pandda_args.debug:
                     print('Got shells that support multiple models')
@@ -540,6 +599,13 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                     pandda_args.max_shell_datasets,
                     pandda_args.high_res_increment,
                 )
+
+            if pandda_args.plan_only:
+                pandda_note("stopping after planning the shells")
+                pp.pprint(shells)
+                update_log(pandda_log, pandda_args.out_dir / constants.PANDDA_LOG_FILE)
+                return
+
             pandda_fs_model.shell_dirs = ShellDirs.from_pandda_dir(pandda_fs_model.pandda_dir, shells)
             pandda_fs_model.shell_dirs.build()
 
@@ -569,6 +635,13 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                 statmaps=pandda_args.statmaps,
                 load_xmap_func=load_xmap_func,
                 analyse_model_func=analyse_model_func,
+                score_events_func=score_events_func,
+                model_selection_top_k=pandda_args.model_selection_top_k,
+                crop_event_maps=pandda_args.crop_event_maps,
+                event_map_margin=pandda_args.event_map_margin,
+                map_output_format=pandda_args.map_output_format,
+                map_compression=pandda_args.map_compression,
+                zmap_quantisation_step=pandda_args.zmap_quantisation_step,
                 debug=pandda_args.debug,
             )
         else:
@@ -596,8 +669,71 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         # Process the shells
         with STDOUTManager('Processing the shells ...','Done!'):
             time_shells_start = time.time()
-            shell_results: List[ShellResult] = process_global(
-                [
+            schedule_graph = pandda_args.shell_scheduling == "graph" and \
+                             pandda_args.comparison_strategy == "cluster" and \
+                             pandda_args.global_processing == "serial"
+            if pandda_args.shell_scheduling == "graph" and not schedule_graph:
+                pandda_warning(
+                    f"Graph shell scheduling needs the 'cluster' comparison strategy and 'serial' global processing, "
+                    f"not '{pandda_args.comparison_strategy}' and '{pandda_args.global_processing}'. Processing "
+                    f"shell by shell instead"
+                )
+            if schedule_graph:
+                # Schedule the xmaps, models and datasets of every shell as tasks on one pool rather than
+                # shell by shell, using the plain functions as the graph handles the parallelism itself
+                shell_results: List[ShellResult] = process_shells_task_graph(
+                    shells,
+                    datasets,
+                    alignments,
+                    grid,
+                    pandda_fs_model,
+                    reference,
+                    structure_factors=structure_factors,
+                    sample_rate=pandda_args.sample_rate,
+                    contour_level=pandda_args.contour_level,
+                    cluster_cutoff_distance_multiplier=pandda_args.cluster_cutoff_distance_multiplier,
+                    min_blob_volume=pandda_args.min_blob_volume,
+                    min_blob_z_peak=pandda_args.min_blob_z_peak,
+                    outer_mask=pandda_args.outer_mask,
+                    inner_mask_symmetry=pandda_args.inner_mask_symmetry,
+                    max_site_distance_cutoff=pandda_args.max_site_distance_cutoff,
+                    min_bdc=pandda_args.min_bdc,
+                    max_bdc=pandda_args.max_bdc,
+                    statmaps=pandda_args.statmaps,
+                    load_xmap_func=from_unaligned_dataset_c,
+                    analyse_model_func=analyse_model,
+                    score_events_func=score_model_events,
+                    model_selection_top_k=pandda_args.model_selection_top_k,
+                    crop_event_maps=pandda_args.crop_event_maps,
+                    event_map_margin=pandda_args.event_map_margin,
+                    map_output_format=pandda_args.map_output_format,
+                    map_compression=pandda_args.map_compression,
+                    zmap_quantisation_step=pandda_args.zmap_quantisation_step,
+                    n_jobs=1 if pandda_args.local_processing == "serial" else pandda_args.local_cpus,
+                    method={"multiprocessing_spawn": "spawn", "ray": "ray"}.get(
+                        pandda_args.local_processing, "forkserver"),
+                    debug=pandda_args.debug,
+                )
+            elif pandda_args.global_processing == "distributed" and pandda_args.distributed_payload == "lazy":
+                # Write the shared data once and send each shell references to only what it needs
+                shared_artefacts = SharedArtefacts.from_objects(
+                    distributed_tmp,
+                    datasets,
+                    alignments,
+                    grid,
+                    reference,
+                )
+                try:
+                    shell_tasks = [
+                        shared_artefacts.shell_task(process_shell_paramaterised, shell, pandda_fs_model)
+                        for res, shell
+                        in shells.items()
+                    ]
+                    shell_results: List[ShellResult] = process_global(shell_tasks)
+                finally:
+                    shared_artefacts.clean()
+            else:
+                shell_tasks = [
                     partial(
                         process_shell_paramaterised,
                         shell,
@@ -609,8 +745,8 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                     )
                     for res, shell
                     in shells.items()
-                ],
-            )
+                ]
+                shell_results: List[ShellResult] = process_global(shell_tasks)
             time_shells_finish = time.time()
             pandda_log[constants.LOG_SHELLS] = {
                 res: shell_result.log
@@ -657,6 +793,8 @@ def process_pandda(pandda_args: PanDDAArgs, ):
                             pandda_fs_model,
                             cif_strategy=pandda_args.cif_strategy,
                             rhofit_coord=pandda_args.rhofit_coord,
+                            cropped_event_maps=pandda_args.crop_event_maps,
+                            map_store_maps=pandda_args.map_output_format == "hdf5",
                         )
                         for event_id
                         in all_events
@@ -792,10 +930,9 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         with STDOUTManager('Saving json log with detailed information on run ...','Done!'):
             if pandda_args.debug:
                 printer.pprint(pandda_log)
-            save_json_log(
-                pandda_log,
-                pandda_args.out_dir / constants.PANDDA_LOG_FILE,
-            )
+            writer = get_writer()
+            writer.update_log(pandda_log, pandda_args.out_dir / constants.PANDDA_LOG_FILE)
+            writer.flush()
 
         print(f"PanDDA ran in: {time_finish - time_start}")
 
@@ -817,10 +954,17 @@ def process_pandda(pandda_args: PanDDAArgs, ):
         #     pandda_log
         # )
 
-        save_json_log(
-            pandda_log,
-            pandda_args.out_dir / constants.PANDDA_LOG_FILE,
-        )
+        # Queue the log behind any earlier snapshots so none of them overwrite it, and write it directly if the
+        # writer is what failed
+        try:
+            writer = get_writer()
+            writer.update_log(pandda_log, pandda_args.out_dir / constants.PANDDA_LOG_FILE)
+            writer.flush()
+        except Exception:
+            save_json_log(
+                pandda_log,
+                pandda_args.out_dir / constants.PANDDA_LOG_FILE,
+            )
 
 
 if __name__ == '__main__':
@@ -19,6 +19,12 @@ class PanDDAArgs:
     ligand_pdb_regex: str = "*.pdb"
     ligand_smiles_regex: str = "*.smiles"
     statmaps: bool = False
+    crop_event_maps: bool = constants.ARGS_CROP_EVENT_MAPS_DEFAULT
+    event_map_margin: float = constants.ARGS_EVENT_MAP_MARGIN_DEFAULT
+    map_output_format: str = constants.ARGS_MAP_OUTPUT_FORMAT_DEFAULT
+    map_compression: str = constants.ARGS_MAP_COMPRESSION_DEFAULT
+    zmap_quantisation_step: float = constants.ARGS_ZMAP_QUANTISATION_STEP_DEFAULT
+    log_alignment_residues: bool = constants.ARGS_LOG_ALIGNMENT_RESIDUES_DEFAULT
     low_memory: bool = False
     ground_state_datasets: Optional[List[str]] = None
     exclude_from_z_map_analysis: Optional[List[str]] = None
@@ -30,6 +36,9 @@ class PanDDAArgs:
     high_res_lower_limit: float = 4.0
     high_res_increment: float = 0.05
     max_shell_datasets: int = 60
+    shell_planner: str = constants.ARGS_SHELL_PLANNER_DEFAULT
+    max_shell_memory: Optional[float] = constants.ARGS_MAX_SHELL_MEMORY_DEFAULT
+    plan_only: bool = constants.ARGS_PLAN_ONLY_DEFAULT
     min_characterisation_datasets: int = constants.ARGS_MIN_CHARACTERISATION_DATASETS_DEFAULT
     structure_factors: Optional[Tuple[str, str]] = None
     all_data_are_valid_values: bool = True
@@ -82,11 +91,14 @@ class PanDDAArgs:
     distributed_walltime: str = "30:00:00"
     distributed_watcher: bool = False
     distributed_slurm_partition: Optional[str] = None
+    distributed_payload: str = constants.ARGS_DISTRIBUTED_PAYLOAD_DEFAULT
+    shell_scheduling: str = constants.ARGS_SHELL_SCHEDULING_DEFAULT
     autobuild: bool = constants.ARGS_AUTOBUILD_DEFAULT
     autobuild_strategy: str = "rhofit"
     rhofit_coord: bool = False
     cif_strategy: str = "elbow"
     rank_method: str = constants.ARGS_RANK_METHOD_DEFAULT
+    model_selection_top_k: int = constants.ARGS_MODEL_SELECTION_TOP_K_DEFAULT
     debug: bool = True
 
     @staticmethod
@@ -260,6 +272,20 @@ class PanDDAArgs:
             default=False,
             help=constants.ARGS_DISTRIBUTED_SLURM_PARTITION_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_DISTRIBUTED_PAYLOAD,
+            type=str,
+            choices=["full", "lazy"],
+            default=constants.ARGS_DISTRIBUTED_PAYLOAD_DEFAULT,
+            help=constants.ARGS_DISTRIBUTED_PAYLOAD_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_SHELL_SCHEDULING,
+            type=str,
+            choices=["shells", "graph"],
+            default=constants.ARGS_SHELL_SCHEDULING_DEFAULT,
+            help=constants.ARGS_SHELL_SCHEDULING_HELP,
+        )
 
         # Dataset Selection
         parser.add_argument(
@@ -399,6 +425,25 @@ class PanDDAArgs:
             default=60,
             help=constants.ARGS_MAX_SHELL_DATASETS_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_SHELL_PLANNER,
+            type=str,
+            choices=["fixed", "cost"],
+            default=constants.ARGS_SHELL_PLANNER_DEFAULT,
+            help=constants.ARGS_SHELL_PLANNER_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_MAX_SHELL_MEMORY,
+            type=float,
+            default=constants.ARGS_MAX_SHELL_MEMORY_DEFAULT,
+            help=constants.ARGS_MAX_SHELL_MEMORY_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_PLAN_ONLY,
+            type=ast.literal_eval,
+            default=constants.ARGS_PLAN_ONLY_DEFAULT,
+            help=constants.ARGS_PLAN_ONLY_HELP,
+        )
         parser.add_argument(
             constants.ARGS_MIN_CHARACTERISATION_DATASETS,
             type=int,
@@ -440,6 +485,36 @@ class PanDDAArgs:
             default=False,
             help=constants.ARGS_STATMAPS_HELP,
         )
+        parser.add_argument(
+            constants.ARGS_CROP_EVENT_MAPS,
+            type=ast.literal_eval,
+            default=constants.ARGS_CROP_EVENT_MAPS_DEFAULT,
+            help=constants.ARGS_CROP_EVENT_MAPS_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_EVENT_MAP_MARGIN,
+            type=float,
+            default=constants.ARGS_EVENT_MAP_MARGIN_DEFAULT,
+            help=constants.ARGS_EVENT_MAP_MARGIN_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_MAP_OUTPUT_FORMAT,
+            type=str,
+            default=constants.ARGS_MAP_OUTPUT_FORMAT_DEFAULT,
+            help=constants.ARGS_MAP_OUTPUT_FORMAT_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_MAP_COMPRESSION,
+            type=str,
+            default=constants.ARGS_MAP_COMPRESSION_DEFAULT,
+            help=constants.ARGS_MAP_COMPRESSION_HELP,
+        )
+        parser.add_argument(
+            constants.ARGS_ZMAP_QUANTISATION_STEP,
+            type=float,
+            default=constants.ARGS_ZMAP_QUANTISATION_STEP_DEFAULT,
+            help=constants.ARGS_ZMAP_QUANTISATION_STEP_HELP,
+        )
         parser.add_argument(
             constants.ARGS_RESOLUTION_FACTOR,
             type=float,
@@ -589,7 +664,21 @@ class PanDDAArgs:
             help=constants.ARGS_RANK_METHOD_HELP,
         )
 
+        # Model selection
+        parser.add_argument(
+            constants.ARGS_MODEL_SELECTION_TOP_K,
+            type=int,
+            default=constants.ARGS_MODEL_SELECTION_TOP_K_DEFAULT,
+            help=constants.ARGS_MODEL_SELECTION_TOP_K_HELP,
+        )
+
         # Debug
+        parser.add_argument(
+            constants.ARGS_LOG_ALIGNMENT_RESIDUES,
+            type=ast.literal_eval,
+            default=constants.ARGS_LOG_ALIGNMENT_RESIDUES_DEFAULT,
+            help=constants.ARGS_LOG_ALIGNMENT_RESIDUES_HELP,
+        )
         parser.add_argument(
             constants.ARGS_DEBUG,
             type=ast.literal_eval,
@@ -611,6 +700,12 @@ class PanDDAArgs:
             ligand_pdb_regex=args.ligand_pdb_regex,
             ligand_smiles_regex=args.ligand_smiles_regex,
             statmaps=args.statmaps,
+            crop_event_maps=args.crop_event_maps,
+            event_map_margin=args.event_map_margin,
+            map_output_format=args.map_output_format,
+            map_compression=args.map_compression,
+            zmap_quantisation_step=args.zmap_quantisation_step,
+            log_alignment_residues=args.log_alignment_residues,
             low_memory=args.low_memory,
             ground_state_datasets=args.ground_state_datasets,
             exclude_from_z_map_analysis=args.exclude_from_z_map_analysis,
@@ -622,6 +717,9 @@ class PanDDAArgs:
             high_res_lower_limit=args.high_res_lower_limit,
             high_res_increment=args.high_res_increment,
             max_shell_datasets=args.max_shell_datasets,
+            shell_planner=args.shell_planner,
+            max_shell_memory=args.max_shell_memory,
+            plan_only=args.plan_only,
             min_characterisation_datasets=args.min_characterisation_datasets,
             structure_factors=args.structure_factors,
             all_data_are_valid_values=args.all_data_are_valid_values,
@@ -674,10 +772,13 @@ class PanDDAArgs:
             distributed_walltime=args.distributed_walltime,
             distributed_watcher=args.distributed_watcher,
             distributed_slurm_partition=args.distributed_slurm_partition,
+            distributed_payload=args.distributed_payload,
+            shell_scheduling=args.shell_scheduling,
             autobuild=args.autobuild,
             autobuild_strategy=args.autobuild_strategy,
             rhofit_coord=args.rhofit_coord,
             cif_strategy=args.cif_strategy,
             rank_method=args.rank_method,
+            model_selection_top_k=args.model_selection_top_k,
             debug=args.debug,
         )
@@ -12,6 +12,7 @@ import fire
 import numpy as np
 import gemmi
 import ray
+from scipy import spatial
 
 from pandda_gemmi import constants
 
@@ -25,6 +26,7 @@ from pandda_gemmi.shells import Shell
 from pandda_gemmi.edalignment import Alignment, Alignments, Transform, Grid, Partitioning, Xmap
 from pandda_gemmi.model import Zmap, Model
 from pandda_gemmi.event import Event
+from pandda_gemmi.fs.map_store import MapStore
 
 
 @dataclasses.dataclass()
@@ -245,7 +247,8 @@ def get_ccp4_map(xmap_path):
     m = gemmi.read_ccp4_map(str(xmap_path))
     m.grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
 
-    m.setup()
+    # Cropped event maps are expanded to the full cell with empty density outside the box
+    m.setup(0.0)
 
     return m
 
@@ -408,6 +411,48 @@ def rhofit_to_coord(truncated_model_path: Path, truncated_xmap_path: Path, mtz_p
 # Rescore
 # #####################
 
+def get_bond_midpoints(positions: np.ndarray, max_distance=2.0) -> np.ndarray:
+    # Midpoints of every pair of atoms closer than max_distance, in the order of the pairs' indexes
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    pairs = spatial.cKDTree(positions).query_pairs(max_distance, output_type="ndarray").reshape(-1, 2)
+    pairs = pairs[np.lexsort((pairs[:, 1], pairs[:, 0]))]
+    pairs = pairs[np.linalg.norm(positions[pairs[:, 0]] - positions[pairs[:, 1]], axis=1) < max_distance]
+    return (positions[pairs[:, 0]] + positions[pairs[:, 1]]) / 2
+
+
+def get_structure_heavy_positions(structure) -> Tuple[np.ndarray, np.ndarray]:
+    # Heavy atom positions and the index of the residue each belongs to
+    positions = []
+    residue_indexes = []
+    residue_index = 0
+    for model in structure:
+        for chain in model:
+            for residue in chain:
+                for atom in residue:
+                    if atom.element.name == "H":
+                        continue
+                    positions.append([atom.pos.x, atom.pos.y, atom.pos.z])
+                    residue_indexes.append(residue_index)
+                residue_index = residue_index + 1
+
+    return np.array(positions, dtype=float).reshape(-1, 3), np.array(residue_indexes, dtype=int)
+
+
+def get_loci_array(positions: np.ndarray, residue_indexes: Optional[np.ndarray] = None) -> np.ndarray:
+    # Every atom and, twice, the midpoint of every bond within a residue: the same points as comparing every
+    # ordered pair of atoms in each residue, atoms with themselves included
+    if residue_indexes is None:
+        residue_indexes = np.zeros(len(positions), dtype=int)
+
+    loci = [positions]
+    for residue_index in np.unique(residue_indexes):
+        midpoints = get_bond_midpoints(positions[residue_indexes == residue_index])
+        loci.append(midpoints)
+        loci.append(midpoints)
+
+    return np.concatenate(loci, axis=0)
+
+
 def score_structure(structure, xmap):
     unit_cell = xmap.unit_cell
 
@@ -418,26 +463,8 @@ def score_structure(structure, xmap):
     mask.set_unit_cell(unit_cell)
     mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
 
-    for model in structure:
-        for chain in model:
-            for residue in chain:
-                for atom_1 in residue:
-                    if atom_1.element.name == "H":
-                        continue
-                    pos_1 = atom_1.pos
-
-                    for atom_2 in residue:
-                        if atom_2.element.name == "H":
-                            continue
-                        pos_2 = atom_2.pos
-                        if pos_1.dist(pos_2) < 2.0:
-                            new_pos = gemmi.Position(
-                                (pos_1.x + pos_2.x) / 2,
-                                (pos_1.y + pos_2.y) / 2,
-                                (pos_1.z + pos_2.z) / 2,
-
-                            )
-                            mask.set_points_around(new_pos, 0.75, 1.0)
+    for pos in get_loci_array(*get_structure_heavy_positions(structure)):
+        mask.set_points_around(gemmi.Position(*pos), 0.75, 1.0)
 
     mask_array = np.array(mask)
 
@@ -451,29 +478,7 @@ def score_structure(structure, xmap):
 
 
 def get_loci(_structure):
-    loci = []
-    for model in _structure:
-        for chain in model:
-            for residue in chain:
-                for atom_1 in residue:
-                    if atom_1.element.name == "H":
-                        continue
-                    pos_1 = atom_1.pos
-
-                    for atom_2 in residue:
-                        if atom_2.element.name == "H":
-                            continue
-                        pos_2 = atom_2.pos
-                        if pos_1.dist(pos_2) < 2.0:
-                            new_pos = gemmi.Position(
-                                (pos_1.x + pos_2.x) / 2,
-                                (pos_1.y + pos_2.y) / 2,
-                                (pos_1.z + pos_2.z) / 2,
-
-                            )
-                            loci.append(new_pos)
-
-    return loci
+    return [gemmi.Position(*pos) for pos in get_loci_array(*get_structure_heavy_positions(_structure))]
 
 
 def signal(positions, xmap, cutoff):
@@ -580,7 +585,6 @@ def get_samples(positions,
                 # radius_outer_1=1.5,
                 # radius=1.3
                 ):
-    positions_array_list = []
     # for position in positions:
     #     # Get some random vectors
     #     position_array = np.array([position.x, position.y, position.z]).reshape((1, 3))
@@ -599,12 +603,7 @@ def get_samples(positions,
     # positions_array = np.vstack(positions_list)
     # samples_arrays_array = np.vstack(samples_arrays_list)
 
-    for position in positions:
-        # get positions in an arrart
-        position_array = np.array([position.x, position.y, position.z]).reshape((1, 3))
-        positions_array_list.append(position_array)
-
-    positions_array = np.vstack(positions_array_list)
+    positions_array = np.asarray(positions, dtype=float).reshape(-1, 3)
 
     min_pos = np.min(positions_array, axis=0) - buffer
     max_pos = np.max(positions_array, axis=0) + buffer
@@ -794,10 +793,8 @@ def score_structure_signal_to_noise_density(
         "radius_outer_1": float(radius_outer_1),
     }
 
-    loci = get_loci(structure)
-    rescore_log["loci"] = [(float(pos.x), float(pos.y), float(pos.z))
-                           for pos
-                           in loci]
+    loci = get_loci_array(*get_structure_heavy_positions(structure))
+    rescore_log["loci"] = loci.tolist()
     rescore_log["num_loci"] = len(loci)
 
     # Get sample points
@@ -860,6 +857,25 @@ def EXPERIMENTAL_score_structure_signal_to_noise_density(
         radius_inner_1=0.5,
         radius_outer_0=1.2,
         radius_outer_1=1.5,
+):
+    return EXPERIMENTAL_score_loci_signal_to_noise_density(
+        get_loci_array(*get_structure_heavy_positions(structure)),
+        xmap,
+        cutoff,
+        radius_inner_0,
+        radius_inner_1,
+        radius_outer_0,
+        radius_outer_1,
+    )
+
+
+def EXPERIMENTAL_score_loci_signal_to_noise_density(
+        loci, xmap,
+        cutoff=2.0,
+        radius_inner_0=0.0,
+        radius_inner_1=0.5,
+        radius_outer_0=1.2,
+        radius_outer_1=1.5,
 ):
     rescore_log = {
         "cutoff": float(cutoff),
@@ -869,10 +885,7 @@ def EXPERIMENTAL_score_structure_signal_to_noise_density(
         "radius_outer_1": float(radius_outer_1),
     }
 
-    loci = get_loci(structure)
-    rescore_log["loci"] = [(float(pos.x), float(pos.y), float(pos.z))
-                           for pos
-                           in loci]
+    rescore_log["loci"] = loci.tolist()
     rescore_log["num_loci"] = len(loci)
 
     # Get sample points
@@ -885,13 +898,7 @@ def EXPERIMENTAL_score_structure_signal_to_noise_density(
     distances = get_sample_distances(positions_array, samples_array)
 
     # Get structure sample points
-    structure_samples = np.array(
-        [
-            (float(pos.x), float(pos.y), float(pos.z))
-            for pos
-            in loci
-        ]
-    )
+    structure_samples = loci
 
     # Get signal samples: change radius until similar number of points
     signal_samples = truncate_samples(samples_array, distances, radius_inner_0, radius_inner_1)
@@ -990,9 +997,8 @@ def score_builds(rhofit_dir: Path, score_model_path, xmap_path, zmap_path):
         *[event_map_reference_grid.nu, event_map_reference_grid.nv, event_map_reference_grid.nw])
     inner_mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
     inner_mask.set_unit_cell(event_map_reference_grid.unit_cell)
-    for atom in score_model.protein_atoms():
-        pos = atom.pos
-        inner_mask.set_points_around(pos,
+    for pos in score_model.arrays().protein_positions:
+        inner_mask.set_points_around(gemmi.Position(*pos),
                                      radius=2.0,
                                      value=1,
                                      )
@@ -1129,6 +1135,8 @@ def autobuild_rhofit(dataset: Dataset,
                      cif_strategy,
                      cut: float = 2.0,
                      rhofit_coord: bool = False,
+                     cropped_event_maps: bool = False,
+                     map_store_maps: bool = False,
                      ):
     # Type all the input variables
     processed_dataset_dir = pandda_fs.processed_datasets[event.event_id.dtag]
@@ -1149,6 +1157,14 @@ def autobuild_rhofit(dataset: Dataset,
     except Exception as e:
         print(e)
 
+    # Export the maps rhofit needs if they were only written to the map store
+    if map_store_maps:
+        map_store = MapStore.from_dir(processed_dataset_dir.path)
+        map_store.export_ccp4(
+            processed_dataset_dir.path,
+            [Path(path).name for path in set([zmap_path, build_map_path, score_map_path]) if not Path(path).exists()],
+        )
+
     # Log
     autobuilding_log_file = out_dir / "log.json"
     autobuilding_log = {}
@@ -1176,10 +1192,16 @@ def autobuild_rhofit(dataset: Dataset,
 
     # Truncate the ed map
     if not rhofit_coord:
-        truncated_xmap_path = truncate_xmap(build_map_path, coords, out_dir)
 
-        # Make cut out map
-        cut_out_xmap(build_map_path, coord, out_dir)
+        # Cropped event maps are already cut down to the event
+        if cropped_event_maps:
+            truncated_xmap_path = build_map_path
+
+        else:
+            truncated_xmap_path = truncate_xmap(build_map_path, coords, out_dir)
+
+            # Make cut out map
+            cut_out_xmap(build_map_path, coord, out_dir)
 
     # Generate the cif
     if cif_strategy == "default":
@@ -1329,11 +1351,15 @@ def autobuild_rhofit_ray(dataset: Dataset,
                          pandda_fs,
                          cif_strategy,
                          cut: float = 2.0,
-                         rhofit_coord: bool = False, ):
+                         rhofit_coord: bool = False,
+                         cropped_event_maps: bool = False,
+                         map_store_maps: bool = False, ):
     return autobuild_rhofit(dataset,
                             event,
                             pandda_fs,
                             cif_strategy,
                             cut,
                             rhofit_coord,
+                            cropped_event_maps,
+                            map_store_maps,
                             )
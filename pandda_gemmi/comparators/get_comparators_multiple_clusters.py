@@ -40,13 +40,8 @@ def truncate(datasets: Dict[Dtag, Dataset], resolution: Resolution, structure_fa
     # truncate on reflections
     new_datasets_reflections = {}
     for dtag in dataset_resolution_truncated:
-        reflections = dataset_resolution_truncated[dtag].reflections.reflections
-        reflections_array = np.array(reflections)
-
         truncated_dataset = dataset_resolution_truncated[dtag].truncate_reflections(common_reflections,
                                                                                     )
-        reflections = truncated_dataset.reflections.reflections
-        reflections_array = np.array(reflections)
 
         new_datasets_reflections[dtag] = truncated_dataset
 
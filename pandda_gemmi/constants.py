@@ -27,6 +27,39 @@ PANDDA_SYMMETRY_MASK_FILE = "symmetry_mask.ccp4"
 PANDDA_TOTAL_MASK_FILE = "total_mask.ccp4"
 PANDDA_MEAN_MAP_FILE = "mean_{number}_{res}.ccp4"
 PANDDA_SIGMA_S_M_FILE = "sigma_s_m_{number}_{res}.ccp4"
+PANDDA_MAP_STORE_FILE = "maps.h5"
+PANDDA_PARTITIONING_CACHE_DIR = "partitioning_cache"
+PANDDA_ALIGNMENT_CACHE_DIR = "alignment_cache"
+PANDDA_CONFORMER_CACHE_DIR = "conformer_cache"
+PANDDA_DISTRIBUTED_ARTEFACT_DIR = "pandda_artefacts_{key}"
+
+IO_WRITER_MAX_PENDING = 8
+DATASET_LOADING_THREADS = 16
+
+SMOOTHING_NUM_BINS = 100
+SMOOTHING_NUM_SCALES = 100
+SMOOTHING_MAX_SCALE = 4.0
+SMOOTHING_BIN_RADIUS = 0.01
+SMOOTHING_MAX_ELEMENTS = 1 << 22
+
+MASK_MAX_ELEMENTS = 1 << 22
+
+# Per-dataset task payloads should hold the test dataset's own data: its xmap, reflections and structure
+DATASET_TASK_MAX_PAYLOAD_XMAPS = 3
+
+# Relative costs of the tasks in the shell task graph, in units of loading one xmap
+TASK_GRAPH_COST_COMMON_REFLECTIONS_PER_DATASET = 0.02
+TASK_GRAPH_COST_TRUNCATE = 0.02
+TASK_GRAPH_COST_XMAP = 1.0
+TASK_GRAPH_COST_MODEL_PER_XMAP = 0.1
+TASK_GRAPH_COST_DATASET_PER_MODEL = 2.0
+TASK_GRAPH_COST_SHELL_LOG = 0.01
+
+# The cost shell planner places shell boundaries on this many steps per high resolution increment
+SHELL_PLAN_SUBDIVISIONS = 5
+# Xmaps are sampled at the resolution over 0.5, so their FFT grids have this spacing in angstroms
+SHELL_PLAN_FFT_SPACING = 0.5
+SHELL_PLAN_BYTES_PER_VOXEL = 4
 
 ###################################################################
 # # Logging constants
@@ -117,6 +150,19 @@ ARGS_DISTRIBUTED_WATCHER = "--distributed_watcher"
 ARGS_DISTRIBUTED_WATCHER_HELP = "A boolean flag that gives whether or not to assign a watcher node to each process."
 ARGS_DISTRIBUTED_SLURM_PARTITION = "--distributed_slurm_partition"
 ARGS_DISTRIBUTED_SLURM_PARTITION_HELP = "A string that gives which slurm partition to submit jobs under."
+ARGS_DISTRIBUTED_PAYLOAD = "--distributed_payload"
+ARGS_DISTRIBUTED_PAYLOAD_HELP = "A string giving how shells are sent to distributed workers from 'full' and 'lazy'. If " \
+                                "'full' then every shell is pickled with all the datasets. If 'lazy' then the " \
+                                "datasets, alignments, grid and reference are written once to the distributed tmp " \
+                                "directory and each shell only carries references to the ones it needs."
+ARGS_SHELL_SCHEDULING = "--shell_scheduling"
+ARGS_SHELL_SCHEDULING_HELP = "A string from 'shells' and 'graph' giving how resolution shells are scheduled. If " \
+                             "'shells' then shells are processed in turn, each loading all its xmaps before " \
+                             "fitting its models and fitting all its models before analysing its datasets. If " \
+                             "'graph' then xmap loading, model fitting, dataset analysis and shell logging " \
+                             "across all shells run as one graph of tasks on a pool of the local cpus, highest " \
+                             "critical path first. Only used with the 'cluster' comparison strategy and serial " \
+                             "global processing."
 ARGS_GROUND_STATE_DATASETS = "--ground_state_datasets"
 ARGS_GROUND_STATE_DATASETS_HELP = "A comma seperated list of dtags to use for characterising the ground state."
 ARGS_EXCLUDE_FROM_Z_MAP_ANALYSIS = "--exclude_from_z_map_analysis"
@@ -173,6 +219,18 @@ ARGS_HIGH_RES_INCREMENT = "--high_res_increment"
 ARGS_HIGH_RES_INCREMENT_HELP = "A float which gives the maximum width of a resolution shell to process."
 ARGS_MAX_SHELL_DATASETS = "--max_shell_datasets"
 ARGS_MAX_SHELL_DATASETS_HELP = "An integer which gives that maximum number of datasets to process in one shell."
+ARGS_SHELL_PLANNER = "--shell_planner"
+ARGS_SHELL_PLANNER_HELP = "A string from 'fixed' and 'cost' giving how datasets are partitioned into resolution " \
+                          "shells with the 'cluster' comparison strategy. If 'fixed' then shells are placed at " \
+                          "fixed high resolution increments. If 'cost' then shell boundaries are chosen to " \
+                          "minimise the predicted xmap loading, FFT and model work over all shells, keeping every " \
+                          "dataset within one high resolution increment of its shell."
+ARGS_MAX_SHELL_MEMORY = "--max_shell_memory"
+ARGS_MAX_SHELL_MEMORY_HELP = "A float giving the most memory in GB the 'cost' shell planner lets the xmaps and " \
+                             "models of one shell take. If not given then shells are not limited."
+ARGS_PLAN_ONLY = "--plan_only"
+ARGS_PLAN_ONLY_HELP = "A boolean giving whether to stop after planning the resolution shells, reporting the " \
+                      "predicted cost of each shell."
 ARGS_MIN_CHARACTERISATION_DATASETS = "--min_characterisation_datasets"
 ARGS_MIN_CHARACTERISATION_DATASETS_HELP = "An integer which gives the minimum number of datasets to consider " \
                                           "processing in a shell."
@@ -240,6 +298,32 @@ ARGS_CIF_STRATEGY_HELP = "A string giving the strategy with which to generate th
 ARGS_RANK_METHOD = "--rank_method"
 ARGS_RANK_METHOD_HELP = "A string giving the ranking method to be used from 'size' and 'autobuild'. If 'size' then " \
                         "the size of event will be used. If 'autobuild' then the scores from autobuilding will be used."
+ARGS_CROP_EVENT_MAPS = "--crop_event_maps"
+ARGS_CROP_EVENT_MAPS_HELP = "A boolean value giving whether to write event maps cut down to a box around the event " \
+                            "(True) or covering the full native unit cell (False). Cropped event maps are used " \
+                            "directly for autobuilding."
+ARGS_EVENT_MAP_MARGIN = "--event_map_margin"
+ARGS_EVENT_MAP_MARGIN_HELP = "A float giving the margin in angstroms around the event to include in cropped event maps."
+ARGS_MODEL_SELECTION_TOP_K = "--model_selection_top_k"
+ARGS_MODEL_SELECTION_TOP_K_HELP = "An integer giving the number of models per dataset which survive the cheap " \
+                                  "z map/cluster statistics stage of model selection to have their events scored " \
+                                  "against ligand conformers. Models with no large clusters or which are " \
+                                  "dominated by another model are always pruned. If 0 then every undominated model is scored."
+ARGS_MAP_OUTPUT_FORMAT = "--map_output_format"
+ARGS_MAP_OUTPUT_FORMAT_HELP = "A string giving the format in which to write output maps from 'ccp4' and 'hdf5'. If " \
+                              "'hdf5' then the maps of each dataset are written as " \
+                              "compressed chunked arrays to a single {} container, which can be exported to ccp4 " \
+                              "with 'python -m pandda_gemmi.fs.map_store'. Maps needed for autobuilding are " \
+                              "always exported.".format(PANDDA_MAP_STORE_FILE)
+ARGS_MAP_COMPRESSION = "--map_compression"
+ARGS_MAP_COMPRESSION_HELP = "A string giving the compression used by the hdf5 map output from 'zstd', 'blosc', " \
+                            "'gzip' and 'none'."
+ARGS_ZMAP_QUANTISATION_STEP = "--zmap_quantisation_step"
+ARGS_ZMAP_QUANTISATION_STEP_HELP = "A float giving the step to which z maps written to hdf5 are rounded and stored " \
+                                   "as 16 bit integers. If 0 then z maps are stored as floats."
+ARGS_LOG_ALIGNMENT_RESIDUES = "--log_alignment_residues"
+ARGS_LOG_ALIGNMENT_RESIDUES_HELP = "A boolean value giving whether or not to print the local alignment of every residue " \
+                                   "of every dataset."
 ARGS_DEBUG = "--debug"
 ARGS_DEBUG_HELP = "A boolean value giving whether or not to print debugging information."
 
@@ -251,6 +335,18 @@ ARGS_LOCAL_CPUS_DEFAULT: int = 6
 ARGS_MEMORY_AVAILABILITY_DEFAULT: str = "low"
 ARGS_AUTOBUILD_DEFAULT: bool = True
 ARGS_RANK_METHOD_DEFAULT: str = "autobuild"
+ARGS_MODEL_SELECTION_TOP_K_DEFAULT: int = 3
+ARGS_CROP_EVENT_MAPS_DEFAULT: bool = True
+ARGS_EVENT_MAP_MARGIN_DEFAULT: float = 6.0
+ARGS_MAP_OUTPUT_FORMAT_DEFAULT: str = "ccp4"
+ARGS_MAP_COMPRESSION_DEFAULT: str = "zstd"
+ARGS_ZMAP_QUANTISATION_STEP_DEFAULT: float = 0.0
+ARGS_LOG_ALIGNMENT_RESIDUES_DEFAULT: bool = False
+ARGS_DISTRIBUTED_PAYLOAD_DEFAULT: str = "lazy"
+ARGS_SHELL_SCHEDULING_DEFAULT: str = "shells"
+ARGS_SHELL_PLANNER_DEFAULT: str = "fixed"
+ARGS_MAX_SHELL_MEMORY_DEFAULT = None
+ARGS_PLAN_ONLY_DEFAULT: bool = False
 
 ###################################################################
 # # Console constants
@@ -282,6 +378,8 @@ LOG_GAPS: str = "Datasets filtered for having large gaps"
 LOG_SG: str = "Datasets filtered for having a different spacegroup"
 
 LOG_DATASETS: str = "Summary of input datasets"
+LOG_DATASET_HEADERS_TIME: str = "Time taken to read dataset headers"
+LOG_DATASET_LOADING_TIME: str = "Time taken to load datasets passing the header filters"
 
 LOG_KNOWN_APOS: str = "Known apo dtags"
 
@@ -289,7 +387,9 @@ LOG_SHELL_XMAP_TIME: str = "Time taken to generate aligned xmaps"
 LOG_SHELL_DATASET_LOGS: str = "Logs for each dataset in shell"
 LOG_SHELL_TIME: str = "Time taken to process shell"
 LOG_SHELLS: str = "Logs for each shell"
+LOG_SHELL_PLAN: str = "Predicted cost of the shell plan"
 LOG_SHELL_DATASETS: str = "Datasets in shell"
+LOG_SHELL_OBJECT_STORE_MEMORY: str = "Ray object store capacity, used and available bytes after processing shell"
 
 LOG_DATASET_TIME: str = "TIme taken to process dataset"
 LOG_DATASET_TRAIN: str = "Datasets density charactersied against"
@@ -305,8 +405,12 @@ LOG_DATASET_MERGED_CLUSTERS_NUM: str = "Number of clusters after merging cluster
 LOG_DATASET_CLUSTER_TIME: str = "Time taken to cluster z map"
 LOG_DATASET_EVENT_TIME: str = "Time taken to get events"
 LOG_DATASET_EVENT_MAP_TIME: str = "Time taken to generate event map"
+LOG_DATASET_NATIVE_SAMPLING_PLAN_TIME: str = "Time taken to get native frame sampling plan"
 LOG_DATASET_XMAP_TIME: str = "Time taken to generate aligned xmaps"
 LOG_DATASET_CLUSTER_SIZES: str = "Size of initial clusters"
+LOG_DATASET_MODEL_STATISTICS: str = "Model statistics"
+LOG_DATASET_MODEL_PRUNING: str = "Model pruning"
+LOG_DATASET_MODEL_SCORING_TIME: str = "Time to score events of surviving models"
 
 LOG_AUTOBUILD_TIME: str = "Time taken to autobuild events"
 LOG_AUTOBUILD_SELECTED_BUILDS: str = "Build selected for each dataset"
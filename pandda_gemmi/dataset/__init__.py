@@ -1,3 +1,5 @@
-from pandda_gemmi.dataset.dataset import Structure, Dataset, Datasets, StructureFactors, Reflections, ResidueID, \
+from pandda_gemmi.dataset.dataset import Structure, StructureArrays, Dataset, Datasets, StructureFactors, Reflections, ResidueID, \
                                                                   Resolution, Reference, Symops, smooth, smooth_ray
 from pandda_gemmi.dataset.dataset_statistics import DatasetStatistics
+from pandda_gemmi.dataset.reflection_table import ReflectionTable, pack_hkl, unpack_hkl
+from pandda_gemmi.dataset.smoothing import ReferenceScalingProfile
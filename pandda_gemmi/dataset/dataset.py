@@ -5,6 +5,7 @@ from typing import Tuple
 import dataclasses
 from pathlib import Path
 from functools import partial
+from concurrent.futures import ThreadPoolExecutor
 
 import scipy
 from scipy import spatial
@@ -21,6 +22,9 @@ from pandda_gemmi.constants import *
 from pandda_gemmi.python_types import *
 from pandda_gemmi.common import Dtag, delayed
 from pandda_gemmi.common import Partial
+from pandda_gemmi.dataset.reflection_table import ReflectionTable
+from pandda_gemmi.dataset.smoothing import get_sample_grid, get_bin_membership, get_binned_means, get_smoothing_scale, \
+    ReferenceScalingProfile
 
 
 # from pandda_gemmi.fs import PanDDAFSModel
@@ -84,10 +88,97 @@ class RFree:
         return self.rfree
 
 
+@dataclasses.dataclass()
+class StructureArrays:
+    residue_ids: typing.List[ResidueID]
+    residue_index: typing.Dict[ResidueID, int]
+    ca_positions: np.ndarray
+    protein_positions: np.ndarray
+    protein_elements: np.ndarray
+    atom_positions: np.ndarray
+    atom_elements: np.ndarray
+    atom_is_water: np.ndarray
+    chains: typing.List[str]
+
+    @staticmethod
+    def from_structure(structure: gemmi.Structure) -> StructureArrays:
+        residue_ids = []
+        residue_index = {}
+        ca_positions = []
+        protein_positions = []
+        protein_elements = []
+        atom_positions = []
+        atom_elements = []
+        atom_is_water = []
+        chains = []
+
+        for model in structure:
+            for chain in model:
+                chains.append(chain.name)
+
+                for residue in chain:
+                    is_water = residue.is_water()
+                    for atom in residue:
+                        atom_positions.append((atom.pos.x, atom.pos.y, atom.pos.z))
+                        atom_elements.append(atom.element.name)
+                        atom_is_water.append(is_water)
+
+                for residue in chain.get_polymer():
+                    if residue.name.upper() not in RESIDUE_NAMES:
+                        continue
+
+                    for atom in residue:
+                        protein_positions.append((atom.pos.x, atom.pos.y, atom.pos.z))
+                        protein_elements.append(atom.element.name)
+
+                    try:
+                        ca = residue["CA"][0]
+                    except Exception as e:
+                        continue
+
+                    # Lookups by residue id find the first residue with that number, so repeats take its CA
+                    resid = ResidueID.from_residue_chain(model, chain, residue)
+                    if resid not in residue_index:
+                        residue_index[resid] = len(residue_ids)
+                        ca_positions.append((ca.pos.x, ca.pos.y, ca.pos.z))
+                    else:
+                        ca_positions.append(ca_positions[residue_index[resid]])
+                    residue_ids.append(resid)
+
+        return StructureArrays(
+            residue_ids=residue_ids,
+            residue_index=residue_index,
+            ca_positions=np.array(ca_positions, dtype=float).reshape(-1, 3),
+            protein_positions=np.array(protein_positions, dtype=float).reshape(-1, 3),
+            protein_elements=np.array(protein_elements, dtype=str),
+            atom_positions=np.array(atom_positions, dtype=float).reshape(-1, 3),
+            atom_elements=np.array(atom_elements, dtype=str),
+            atom_is_water=np.array(atom_is_water, dtype=bool),
+            chains=chains,
+        )
+
+    def non_water_positions(self) -> np.ndarray:
+        return self.atom_positions[~self.atom_is_water]
+
+    def common_ca_positions(self, other: StructureArrays) -> typing.Tuple[np.ndarray, np.ndarray]:
+        # CA positions of the residues in both structures, in the order of this structure
+        rows = []
+        other_rows = []
+        for row, resid in enumerate(self.residue_ids):
+            other_row = other.residue_index.get(resid)
+            if other_row is None:
+                continue
+            rows.append(row)
+            other_rows.append(other_row)
+
+        return self.ca_positions[np.array(rows, dtype=int)], other.ca_positions[np.array(other_rows, dtype=int)]
+
+
 @dataclasses.dataclass()
 class Structure:
     structure: gemmi.Structure
     path: typing.Union[Path, None] = None
+    _arrays: typing.Optional[StructureArrays] = dataclasses.field(default=None, repr=False, compare=False)
 
     @staticmethod
     def from_file(file: Path) -> Structure:
@@ -98,12 +189,36 @@ class Structure:
         structure.setup_entities()
         return Structure(structure, file)
 
+    @staticmethod
+    def from_file_header(file: Path) -> Structure:
+        # Only the records before the coordinates are needed for metadata such as the rfree
+        if file.suffix != ".pdb":
+            return Structure.from_file(file)
+
+        header_lines = []
+        try:
+            with open(file, "r") as f:
+                for line in f:
+                    if line.startswith(("ATOM", "HETATM", "MODEL")):
+                        break
+                    header_lines.append(line)
+            structure = gemmi.read_pdb_string("".join(header_lines))
+        except Exception as e:
+            raise Exception(f'Error trying to open file: {file}: {e}')
+        return Structure(structure, file)
+
     def rfree(self):
         return RFree.from_structure(self)
 
     def __getitem__(self, item: ResidueID):
         return self.structure[item.model][item.chain][item.insertion]
 
+    def arrays(self) -> StructureArrays:
+        # Coordinates are read out of gemmi once and reused by masking, alignment and statistics
+        if self._arrays is None:
+            self._arrays = StructureArrays.from_structure(self.structure)
+        return self._arrays
+
     # def residue_ids(self):
     #     residue_ids = []
     #     for model in self.structure:
@@ -115,19 +230,7 @@ class Structure:
     #     return residue_ids
 
     def protein_residue_ids(self):
-        for model in self.structure:
-            for chain in model:
-                for residue in chain.get_polymer():
-                    if residue.name.upper() not in RESIDUE_NAMES:
-                        continue
-
-                    try:
-                        has_ca = residue["CA"][0]
-                    except Exception as e:
-                        continue
-
-                    resid = ResidueID.from_residue_chain(model, chain, residue)
-                    yield resid
+        return iter(self.arrays().residue_ids)
 
     def protein_atoms(self):
         for model in self.structure:
@@ -169,38 +272,18 @@ class Structure:
         # Transform positions
         for atom in self.all_atoms():
             atom.pos = transform.apply_inverse(atom.pos)
+        self._arrays = None
 
         return self
 
     def get_alignment(self, other: Structure):
         # alignment returned is FROM other TO self
 
-        ca_self = []
-        ca_other = []
-
         # Get CAs
-        for model in self.structure:
-            for chain in model:
-                for res_self in chain.get_polymer():
-                    if res_self.name.upper() not in RESIDUE_NAMES:
-                        continue
-
-                    current_res_id = ResidueID.from_residue_chain(model, chain, res_self)
-
-                    res_other = other.structure[current_res_id][0]
-
-                    self_ca_pos = res_self["CA"][0].pos
-                    other_ca_pos = res_other["CA"][0].pos
-
-                    ca_list_self = Transform.pos_to_list(self_ca_pos)
-                    ca_list_other = Transform.pos_to_list(other_ca_pos)
-
-                    ca_self.append(ca_list_self)
-                    ca_other.append(ca_list_other)
-
-        # Make coord matricies
-        matrix_self = np.array(ca_self)
-        matrix_other = np.array(ca_other)
+        matrix_self, matrix_other = self.arrays().common_ca_positions(other.arrays())
+        if matrix_self.shape[0] != len(self.arrays().residue_ids):
+            raise Exception(f"Structure is missing {len(self.arrays().residue_ids) - matrix_self.shape[0]} residues "
+                            f"to align to")
 
         # Find means
         mean_self = np.mean(matrix_self, axis=0)
@@ -229,31 +312,11 @@ class Structure:
     def get_alignment(self, other: Structure):
         # alignment returned is FROM other TO self
 
-        ca_self = []
-        ca_other = []
-
         # Get CAs
-        for model in self.structure:
-            for chain in model:
-                for res_self in chain.get_polymer():
-                    if res_self.name.upper() not in RESIDUE_NAMES:
-                        continue
-                    current_res_id = ResidueID.from_residue_chain(model, chain, res_self)
-
-                    res_other = other.structure[current_res_id][0]
-
-                    self_ca_pos = res_self["CA"][0].pos
-                    other_ca_pos = res_other["CA"][0].pos
-
-                    ca_list_self = Transform.pos_to_list(self_ca_pos)
-                    ca_list_other = Transform.pos_to_list(other_ca_pos)
-
-                    ca_self.append(ca_list_self)
-                    ca_other.append(ca_list_other)
-
-        # Make coord matricies
-        matrix_self = np.array(ca_self)
-        matrix_other = np.array(ca_other)
+        matrix_self, matrix_other = self.arrays().common_ca_positions(other.arrays())
+        if matrix_self.shape[0] != len(self.arrays().residue_ids):
+            raise Exception(f"Structure is missing {len(self.arrays().residue_ids) - matrix_self.shape[0]} residues "
+                            f"to align to")
 
         # Find means
         mean_self = np.mean(matrix_self, axis=0)
@@ -288,19 +351,12 @@ class Structure:
         # Transform positions
         for atom in self.all_atoms():
             atom.pos = transform.apply_reference_to_moving(atom.pos)
+        self._arrays = None
 
         return self
 
-    def __getstate__(self):
-        structure_python = StructurePython.from_gemmi(self.structure)
-        return (structure_python, self.path)
-
-    def __setstate__(self, data: Tuple[StructurePython, Path]):
-        structure_python = data[0]
-        path = data[1]
-        self.structure = structure_python.to_gemmi()
-        self.structure.setup_entities()
-        self.path = path
+    def __reduce__(self):
+        return Structure, (self.structure, self.path)
 
 
 @dataclasses.dataclass()
@@ -336,12 +392,13 @@ class Symops:
 class Reflections:
     reflections: gemmi.Mtz
     path: typing.Union[Path, None] = None
+    _table: typing.Optional[ReflectionTable] = dataclasses.field(default=None, repr=False, compare=False)
 
     @staticmethod
-    def from_file(file: Path) -> Reflections:
+    def from_file(file: Path, with_data: bool = True) -> Reflections:
 
         try:
-            reflections = gemmi.read_mtz_file(str(file))
+            reflections = gemmi.read_mtz_file(str(file), with_data)
         except Exception as e:
             raise Exception(f'Error trying to open file: {file}: {e}')
         return Reflections(reflections, file)
@@ -349,104 +406,23 @@ class Reflections:
     def resolution(self) -> Resolution:
         return Resolution.from_float(self.reflections.resolution_high())
 
-    def truncate_resolution(self, resolution: Resolution) -> Reflections:
-        new_reflections = gemmi.Mtz(with_base=False)
-
-        # Set dataset properties
-        new_reflections.spacegroup = self.reflections.spacegroup
-        new_reflections.set_cell_for_all(self.reflections.cell)
-
-        # Add dataset
-        new_reflections.add_dataset("truncated")
-
-        # Add columns
-        for column in self.reflections.columns:
-            new_reflections.add_column(column.label, column.type)
-
-        # Get data
-        data_array = np.array(self.reflections, copy=True)
-        data = pd.DataFrame(data_array,
-                            columns=self.reflections.column_labels(),
-                            )
-        data.set_index(["H", "K", "L"], inplace=True)
-
-        # add resolutions
-        data["res"] = self.reflections.make_d_array()
-
-        # Truncate by resolution
-        data_truncated = data[data["res"] >= resolution.resolution]
-
-        # Remove res colum
-        data_dropped = data_truncated.drop(columns="res")
-
-        # To numpy
-        data_dropped_array = data_dropped.to_numpy()
-
-        # new data
-        new_data = np.hstack([data_dropped.index.to_frame().to_numpy(),
-                              data_dropped_array,
-                              ]
-                             )
-
-        # Update
-        new_reflections.set_data(new_data)
+    def table(self) -> ReflectionTable:
+        # Cache the numpy form so chained operations do not repeatedly copy out of the mtz
+        if self._table is None:
+            self._table = ReflectionTable.from_mtz(self.reflections)
+        return self._table
 
-        # Update resolution
-        new_reflections.update_reso()
+    @staticmethod
+    def from_table(table: ReflectionTable, dataset_name: str = "truncated") -> Reflections:
+        return Reflections(table.to_mtz(dataset_name), _table=table)
 
-        return Reflections(new_reflections)
+    def truncate_resolution(self, resolution: Resolution) -> Reflections:
+        return Reflections.from_table(self.table().truncate_resolution(resolution.resolution))
 
     def truncate_reflections(self, index=None) -> Reflections:
-        new_reflections = gemmi.Mtz(with_base=False)
-
-        # Set dataset properties
-        new_reflections.spacegroup = self.reflections.spacegroup
-        new_reflections.set_cell_for_all(self.reflections.cell)
-
-        # Add dataset
-        new_reflections.add_dataset("truncated")
-
-        # Add columns
-        for column in self.reflections.columns:
-            new_reflections.add_column(column.label, column.type)
-
-        # Get data
-        data_array = np.array(self.reflections, copy=True)
-        data = pd.DataFrame(data_array,
-                            columns=self.reflections.column_labels(),
-                            )
-        data.set_index(["H", "K", "L"], inplace=True)
-
-        # Truncate by index
-        data_indexed = data.loc[index]
-
-        # To numpy
-        data_dropped_array = data_indexed.to_numpy()
-
-        # new data
-        new_data = np.hstack([data_indexed.index.to_frame().to_numpy(),
-                              data_dropped_array,
-                              ]
-                             )
-
-        # Update
-        new_reflections.set_data(new_data)
-
-        # Update resolution
-        new_reflections.update_reso()
-
-        return Reflections(new_reflections)
+        return Reflections.from_table(self.table().select_keys(index))
 
     def drop_columns(self, structure_factors: StructureFactors):
-        new_reflections = gemmi.Mtz(with_base=False)
-
-        # Set dataset properties
-        new_reflections.spacegroup = self.reflections.spacegroup
-        new_reflections.set_cell_for_all(self.reflections.cell)
-
-        # Add dataset
-        new_reflections.add_dataset("truncated")
-
         free_flag = None
 
         # CV-20220303: should we really restrict ourself to some
@@ -462,47 +438,13 @@ class Reflections:
         if not free_flag:
             raise Exception("No RFree Flag found!")
 
-        # Add columns
-        expected_columns = ["H", "K", "L", free_flag, structure_factors.f, structure_factors.phi]
-
         # CV-20220302: we need to work in the order of expected
         #              columns here to ensure the data will end up in
         #              that order as well - irrespective of the order
         #              in the reflection/MTZ file
-        for e in expected_columns:
-            for column in self.reflections.columns:
-                if column.label == e:
-                    new_reflections.add_column(column.label, column.type)
-
-        # Get data
-        data_array = np.array(self.reflections, copy=True)
-        data = pd.DataFrame(data_array,
-                            columns=self.reflections.column_labels(),
-                            )
-        data.set_index(["H", "K", "L"], inplace=True)
-
-        # Truncate by columns
-        # CV-20220303: this assumes an order - so above column
-        #              assignment also needs to have that order
-        #              enforced
-        data_indexed = data[[free_flag, structure_factors.f, structure_factors.phi]]
+        expected_columns = [free_flag, structure_factors.f, structure_factors.phi]
 
-        # To numpy
-        data_dropped_array = data_indexed.to_numpy()
-
-        # new data
-        new_data = np.hstack([data_indexed.index.to_frame().to_numpy(),
-                              data_dropped_array,
-                              ]
-                             )
-
-        # Update
-        new_reflections.set_data(new_data)
-
-        # Update resolution
-        new_reflections.update_reso()
-
-        return Reflections(new_reflections)
+        return Reflections.from_table(self.table().select_columns(expected_columns))
 
     def spacegroup(self):
         return self.reflections.spacegroup
@@ -511,56 +453,32 @@ class Reflections:
         return self.reflections.column_labels()
 
     def missing(self, structure_factors: StructureFactors, resolution: Resolution) -> pd.DataFrame:
-        all_data = np.array(self.reflections, copy=True)
-        resolution_array = self.reflections.make_d_array()
-
-        table = pd.DataFrame(data=all_data, columns=self.reflections.column_labels())
-
-        reflections_in_resolution = table[resolution_array >= resolution.to_float()]
+        table = self.table().truncate_resolution(resolution.to_float())
 
-        amplitudes = reflections_in_resolution[structure_factors.f]
+        missing = table.select_rows(table.column(structure_factors.f) == 0)
 
-        missing = reflections_in_resolution[amplitudes == 0]
-
-        return missing
+        return pd.DataFrame(data=missing.data, columns=missing.labels)
 
     def common_set(self, other_reflections: Reflections):
-        # Index own reflections
-        reflections_array = np.array(self.reflections, copy=False, )
-        hkl_dict = {}
-        f_index = self.reflections.column_labels().index("F")
-        for i, row in enumerate(reflections_array):
-            hkl = (row[0], row[1], row[2])
-            if not np.isnan(row[f_index]):
-                hkl_dict[hkl] = i
-
-        # Index the other array
-        other_reflections_array = np.array(other_reflections.reflections, copy=False, )
-        other_hkl_dict = {}
-        f_other_index = other_reflections.reflections.column_labels().index("F")
-        for i, row in enumerate(other_reflections_array):
-            hkl = (row[0], row[1], row[2])
-            if not np.isnan(row[f_other_index]):
-                other_hkl_dict[hkl] = i
+        table = self.table()
+        other_table = other_reflections.table()
+
+        # Join the observed reflections on their packed miller indices
+        rows = np.nonzero(~np.isnan(table.column("F")))[0]
+        other_rows = np.nonzero(~np.isnan(other_table.column("F")))[0]
+        _, common_rows, other_common_rows = np.intersect1d(
+            table.keys[rows],
+            other_table.keys[other_rows],
+            return_indices=True,
+        )
 
         # Allocate the masks
-        self_mask = np.zeros(reflections_array.shape[0],
-                             dtype=np.bool,
-                             )
-
-        other_mask = np.zeros(other_reflections_array.shape[0],
-                              dtype=np.bool,
-                              )
+        self_mask = np.zeros(len(table), dtype=bool, )
+        other_mask = np.zeros(len(other_table), dtype=bool, )
 
         # Fill the masks
-        for hkl, index in hkl_dict.items():
-            try:
-                other_index = other_hkl_dict[hkl]
-                self_mask[index] = True
-                other_mask[other_index] = True
-
-            except:
-                continue
+        self_mask[rows[common_rows]] = True
+        other_mask[other_rows[other_common_rows]] = True
 
         return self_mask, other_mask
 
@@ -649,15 +567,8 @@ class Reflections:
             x_r_all = x_r_truncated
             y_r_all = y_r_truncated
 
-    def __getstate__(self):
-        return (MtzPython.from_gemmi(self.reflections), self.path)
-
-    def __setstate__(self, data: Tuple[MtzPython, Path]):
-        reflections_python = data[0]
-        path = data[1]
-        reflections = reflections_python.to_gemmi()
-        self.reflections = reflections
-        self.path = path
+    def __reduce__(self):
+        return Reflections, (self.reflections, self.path)
 
 
 @dataclasses.dataclass()
@@ -706,6 +617,7 @@ class Dataset:
     structure: Structure
     reflections: Reflections
     smoothing_factor: float = 0.0
+    header_only: bool = False
 
     @staticmethod
     def from_files(pdb_file: Path, mtz_file: Path, ):
@@ -716,6 +628,24 @@ class Dataset:
                        reflections=reflections,
                        )
 
+    @staticmethod
+    def from_files_header(pdb_file: Path, mtz_file: Path, ):
+        # Enough for filtering on columns, resolution, spacegroup, cell and rfree without reading the reflections
+        # or coordinates
+        strucure: Structure = Structure.from_file_header(pdb_file)
+        reflections: Reflections = Reflections.from_file(mtz_file, with_data=False)
+
+        return Dataset(structure=strucure,
+                       reflections=reflections,
+                       header_only=True,
+                       )
+
+    def load(self) -> Dataset:
+        if not self.header_only:
+            return self
+
+        return Dataset.from_files(self.structure.path, self.reflections.path)
+
     def truncate_resolution(self, resolution: Resolution) -> Dataset:
         return Dataset(self.structure,
                        self.reflections.truncate_resolution(resolution,
@@ -744,154 +674,13 @@ class Dataset:
                            reference_ref: Reflections,
                            structure_factors: StructureFactors,
                            ):
-        # Get own reflections
-        dtag_reflections = self.reflections.reflections
-        dtag_reflections_array = np.array(dtag_reflections, copy=True)
-        dtag_reflections_table = pd.DataFrame(dtag_reflections_array,
-                                              columns=dtag_reflections.column_labels(),
-                                              )
-        dtag_reflections_table.set_index(["H", "K", "L"], inplace=True)
-        dtag_flattened_index = dtag_reflections_table[
-            ~dtag_reflections_table[structure_factors.f].isna()].index.to_flat_index()
-
-        # Get reference
-        reference_reflections = reference_ref.reflections
-        reference_reflections_array = np.array(reference_reflections, copy=True)
-        reference_reflections_table = pd.DataFrame(reference_reflections_array,
-                                                   columns=reference_reflections.column_labels(),
-                                                   )
-        reference_reflections_table.set_index(["H", "K", "L"], inplace=True)
-        reference_flattened_index = reference_reflections_table[
-            ~reference_reflections_table[structure_factors.f].isna()].index.to_flat_index()
-
-        running_index = dtag_flattened_index.intersection(reference_flattened_index)
-
-        return running_index.to_list()
+        return self.reflections.table().common_keys(reference_ref.table(), structure_factors.f)
 
     def smooth(self, reference: Reference, structure_factors: StructureFactors):
-        reference_dataset = reference.dataset
-
-        # Get common set of reflections
-        common_reflections = self.common_reflections(reference_dataset.reflections,
-                                                     structure_factors,
-                                                     )
-
-        # Truncate
-        truncated_reference = reference.dataset.truncate_reflections(common_reflections)
-        truncated_dataset = self.truncate_reflections(common_reflections)
-
-        # Refference array
-        reference_reflections = truncated_reference.reflections.reflections
-        reference_reflections_array = np.array(reference_reflections,
-                                               copy=True,
-                                               )
-        reference_reflections_table = pd.DataFrame(reference_reflections_array,
-                                                   columns=reference_reflections.column_labels(),
-                                                   )
-        reference_f_array = reference_reflections_table[structure_factors.f].to_numpy()
-
-        # Dtag array
-        dtag_reflections = truncated_dataset.reflections.reflections
-        dtag_reflections_array = np.array(dtag_reflections,
-                                          copy=True,
-                                          )
-        dtag_reflections_table = pd.DataFrame(dtag_reflections_array,
-                                              columns=dtag_reflections.column_labels(),
-                                              )
-        dtag_f_array = dtag_reflections_table[structure_factors.f].to_numpy()
-
-        # Resolution array
-        resolution_array = reference_reflections.make_1_d2_array()
-
-        # Prepare optimisation
-        x = reference_f_array
-        y = dtag_f_array
-
-        r = resolution_array
-
-        sample_grid = np.linspace(min(r), max(r), 100)
-
-        knn_x = neighbors.RadiusNeighborsRegressor(0.01)
-        knn_x.fit(r.reshape(-1, 1),
-                  x.reshape(-1, 1),
-                  )
-        x_f = knn_x.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-        scales = []
-        rmsds = []
-
-        knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-        knn_y.fit(r.reshape(-1, 1),
-                  (y * np.exp(0.0 * r)).reshape(-1, 1),
-                  )
-
-        # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-        y_neighbours = knn_y.radius_neighbors(sample_grid[:, np.newaxis])
-
-        # Optimise the scale factor
-        for scale in np.linspace(-4, 4, 100):
-            y_s = y * np.exp(scale * r)
-            # knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-            # knn_y.fit(r.reshape(-1, 1),
-            #           y_s.reshape(-1, 1),
-            #           )
-            #
-            # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-            y_f = np.array([np.mean(y_s[y_neighbours[1][j]]) for j, val in enumerate(sample_grid[:,
-                                                                                     np.newaxis].flatten())])
-
-            rmsd = np.sum(np.abs(x_f - y_f))
-
-            scales.append(scale)
-            rmsds.append(rmsd)
-
-        min_scale = scales[np.argmin(rmsds)]
-
-        # Get the original reflections
-        original_reflections = self.reflections.reflections
-
-        original_reflections_array = np.array(original_reflections,
-                                              copy=True,
-                                              )
-
-        original_reflections_table = pd.DataFrame(original_reflections_array,
-                                                  columns=reference_reflections.column_labels(),
-                                                  )
-
-        f_array = original_reflections_table[structure_factors.f]
-
-        f_scaled_array = f_array * np.exp(min_scale * original_reflections.make_1_d2_array())
-
-        original_reflections_table[structure_factors.f] = f_scaled_array
-
-        # New reflections
-        new_reflections = gemmi.Mtz(with_base=False)
-
-        # Set dataset properties
-        new_reflections.spacegroup = original_reflections.spacegroup
-        new_reflections.set_cell_for_all(original_reflections.cell)
-
-        # Add dataset
-        new_reflections.add_dataset("scaled")
-
-        # Add columns
-        for column in original_reflections.columns:
-            new_reflections.add_column(column.label, column.type)
-
-        # Update
-        new_reflections.set_data(original_reflections_table.to_numpy())
-
-        # Update resolution
-        new_reflections.update_reso()
-
-        # Create new dataset
-        smoothed_dataset = Dataset(self.structure,
-                                   Reflections(new_reflections),
-                                   )
-
-        return smoothed_dataset
+        return smooth(self,
+                      ReferenceScalingProfile.from_reference(reference, structure_factors),
+                      structure_factors,
+                      )
 
     # def correlation(self,
     #                 alignment: Alignment,
@@ -922,137 +711,45 @@ class Dataset:
     #     # return
     #     return correlation
 
-def smooth(dataset, reference: Reference, structure_factors: StructureFactors):
-    reference_dataset = reference.dataset
-
-    # Get common set of reflections
-    common_reflections = dataset.common_reflections(reference_dataset.reflections,
-                                                 structure_factors,
-                                                 )
-
-    # Truncate
-    truncated_reference = reference.dataset.truncate_reflections(common_reflections)
-    truncated_dataset = dataset.truncate_reflections(common_reflections)
-
-    # Reference array
-    reference_reflections = truncated_reference.reflections.reflections
-    reference_reflections_array = np.array(reference_reflections,
-                                           copy=True,
-                                           )
-    reference_reflections_table = pd.DataFrame(reference_reflections_array,
-                                               columns=reference_reflections.column_labels(),
-                                               )
-    reference_f_array = reference_reflections_table[structure_factors.f].to_numpy()
-
-    # Dtag array
-    dtag_reflections = truncated_dataset.reflections.reflections
-    dtag_reflections_array = np.array(dtag_reflections,
-                                      copy=True,
-                                      )
-    dtag_reflections_table = pd.DataFrame(dtag_reflections_array,
-                                          columns=dtag_reflections.column_labels(),
-                                          )
-    dtag_f_array = dtag_reflections_table[structure_factors.f].to_numpy()
-
-    # Resolution array
-    resolution_array = reference_reflections.make_1_d2_array()
-
-    # Prepare optimisation
-    x = reference_f_array
-    y = dtag_f_array
-
-    r = resolution_array
+def smooth(dataset, reference_profile: ReferenceScalingProfile, structure_factors: StructureFactors):
+    # Join the dataset against the reference reflections observed in both
+    x, y, r = reference_profile.join(dataset.reflections.table(), structure_factors.f)
 
     print('resolution = ',min(r),max(r))
 
-    sample_grid = np.linspace(min(r), max(r), 100)
+    sample_grid = get_sample_grid(r)
 
-    knn_x = neighbors.RadiusNeighborsRegressor(0.01)
-    knn_x.fit(r.reshape(-1, 1),
-              x.reshape(-1, 1),
-              )
-    x_f = knn_x.predict(sample_grid[:, np.newaxis]).reshape(-1)
+    # Mean of the reflections near each sample point
+    membership = get_bin_membership(r, sample_grid)
 
-    scales = []
-    rmsds = []
+    x_f = get_binned_means(membership, x)
 
-    knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-    knn_y.fit(r.reshape(-1, 1),
-              (y * np.exp(0.0 * r)).reshape(-1, 1),
-              )
-
-    # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-    y_neighbours = knn_y.radius_neighbors(sample_grid[:, np.newaxis])
-
-    # Optimise the scale factor
-    for scale in np.linspace(-4, 4, 100):
-        y_s = y * np.exp(scale * r)
-        # knn_y = neighbors.RadiusNeighborsRegressor(0.01)
-        # knn_y.fit(r.reshape(-1, 1),
-        #           y_s.reshape(-1, 1),
-        #           )
-        #
-        # y_f = knn_y.predict(sample_grid[:, np.newaxis]).reshape(-1)
-
-        y_f = np.array([np.mean(y_s[y_neighbours[1][j]]) for j, val in enumerate(sample_grid[:,
-                                                                                 np.newaxis].flatten())])
-
-        rmsd = np.sum(np.abs(x_f - y_f))
-
-        scales.append(scale)
-        rmsds.append(rmsd)
-
-    min_scale = scales[np.argmin(rmsds)]
-    print('\tdataset, minimum scale, rmsd = %s %10.4f %10.2f' % (dataset.structure.path,min_scale,min(rmsds)))
+    # Optimise the scale factor over all candidate scales at once
+    min_scale, min_rmsd = get_smoothing_scale(x_f, y, r, membership)
+    print('\tdataset, minimum scale, rmsd = %s %10.4f %10.2f' % (dataset.structure.path,min_scale,min_rmsd))
 
     # Get the original reflections
-    original_reflections = dataset.reflections.reflections
-
-    original_reflections_array = np.array(original_reflections,
-                                          copy=True,
-                                          )
+    original_table = dataset.reflections.table()
 
-    original_reflections_table = pd.DataFrame(original_reflections_array,
-                                              columns=reference_reflections.column_labels(),
-                                              )
+    f_array = original_table.column(structure_factors.f)
 
-    f_array = original_reflections_table[structure_factors.f]
-
-    f_scaled_array = f_array * np.exp(min_scale * original_reflections.make_1_d2_array())
-
-    original_reflections_table[structure_factors.f] = f_scaled_array
+    f_scaled_array = f_array * np.exp(min_scale * original_table.one_over_d2())
 
     # New reflections
-    new_reflections = gemmi.Mtz(with_base=False)
-
-    # Set dataset properties
-    new_reflections.spacegroup = original_reflections.spacegroup
-    new_reflections.set_cell_for_all(original_reflections.cell)
-
-    # Add dataset
-    new_reflections.add_dataset("scaled")
-
-    # Add columns
-    for column in original_reflections.columns:
-        new_reflections.add_column(column.label, column.type)
-
-    # Update
-    new_reflections.set_data(original_reflections_table.to_numpy())
-
-    # Update resolution
-    new_reflections.update_reso()
+    new_reflections = Reflections.from_table(original_table.with_column(structure_factors.f, f_scaled_array),
+                                             "scaled",
+                                             )
 
     # Create new dataset
     smoothed_dataset = Dataset(dataset.structure,
-                               Reflections(new_reflections),
+                               new_reflections,
                                )
 
     return smoothed_dataset
 
 @ray.remote
-def smooth_ray(dataset, reference: Reference, structure_factors: StructureFactors):
-    return smooth(dataset, reference, structure_factors)
+def smooth_ray(dataset, reference_profile: ReferenceScalingProfile, structure_factors: StructureFactors):
+    return smooth(dataset, reference_profile, structure_factors)
 
 @dataclasses.dataclass()
 class RMSD:
@@ -1069,42 +766,7 @@ class RMSD:
     @staticmethod
     def from_structures(structure_1: Structure, structure_2: Structure, ) -> RMSD:
 
-        distances = []
-
-        positions_1 = []
-        positions_2 = []
-
-        # for residues_id in structure_1.protein_residue_ids():
-        for residues_id in structure_1.protein_residue_ids():
-
-            res_1 = structure_1[residues_id][0]
-            try:
-                res_2 = structure_2[residues_id][0]
-            except:
-                continue
-
-            # print(f"Residue 1 is: {res_1}")
-            # print(f"Residue 2 is: {res_2}")
-            try:
-                res_1_ca = res_1["CA"][0]
-            except Exception as e:
-                continue
-
-            try:
-                res_2_ca = res_2["CA"][0]
-            except Exception as e:
-                continue
-
-            res_1_ca_pos = res_1_ca.pos
-            res_2_ca_pos = res_2_ca.pos
-
-            positions_1.append(res_1_ca_pos)
-            positions_2.append(res_2_ca_pos)
-
-            distances.append(res_1_ca_pos.dist(res_2_ca_pos))
-
-        positions_1_array = np.array([[x[0], x[1], x[2]] for x in positions_1])
-        positions_2_array = np.array([[x[0], x[1], x[2]] for x in positions_2])
+        positions_1_array, positions_2_array = structure_1.arrays().common_ca_positions(structure_2.arrays())
 
         if positions_1_array.size < 3:
             return RMSD(100.0)
@@ -1163,15 +825,26 @@ class Datasets:
         return Datasets(datasets)
 
     @staticmethod
-    def from_dir(pandda_fs_model  #: PanDDAFSModel,
+    def from_dir(pandda_fs_model,  #: PanDDAFSModel,
+                 header_only: bool = False,
+                 num_threads: int = DATASET_LOADING_THREADS,
                  ):
-        datasets = {}
-        for dtag, dataset_dir in pandda_fs_model.data_dirs.to_dict().items():
-            dataset: Dataset = Dataset.from_files(dataset_dir.input_pdb_file,
-                                                  dataset_dir.input_mtz_file,
-                                                  )
+        # Reading is dominated by file system latency, so read datasets concurrently
+        dataset_dirs = pandda_fs_model.data_dirs.to_dict()
+        from_files = Dataset.from_files_header if header_only else Dataset.from_files
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = executor.map(
+                lambda dataset_dir: from_files(dataset_dir.input_pdb_file, dataset_dir.input_mtz_file, ),
+                dataset_dirs.values(),
+            )
+            datasets = {dtag: dataset for dtag, dataset in zip(dataset_dirs, results)}
 
-            datasets[dtag] = dataset
+        return Datasets(datasets)
+
+    def load(self, num_threads: int = DATASET_LOADING_THREADS) -> Datasets:
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            results = executor.map(lambda dataset: dataset.load(), self.datasets.values())
+            datasets = {dtag: dataset for dtag, dataset in zip(self.datasets, results)}
 
         return Datasets(datasets)
 
@@ -1273,26 +946,14 @@ class Datasets:
 
     def common_reflections(self, structure_factors: StructureFactors, tol=0.000001):
 
-        running_index = None
+        running_keys = None
 
         for dtag in self.datasets:
-            dataset = self.datasets[dtag]
-            reflections = dataset.reflections.reflections
-            reflections_array = np.array(reflections, copy=True)
-            reflections_table = pd.DataFrame(reflections_array,
-                                             columns=reflections.column_labels(),
-                                             )
-            reflections_table.set_index(["H", "K", "L"], inplace=True)
-
-            is_na = reflections_table[structure_factors.f].isna()
-            is_zero = reflections_table[structure_factors.f].abs() < tol
-            mask = ~(is_na | is_zero)
-
-            flattened_index = reflections_table[mask].index.to_flat_index()
-            if running_index is None:
-                running_index = flattened_index
-            running_index = running_index.intersection(flattened_index)
-        return running_index.to_list()
+            keys = self.datasets[dtag].reflections.table().observed_keys(structure_factors.f, tol)
+            if running_keys is None:
+                running_keys = keys
+            running_keys = np.intersect1d(running_keys, keys, assume_unique=True)
+        return running_keys
 
     def truncate(self, resolution: Resolution, structure_factors: StructureFactors) -> Datasets:
         new_datasets_resolution = {}
@@ -1311,13 +972,8 @@ class Datasets:
         # truncate on reflections
         new_datasets_reflections = {}
         for dtag in dataset_resolution_truncated:
-            reflections = dataset_resolution_truncated[dtag].reflections.reflections
-            reflections_array = np.array(reflections)
-
             truncated_dataset = dataset_resolution_truncated[dtag].truncate_reflections(common_reflections,
                                                                                         )
-            reflections = truncated_dataset.reflections.reflections
-            reflections_array = np.array(reflections)
 
             new_datasets_reflections[dtag] = truncated_dataset
 
@@ -1331,6 +987,9 @@ class Datasets:
                         mapper=False,
                         ):
 
+        # The reference is reduced to its observed amplitudes once rather than being truncated against each dataset
+        reference_profile = ReferenceScalingProfile.from_reference(reference, structure_factors)
+
         if mapper:
             keys = list(self.datasets.keys())
 
@@ -1342,7 +1001,7 @@ class Datasets:
                         Partial(
                             smooth_func,
                             self[key],
-                        reference,
+                        reference_profile,
                         structure_factors
                         )
                     for key
@@ -1361,9 +1020,10 @@ class Datasets:
             for dtag in self.datasets:
                 dataset = self.datasets[dtag]
 
-                smoothed_dataset = dataset.smooth(reference,
-                                                  structure_factors,
-                                                  )
+                smoothed_dataset = smooth(dataset,
+                                          reference_profile,
+                                          structure_factors,
+                                          )
                 smoothed_datasets[dtag] = smoothed_dataset
 
         return Datasets(smoothed_datasets)
@@ -1374,32 +1034,19 @@ class Datasets:
                cut=97.5,
                ):
 
-        reference_reflections_array = np.array(reference_reflections,
-                                               copy=True,
-                                               )
+        reference_reflections_table = ReflectionTable.from_mtz(reference_reflections)
 
-        reference_reflections_table = pd.DataFrame(reference_reflections_array,
-                                                   columns=reference_reflections.column_labels(),
-                                                   )
+        reference_f_array = reference_reflections_table.column(structure_factors.f)
 
-        reference_f_array = reference_reflections_table[structure_factors.f].to_numpy()
-
-        resolution_array = reference_reflections.make_1_d2_array()
+        resolution_array = reference_reflections_table.one_over_d2()
 
         new_reflections_dict = {}
         smoothing_factor_dict = {}
         for dtag in self.datasets:
 
-            dtag_reflections = self.datasets[dtag].reflections.reflections
-
-            dtag_reflections_array = np.array(dtag_reflections,
-                                              copy=True,
-                                              )
-            dtag_reflections_table = pd.DataFrame(dtag_reflections_array,
-                                                  columns=dtag_reflections.column_labels(),
-                                                  )
+            dtag_reflections_table = self.datasets[dtag].reflections.table()
 
-            dtag_f_array = dtag_reflections_table[structure_factors.f].to_numpy()
+            dtag_f_array = dtag_reflections_table.column(structure_factors.f)
 
             x = reference_f_array
             y = dtag_f_array
@@ -1435,31 +1082,15 @@ class Datasets:
             min_scale = scales[np.argmin(rmsds)]
             print('min_scale =',min_scale)
 
-            f_array = dtag_reflections_table[structure_factors.f]
+            f_array = dtag_reflections_table.column(structure_factors.f)
 
             f_scaled_array = f_array * np.exp(min_scale * resolution_array)
 
-            dtag_reflections_table[structure_factors.f] = f_scaled_array
-
             # New reflections
-            new_reflections = gemmi.Mtz(with_base=False)
-
-            # Set dataset properties
-            new_reflections.spacegroup = dtag_reflections.spacegroup
-            new_reflections.set_cell_for_all(dtag_reflections.cell)
-
-            # Add dataset
-            new_reflections.add_dataset("scaled")
-
-            # Add columns
-            for column in dtag_reflections.columns:
-                new_reflections.add_column(column.label, column.type)
-
-            # Update
-            new_reflections.set_data(dtag_reflections_table.to_numpy())
-
-            # Update resolution
-            new_reflections.update_reso()
+            new_reflections = Reflections.from_table(
+                dtag_reflections_table.with_column(structure_factors.f, f_scaled_array),
+                "scaled",
+            )
 
             new_reflections_dict[dtag] = new_reflections
             smoothing_factor_dict[dtag] = min_scale
@@ -1474,7 +1105,7 @@ class Datasets:
             smoothing_factor = smoothing_factor_dict[dtag]
 
             new_dataset = Dataset(structure,
-                                  Reflections(new_reflections),
+                                  new_reflections,
                                   smoothing_factor=smoothing_factor
                                   )
             new_datasets_dict[dtag] = new_dataset
@@ -43,15 +43,7 @@ class DatasetStatistics:
         chains = []
         for dtag, dataset in datasets.items():
 
-            dataset_structure = dataset.structure.structure
-
-            dataset_chains = []
-
-            for model in dataset_structure:
-                for chain in model:
-                    dataset_chains.append(chain.name)
-
-            dataset_chains = list(sorted(dataset_chains))
+            dataset_chains = list(sorted(dataset.structure.arrays().chains))
 
             chains.append(dataset_chains)
 
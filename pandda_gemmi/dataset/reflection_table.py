@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+import typing
+import dataclasses
+
+from pandda_gemmi.python_types import *
+
+HKL_KEY_BITS = 21
+HKL_KEY_OFFSET = 1 << (HKL_KEY_BITS - 1)
+
+
+def pack_hkl(hkl: np.ndarray) -> np.ndarray:
+    hkl = np.asarray(hkl).reshape(-1, 3).astype(np.int64) + HKL_KEY_OFFSET
+    return (hkl[:, 0] << (2 * HKL_KEY_BITS)) | (hkl[:, 1] << HKL_KEY_BITS) | hkl[:, 2]
+
+
+def unpack_hkl(keys: np.ndarray) -> np.ndarray:
+    mask = (1 << HKL_KEY_BITS) - 1
+    return np.stack(
+        [
+            (keys >> (2 * HKL_KEY_BITS)) & mask,
+            (keys >> HKL_KEY_BITS) & mask,
+            keys & mask,
+        ],
+        axis=1,
+    ) - HKL_KEY_OFFSET
+
+
+@dataclasses.dataclass()
+class ReflectionTable:
+    data: np.ndarray
+    labels: typing.List[str]
+    types: typing.List[str]
+    spacegroup: gemmi.SpaceGroup
+    cell: gemmi.UnitCell
+    d: np.ndarray
+    keys: np.ndarray
+    observed_keys_cache: typing.Dict[typing.Tuple[str, typing.Optional[float]], np.ndarray] = dataclasses.field(
+        default_factory=dict, repr=False, compare=False)
+
+    @staticmethod
+    def from_mtz(mtz: gemmi.Mtz) -> ReflectionTable:
+        data = np.array(mtz, copy=True)
+        return ReflectionTable(
+            data=data,
+            labels=mtz.column_labels(),
+            types=[column.type for column in mtz.columns],
+            spacegroup=mtz.spacegroup,
+            cell=mtz.cell,
+            d=mtz.make_d_array(),
+            keys=pack_hkl(data[:, :3]),
+        )
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def column(self, label: str) -> np.ndarray:
+        return self.data[:, self.labels.index(label)]
+
+    def one_over_d2(self) -> np.ndarray:
+        return 1.0 / np.square(self.d)
+
+    def select_rows(self, rows: np.ndarray) -> ReflectionTable:
+        return ReflectionTable(
+            data=self.data[rows],
+            labels=self.labels,
+            types=self.types,
+            spacegroup=self.spacegroup,
+            cell=self.cell,
+            d=self.d[rows],
+            keys=self.keys[rows],
+        )
+
+    def select_columns(self, labels: typing.List[str]) -> ReflectionTable:
+        # The miller indices are always kept as the first columns
+        labels = ["H", "K", "L"] + [label for label in labels if label not in ("H", "K", "L")]
+        indexes = [self.labels.index(label) for label in labels]
+        return ReflectionTable(
+            data=self.data[:, indexes],
+            labels=labels,
+            types=[self.types[index] for index in indexes],
+            spacegroup=self.spacegroup,
+            cell=self.cell,
+            d=self.d,
+            keys=self.keys,
+        )
+
+    def truncate_resolution(self, resolution: float) -> ReflectionTable:
+        return self.select_rows(self.d >= resolution)
+
+    def select_keys(self, keys: np.ndarray) -> ReflectionTable:
+        # Rows are returned in the order of the given keys, so tables selected with the same keys line up
+        order = np.argsort(self.keys, kind="stable")
+        positions = np.searchsorted(self.keys, keys, sorter=order)
+        positions = np.clip(positions, 0, len(order) - 1)
+        rows = order[positions]
+        if not np.all(self.keys[rows] == keys):
+            raise Exception(f"Tried to select {np.sum(self.keys[rows] != keys)} reflections not in the table")
+        return self.select_rows(rows)
+
+    def select_hkls(self, hkls) -> ReflectionTable:
+        return self.select_keys(pack_hkl(np.array(hkls)))
+
+    def observed_keys(self, label: str, tol: typing.Optional[float] = None) -> np.ndarray:
+        # Sorted keys of the reflections with a value in the column, cached as the reference is joined against
+        # every dataset
+        cache_key = (label, tol)
+        if cache_key not in self.observed_keys_cache:
+            values = self.column(label)
+            mask = ~np.isnan(values)
+            if tol is not None:
+                mask = mask & (np.abs(values) >= tol)
+            self.observed_keys_cache[cache_key] = np.unique(self.keys[mask])
+        return self.observed_keys_cache[cache_key]
+
+    def common_keys(self, other: ReflectionTable, label: str, tol: typing.Optional[float] = None) -> np.ndarray:
+        return np.intersect1d(
+            self.observed_keys(label, tol),
+            other.observed_keys(label, tol),
+            assume_unique=True,
+        )
+
+    def with_column(self, label: str, values: np.ndarray) -> ReflectionTable:
+        data = self.data.copy()
+        data[:, self.labels.index(label)] = values
+        return ReflectionTable(
+            data=data,
+            labels=self.labels,
+            types=self.types,
+            spacegroup=self.spacegroup,
+            cell=self.cell,
+            d=self.d,
+            keys=self.keys,
+        )
+
+    def to_mtz(self, dataset_name: str = "truncated") -> gemmi.Mtz:
+        mtz = gemmi.Mtz(with_base=False)
+
+        # Set dataset properties
+        mtz.spacegroup = self.spacegroup
+        mtz.set_cell_for_all(self.cell)
+
+        # Add dataset
+        mtz.add_dataset(dataset_name)
+
+        # Add columns
+        for label, column_type in zip(self.labels, self.types):
+            mtz.add_column(label, column_type)
+
+        # Update
+        mtz.set_data(np.ascontiguousarray(self.data, dtype=np.float32))
+
+        # Update resolution
+        mtz.update_reso()
+
+        return mtz
@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import typing
+import dataclasses
+
+from scipy import sparse
+
+from pandda_gemmi.constants import *
+from pandda_gemmi.python_types import *
+
+
+def get_sample_grid(r: np.ndarray, num_bins: int = SMOOTHING_NUM_BINS) -> np.ndarray:
+    return np.linspace(np.min(r), np.max(r), num_bins)
+
+
+def get_bin_membership(r: np.ndarray,
+                       sample_grid: np.ndarray,
+                       radius: float = SMOOTHING_BIN_RADIUS,
+                       ) -> sparse.csr_matrix:
+    # A [bins, reflections] matrix which takes the mean of the reflections within the radius of each bin centre,
+    # equivalent to predicting with a RadiusNeighborsRegressor fit on r
+    order = np.argsort(r, kind="stable")
+    r_sorted = r[order]
+    starts = np.searchsorted(r_sorted, sample_grid - radius, side="left")
+    stops = np.searchsorted(r_sorted, sample_grid + radius, side="right")
+    counts = stops - starts
+
+    indptr = np.concatenate([[0], np.cumsum(counts)])
+    indices = np.concatenate([order[start:stop] for start, stop in zip(starts, stops)])
+    data = np.repeat(1.0 / np.maximum(counts, 1), counts)
+
+    return sparse.csr_matrix((data, indices, indptr), shape=(sample_grid.size, r.size))
+
+
+def get_binned_means(membership: sparse.csr_matrix, values: np.ndarray) -> np.ndarray:
+    return membership @ values
+
+
+def get_scaled_binned_means(membership: sparse.csr_matrix,
+                            y: np.ndarray,
+                            r: np.ndarray,
+                            scales: np.ndarray,
+                            max_elements: int = SMOOTHING_MAX_ELEMENTS,
+                            ) -> np.ndarray:
+    # Evaluate the binned means of y * exp(scale * r) for every scale as one [scales, bins] product, in blocks of
+    # scales to bound the size of the intermediate
+    num_blocks = max(1, (scales.size * r.size) // max_elements)
+    y_f_blocks = []
+    for scales_block in np.array_split(scales, num_blocks):
+        y_scaled = y[np.newaxis, :] * np.exp(scales_block[:, np.newaxis] * r[np.newaxis, :])
+        y_f_blocks.append((membership @ y_scaled.T).T)
+
+    return np.concatenate(y_f_blocks, axis=0)
+
+
+def get_smoothing_scale(x_f: np.ndarray,
+                        y: np.ndarray,
+                        r: np.ndarray,
+                        membership: sparse.csr_matrix,
+                        scales: typing.Optional[np.ndarray] = None,
+                        refine: bool = False,
+                        tol: float = 1e-4,
+                        ) -> typing.Tuple[float, float]:
+    if scales is None:
+        scales = np.linspace(-SMOOTHING_MAX_SCALE, SMOOTHING_MAX_SCALE, SMOOTHING_NUM_SCALES)
+
+    # Empty bins have no mean to compare
+    occupied = (np.diff(membership.indptr) > 0) & (~np.isnan(x_f))
+    membership_occupied = membership[occupied]
+    x_f_occupied = x_f[occupied]
+
+    y_f = get_scaled_binned_means(membership_occupied, y, r, scales)
+    rmsds = np.sum(np.abs(x_f_occupied[np.newaxis, :] - y_f), axis=1)
+
+    min_index = int(np.argmin(rmsds))
+    min_scale, min_rmsd = float(scales[min_index]), float(rmsds[min_index])
+
+    if not refine:
+        return min_scale, min_rmsd
+
+    # Golden section search between the neighbours of the best grid point
+    def objective(scale):
+        return float(np.sum(np.abs(x_f_occupied - membership_occupied @ (y * np.exp(scale * r)))))
+
+    inverse_golden_ratio = (np.sqrt(5.0) - 1.0) / 2.0
+    lower = float(scales[max(min_index - 1, 0)])
+    upper = float(scales[min(min_index + 1, scales.size - 1)])
+    c = upper - inverse_golden_ratio * (upper - lower)
+    d = lower + inverse_golden_ratio * (upper - lower)
+    f_c, f_d = objective(c), objective(d)
+    while abs(upper - lower) > tol:
+        if f_c < f_d:
+            upper, d, f_d = d, c, f_c
+            c = upper - inverse_golden_ratio * (upper - lower)
+            f_c = objective(c)
+        else:
+            lower, c, f_c = c, d, f_d
+            d = lower + inverse_golden_ratio * (upper - lower)
+            f_d = objective(d)
+
+    refined_scale = (lower + upper) / 2.0
+    refined_rmsd = objective(refined_scale)
+    if refined_rmsd < min_rmsd:
+        return refined_scale, refined_rmsd
+
+    return min_scale, min_rmsd
+
+
+@dataclasses.dataclass()
+class ReferenceScalingProfile:
+    keys: np.ndarray
+    f: np.ndarray
+    r: np.ndarray
+
+    @staticmethod
+    def from_reference(reference, structure_factors) -> ReferenceScalingProfile:
+        # Only the observed reference amplitudes, their packed miller indices and 1/d^2 are needed to scale
+        # datasets, so this is all that is sent to workers instead of the reference structure and mtz
+        table = reference.dataset.reflections.table()
+        keys = table.observed_keys(structure_factors.f)
+        reference_table = table.select_keys(keys)
+
+        return ReferenceScalingProfile(
+            keys=keys,
+            f=reference_table.column(structure_factors.f).copy(),
+            r=reference_table.one_over_d2(),
+        )
+
+    def join(self, table, label: str) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        # Reference amplitudes, dataset amplitudes and 1/d^2 of the reflections observed in both
+        _, reference_rows, rows = np.intersect1d(
+            self.keys,
+            table.keys,
+            assume_unique=True,
+            return_indices=True,
+        )
+        y = table.column(label)[rows]
+        observed = ~np.isnan(y)
+
+        return self.f[reference_rows][observed], y[observed], self.r[reference_rows][observed]
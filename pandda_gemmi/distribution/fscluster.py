@@ -1,13 +1,18 @@
+import time
 from time import sleep
 from enum import Enum, auto
 from typing import *
 from pathlib import Path
 import subprocess
+import traceback
+import getpass
+import sys
 import re
-import pickle
 import secrets
 import os
 
+from pandda_gemmi import serialisation
+
 
 def shell(command: str):
     p = subprocess.Popen(
@@ -22,6 +27,30 @@ def shell(command: str):
     return stdout, stderr
 
 
+class QueueQueryError(Exception):
+    ...
+
+
+def query_queue(command: str):
+    # Only a non-zero exit means the query failed: schedulers also print warnings to stderr
+    p = subprocess.Popen(
+        command,
+        shell=True,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+    )
+
+    stdout, stderr = p.communicate()
+
+    if p.returncode != 0:
+        raise QueueQueryError(f"{command} exited with {p.returncode}: {stderr.decode()}")
+
+    if stderr:
+        print(f"\t{command} warned: {stderr.decode()}")
+
+    return stdout
+
+
 def chmod(path: Path):
     command = f"chmod 777 {path}"
     shell(command)
@@ -34,24 +63,79 @@ def write(script, file):
     chmod(file)
 
 
+def touch(file):
+    with open(file, "w") as f:
+        f.write("")
+
+
 class Run:
     def __init__(self,
                  f,
                  output_file,
-                 # target_file,
+                 done_file,
+                 failed_file,
                  ):
         self.f = f
         self.output_file = output_file
-        # self.target_file = target_file
+        self.done_file = done_file
+        self.failed_file = failed_file
 
     def __call__(self):
-        result = self.f()
+        try:
+            result = self.f()
+        except Exception as e:
+            with open(self.failed_file, "w") as f:
+                f.write(traceback.format_exc())
+            raise e
+
+        # Write the result under a temporary name so the sentinel is only ever seen next to a complete result
+        tmp_file = Path(f"{self.output_file}.tmp")
+        serialisation.dump(result, tmp_file)
+        os.replace(tmp_file, self.output_file)
+
+        touch(self.done_file)
+
+
+def write_inputs(output_dir: Path, key: str, funcs, debug=False):
+    # One pickled Run per task, indexed by its position in the submission so a single run script serves a
+    # whole job array
+    futures = []
+    for index, func in enumerate(funcs):
+        input_file = output_dir / f"{key}.{index}.in.pickle"
+        output_file = output_dir / f"{key}.{index}.out.pickle"
+        done_file = output_dir / f"{key}.{index}.done"
+        failed_file = output_dir / f"{key}.{index}.failed"
+        func_ob = Run(func, output_file, done_file, failed_file)
+        serialisation.dump(func_ob, input_file)
 
-        with open(self.output_file, "wb") as f:
-            pickle.dump(result, f)
+        if debug:
+            print(f"\tInput file is: {input_file}")
+            print(f"\tOutput file is: {output_file}")
 
-        # with open(self.target_file, "w") as f:
-        #     f.write("done")
+        futures.append(
+            FSFuture(
+                key=f"{key}.{index}",
+                run_script_file=output_dir / f"{key}.run.sh",
+                input_file=input_file,
+                target_file=output_file,
+                done_file=done_file,
+                failed_file=failed_file,
+            )
+        )
+
+    return futures
+
+
+def write_run_script(output_dir: Path, key: str, debug=False):
+    # Script to run on worker: the task index is passed as the first argument
+    run_script = f"#!/bin/bash\n{sys.executable} {Path(__file__).parent}/run.py {output_dir}/{key}.$1.in.pickle"
+    run_script_file = output_dir / f"{key}.run.sh"
+    write(run_script, run_script_file)
+    if debug:
+        print(f"\tRun script is: {run_script}")
+        print(f"\tRun script file is: {run_script_file}")
+
+    return run_script_file
 
 
 class SGE:
@@ -67,10 +151,11 @@ class SLURM:
         "#SBATCH --cpus-per-task={cpus}\n"
         "#SBATCH --mem-per-cpu={mem_per_cpu}G\n"
         "#SBATCH --output={output_file}\n"
-        "#SBATCH --error={error_file}}\n"
+        "#SBATCH --error={error_file}\n"
+        "#SBATCH --array=0-{last_index}\n"
         "#SBATCH --exclusive      \n"
 
-        "{executable_file}\n"
+        "{executable_file} ${{SLURM_ARRAY_TASK_ID}}\n"
     )
 
     def __init__(self,
@@ -84,41 +169,25 @@ class SLURM:
         self.distributed_mem_per_core = distributed_mem_per_core
         self.partition = partition
 
-    def submit(self, func, debug=True):
-        # Assign the key to the future
+    def submit(self, funcs, debug=True):
+        # Submit the funcs as one job array
         key = str(secrets.token_hex(16))
         if debug:
             print(f"\tKey is: {key}")
 
-        # Wrap func to pickle it's result
-        input_file = self.output_dir / f"{key}.in.pickle"
-        output_file = self.output_dir / f"{key}.out.pickle"
-        func_ob = Run(func, output_file)
-        with open(input_file, "wb") as f:
-            pickle.dump(func_ob, f)
-
-        if debug:
-            print(f"\tInput file is: {input_file}")
-            print(f"\tOutput file is: {output_file}")
-
-        # Script to run on worker: needs to be saved by this process/removed by future
-        run_script = f"#!/bin/bash\npython {Path(__file__).parent}/run.py {input_file}"
-        run_script_file = self.output_dir / f"{key}.run.sh"
-        write(run_script, run_script_file)
-        if debug:
-            print(f"\tRun script is: {run_script}")
-            print(f"\tRun script file is: {run_script_file}")
+        futures = write_inputs(self.output_dir, key, funcs, debug)
+        run_script_file = write_run_script(self.output_dir, key, debug)
 
         # describe job to scheduler: needs to be saved/removed by this process
         job_script = self.JOB_SCRIPT.format(
             executable_file=run_script_file,
-            log_file=self.output_dir / f"{key}.log",
-            output_file=self.output_dir / f"{key}.out",
-            error_file=self.output_dir / f"{key}.err",
-            request_cpus=self.distributed_cores_per_worker,
-            request_memory=self.distributed_mem_per_core * self.distributed_cores_per_worker,
+            output_file=self.output_dir / f"{key}.%a.out",
+            error_file=self.output_dir / f"{key}.%a.err",
+            cpus=self.distributed_cores_per_worker,
+            mem_per_cpu=self.distributed_mem_per_core,
             job_name=f"{key}",
             partition=self.partition,
+            last_index=len(futures) - 1,
         )
         job_script_file = self.output_dir / f"{key}.job"
         write(job_script, job_script_file)
@@ -128,35 +197,32 @@ class SLURM:
             print(f"\tJob script file file is: {job_script_file}")
 
         # code to submit job to sceduler
-        submit_script = f"condor_submit {job_script_file}"
+        submit_script = f"sbatch --parsable {job_script_file}"
 
         if debug:
             print(f"\tSubmit script is: {submit_script}")
 
         # run the submitscript locally
-        shell(submit_script)
-
-        # Construct the future
-        future = FSFuture(
-            key=key,
-            run_script_file=run_script_file,
-            input_file=input_file,
-            target_file=output_file,
-        )
+        stdout, stderr = shell(submit_script)
+        match = re.search(r"^(\d+)", stdout.decode())
+        if not match:
+            raise Exception(f"Could not submit job {key}: {stderr.decode()}")
+        job_id = match.group(1)
 
-        return future
+        for index, future in enumerate(futures):
+            future.job_id = job_id
+            future.error_file = self.output_dir / f"{key}.{index}.err"
 
-    def running(self, key, debug=False):
-        stdout, stderr = shell("squeue")
+        return futures
+
+    def queued(self, job_ids, debug=False):
+        # One query for all of this user's jobs: array tasks are reported under their array job id
+        stdout = query_queue(f"squeue --noheader --format=%F --user={getpass.getuser()}")
 
         if debug:
             print(str(stdout))
-            print(str(stderr))
 
-        if re.search(key, str(stdout)):
-            return True
-        else:
-            return False
+        return set(stdout.decode().split()) & set(job_ids)
 
 
 class HTCONDOR:
@@ -169,6 +235,7 @@ class HTCONDOR:
         "####################    \n"
 
         "Executable   = {executable_file} \n"
+        "Arguments    = $(Process) \n"
         "Log          = {log_file} \n"
         "Output = {output_file} \n"
         "Error = {error_file} \n"
@@ -178,7 +245,7 @@ class HTCONDOR:
 
         "GetEnv = True\n"
 
-        "Queue"
+        "Queue {num_tasks}"
     )
 
     def __init__(self,
@@ -190,39 +257,24 @@ class HTCONDOR:
         self.distributed_cores_per_worker = distributed_cores_per_worker
         self.distributed_mem_per_core = distributed_mem_per_core
 
-    def submit(self, func, debug=True):
-        # Assign the key to the future
+    def submit(self, funcs, debug=True):
+        # Submit the funcs as one cluster of processes
         key = str(secrets.token_hex(16))
         if debug:
             print(f"\tKey is: {key}")
 
-        # Wrap func to pickle it's result
-        input_file = self.output_dir / f"{key}.in.pickle"
-        output_file = self.output_dir / f"{key}.out.pickle"
-        func_ob = Run(func, output_file)
-        with open(input_file, "wb") as f:
-            pickle.dump(func_ob, f)
-
-        if debug:
-            print(f"\tInput file is: {input_file}")
-            print(f"\tOutput file is: {output_file}")
-
-        # Script to run on worker: needs to be saved by this process/removed by future
-        run_script = f"#!/bin/bash\npython {Path(__file__).parent}/run.py {input_file}"
-        run_script_file = self.output_dir / f"{key}.run.sh"
-        write(run_script, run_script_file)
-        if debug:
-            print(f"\tRun script is: {run_script}")
-            print(f"\tRun script file is: {run_script_file}")
+        futures = write_inputs(self.output_dir, key, funcs, debug)
+        run_script_file = write_run_script(self.output_dir, key, debug)
 
         # describe job to scheduler: needs to be saved/removed by this process
         job_script = self.JOB_SCRIPT.format(
             executable_file=run_script_file,
             log_file=self.output_dir / f"{key}.log",
-            output_file=self.output_dir / f"{key}.out",
-            error_file=self.output_dir / f"{key}.err",
+            output_file=self.output_dir / f"{key}.$(Process).out",
+            error_file=self.output_dir / f"{key}.$(Process).err",
             request_cpus=self.distributed_cores_per_worker,
             request_memory=self.distributed_mem_per_core * self.distributed_cores_per_worker,
+            num_tasks=len(futures),
         )
         job_script_file = self.output_dir / f"{key}.job"
         write(job_script, job_script_file)
@@ -238,29 +290,75 @@ class HTCONDOR:
             print(f"\tSubmit script is: {submit_script}")
 
         # run the submitscript locally
-        shell(submit_script)
-
-        # Construct the future
-        future = FSFuture(
-            key=key,
-            run_script_file=run_script_file,
-            input_file=input_file,
-            target_file=output_file,
-        )
+        stdout, stderr = shell(submit_script)
+        match = re.search(r"submitted to cluster (\d+)", stdout.decode())
+        if not match:
+            raise Exception(f"Could not submit job {key}: {stderr.decode()}")
+        job_id = match.group(1)
+
+        for index, future in enumerate(futures):
+            future.job_id = job_id
+            future.error_file = self.output_dir / f"{key}.{index}.err"
 
-        return future
+        return futures
 
-    def running(self, key, debug=False):
-        stdout, stderr = shell("condor_q --json")
+    def queued(self, job_ids, debug=False):
+        # One query for all the clusters
+        stdout = query_queue(f"condor_q {' '.join(sorted(set(job_ids)))} -af ClusterId")
 
         if debug:
             print(str(stdout))
-            print(str(stderr))
 
-        if re.search(key, str(stdout)):
-            return True
-        else:
-            return False
+        return set(stdout.decode().split()) & set(job_ids)
+
+
+class LOCAL:
+    # Stands in for a cluster scheduler by running tasks as subprocesses of this process, at most num_workers
+    # at a time, so the submission and polling logic can be run without a cluster
+
+    def __init__(self,
+                 output_dir,
+                 num_workers,
+                 ):
+        self.output_dir = output_dir
+        self.num_workers = num_workers
+        self.pending = []
+        self.processes = {}
+
+    def submit(self, funcs, debug=True):
+        key = str(secrets.token_hex(16))
+        if debug:
+            print(f"\tKey is: {key}")
+
+        futures = write_inputs(self.output_dir, key, funcs, debug)
+        run_script_file = write_run_script(self.output_dir, key, debug)
+
+        for index, future in enumerate(futures):
+            future.job_id = f"{key}.{index}"
+            future.error_file = self.output_dir / f"{key}.{index}.err"
+            self.pending.append((future.job_id, run_script_file, index, future.error_file))
+
+        self.start()
+
+        return futures
+
+    def start(self):
+        while self.pending and (sum(p.poll() is None for p in self.processes.values()) < self.num_workers):
+            job_id, run_script_file, index, error_file = self.pending.pop(0)
+            with open(error_file, "w") as f:
+                self.processes[job_id] = subprocess.Popen(
+                    [str(run_script_file), str(index)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=f,
+                )
+
+    def queued(self, job_ids, debug=False):
+        self.start()
+
+        queued = {job_id for job_id, _, _, _ in self.pending}
+        running = {job_id for job_id, p in self.processes.items() if p.poll() is None}
+
+        return (queued | running) & set(job_ids)
 
 
 class FutureStatus(Enum):
@@ -273,6 +371,7 @@ class Scheduler(Enum):
     SGE = SGE
     SLURM = SLURM
     HTCONDOR = HTCONDOR
+    LOCAL = LOCAL
 
 
 class FSFuture:
@@ -281,42 +380,73 @@ class FSFuture:
                  run_script_file: Path,
                  input_file: Path,
                  target_file: Path,
+                 done_file: Path,
+                 failed_file: Path,
+                 job_id: Optional[str] = None,
+                 error_file: Optional[Path] = None,
                  ):
         self.key = key
         self.run_script_file = run_script_file
         self.input_file = input_file
         self.target_file = target_file
-
-    def status(self, scheduler):
-        running = scheduler.running(self.key)
-        finished = self.target_file.exists()
-
-        if running and not finished:
-            return FutureStatus.RUNNING
-        elif finished and not running:
+        self.done_file = done_file
+        self.failed_file = failed_file
+        self.job_id = job_id
+        self.error_file = error_file
+        self.missing_since: Optional[float] = None
+
+    def finished(self) -> Optional[FutureStatus]:
+        # The sentinels written by the worker settle a task without asking the scheduler
+        if self.done_file.exists():
             return FutureStatus.DONE
-        elif not finished and not running:
+        elif self.failed_file.exists():
             return FutureStatus.FAILED
         else:
-            raise Exception(f"Unknown future status for job")
+            return None
+
+    def status(self, queued_job_ids: Set[str], grace_period: float = 0.0):
+        finished = self.finished()
+        if finished:
+            return finished
+
+        if self.job_id in queued_job_ids:
+            self.missing_since = None
+            return FutureStatus.RUNNING
+
+        # The job may have written its sentinel after it was last checked
+        finished = self.finished()
+        if finished:
+            return finished
+
+        # On a shared file system the sentinel of a job that has left the queue can appear late, so keep checking
+        # for it for a while before calling the job failed
+        if self.missing_since is None:
+            self.missing_since = time.time()
+        if time.time() - self.missing_since < grace_period:
+            return FutureStatus.RUNNING
+
+        return FutureStatus.FAILED
+
+    def missing(self) -> bool:
+        return self.missing_since is not None
 
     def result(self):
-        with open(self.target_file, "rb") as f:
-            result = pickle.load(f)
+        result = serialisation.load(self.target_file)
 
         self.clean()
 
         return result
 
     def clean(self):
-        os.remove(self.input_file)
-        os.remove(self.target_file)
+        for file in (self.input_file, self.target_file, self.done_file):
+            if file.exists():
+                os.remove(file)
 
 
 class FSCluster:
 
     def __init__(self,
-                 scheduler: Literal["SGE", "HTCONDOR", "SLURM"],
+                 scheduler: Literal["SGE", "HTCONDOR", "SLURM", "LOCAL"],
                  num_workers=10,
                  queue=None,
                  project=None,
@@ -328,7 +458,19 @@ class FSCluster:
                  watcher=True,
                  output_dir=Path("/data/share-2/conor/pandda/tmp"),
                  slurm_partition=None,
+                 array=False,
+                 poll_interval=1.0,
+                 max_poll_interval=60.0,
+                 poll_backoff=1.5,
+                 sentinel_grace_period=30.0,
+                 max_queue_query_failures=10,
                  ):
+        self.array = array
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.poll_backoff = poll_backoff
+        self.sentinel_grace_period = sentinel_grace_period
+        self.max_queue_query_failures = max_queue_query_failures
 
         if scheduler == "SGE":
             self.scheduler = SGE(
@@ -350,32 +492,75 @@ class FSCluster:
                 partition=slurm_partition,
             )
 
+        elif scheduler == "LOCAL":
+            self.scheduler = LOCAL(
+                output_dir=output_dir,
+                num_workers=num_workers,
+            )
+
         else:
             raise Exception(f"Scheduler: {scheduler} is not recognised!")
 
     def __call__(self, funcs):
-        futures = [self.submit(f) for f in funcs]
-
-        print([f.status(self.scheduler) for f in futures])
-
-        while any(f.status(self.scheduler) == FutureStatus.RUNNING for f in futures):
-            running = [f for f in futures if f.status(self.scheduler) == FutureStatus.RUNNING]
-            failed = [f for f in futures if f.status(self.scheduler) == FutureStatus.FAILED]
-            complete = [f for f in futures if f.status(self.scheduler) == FutureStatus.DONE]
-
-            print(f"\t{len(running)} out of {len(futures)} running. {len(failed)} failed. {len(complete)} completee")
-            sleep(1)
+        funcs = list(funcs)
+        if self.array:
+            futures = self.scheduler.submit(funcs)
+        else:
+            futures = [self.submit(f) for f in funcs]
+
+        statuses = {future.key: FutureStatus.RUNNING for future in futures}
+        interval = self.poll_interval
+        num_query_failures = 0
+        while True:
+            # Settle what the sentinels can, then ask the scheduler about the rest in a single query
+            running = [f for f in futures if statuses[f.key] == FutureStatus.RUNNING]
+            unsettled = [f for f in running if not f.finished()]
+            try:
+                queued_job_ids = self.scheduler.queued({f.job_id for f in unsettled}) if unsettled else set()
+                num_query_failures = 0
+            except QueueQueryError as e:
+                # A failed query says nothing about the jobs, so leave the unsettled ones running and try again at
+                # the next poll, unless the scheduler keeps failing
+                num_query_failures += 1
+                if num_query_failures >= self.max_queue_query_failures:
+                    raise
+                print(f"\tCould not query the queue ({num_query_failures} failures in a row), retrying: {e}")
+                queued_job_ids = {f.job_id for f in unsettled}
+
+            for future in running:
+                statuses[future.key] = future.status(queued_job_ids, self.sentinel_grace_period)
+
+            num_running = sum(status == FutureStatus.RUNNING for status in statuses.values())
+            num_failed = sum(status == FutureStatus.FAILED for status in statuses.values())
+            num_complete = sum(status == FutureStatus.DONE for status in statuses.values())
+
+            if num_running == 0:
+                break
+
+            # Back off while nothing changes, and poll quickly again once jobs start finishing or leave the queue
+            # without a sentinel
+            if (num_running < len(running)) or any(f.missing() for f in running):
+                interval = self.poll_interval
+            else:
+                interval = min(interval * self.poll_backoff, self.max_poll_interval)
+
+            print(f"\t{num_running} out of {len(futures)} running. {num_failed} failed. {num_complete} completee")
+            sleep(interval)
 
-        statuses = [f.status(self.scheduler) for f in futures]
         print("###########################")
-        print(f"Statuses are: {statuses}")
+        print(f"Statuses are: {[statuses[f.key] for f in futures]}")
         print("###########################")
 
+        failed = [f for f in futures if statuses[f.key] == FutureStatus.FAILED]
+        if failed:
+            raise Exception(
+                f"{len(failed)} out of {len(futures)} jobs failed. Errors are in: "
+                f"{[str(f.failed_file if f.failed_file.exists() else f.error_file) for f in failed]}"
+            )
+
         results = [f.result() for f in futures]
-        for result in results:
-            print(result)
 
         return results
 
     def submit(self, f) -> FSFuture:
-        return self.scheduler.submit(f)
+        return self.scheduler.submit([f])[0]
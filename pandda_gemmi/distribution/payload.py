@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import os
+import dataclasses
+import hashlib
+import secrets
+from pathlib import Path
+from typing import Any, Callable, Dict
+
+from pandda_gemmi import serialisation
+from pandda_gemmi.constants import PANDDA_DISTRIBUTED_ARTEFACT_DIR
+from pandda_gemmi.common import Dtag
+from pandda_gemmi.fs import PanDDAFSModel
+
+# Artefacts shared between the tasks run by this process, keyed by content hash
+ARTEFACT_CACHE: Dict[str, Any] = {}
+
+
+@dataclasses.dataclass()
+class SharedArtefact:
+    path: Path
+    key: str
+
+    @staticmethod
+    def from_object(obj, artefact_dir: Path) -> SharedArtefact:
+        data, buffers = serialisation.serialise(obj)
+        digest = hashlib.sha1(data)
+        for buffer in buffers:
+            digest.update(buffer.raw())
+        key = digest.hexdigest()
+        path = artefact_dir / f"{key}.pickle"
+
+        # Content addressed, so an existing file already holds the same object
+        if not path.exists():
+            tmp_path = artefact_dir / f"{key}.{os.getpid()}.tmp"
+            serialisation.write(tmp_path, data, buffers)
+            os.replace(tmp_path, path)
+
+        return SharedArtefact(path, key)
+
+    def load(self, cache: bool = True):
+        if self.key in ARTEFACT_CACHE:
+            return ARTEFACT_CACHE[self.key]
+
+        obj = serialisation.load(self.path)
+
+        if cache:
+            ARTEFACT_CACHE[self.key] = obj
+
+        return obj
+
+
+@dataclasses.dataclass()
+class LazyShellTask:
+    func: Callable
+    shell: Any
+    datasets: Dict[Dtag, SharedArtefact]
+    alignments: SharedArtefact
+    grid: SharedArtefact
+    pandda_fs_model: PanDDAFSModel
+    reference: SharedArtefact
+
+    def __call__(self):
+        # Only this shell's datasets are materialised, and they are released with it
+        datasets = {dtag: artefact.load(cache=False) for dtag, artefact in self.datasets.items()}
+
+        return self.func(
+            self.shell,
+            datasets,
+            self.alignments.load(),
+            self.grid.load(),
+            self.pandda_fs_model,
+            self.reference.load(),
+        )
+
+
+@dataclasses.dataclass()
+class SharedArtefacts:
+    path: Path
+    datasets: Dict[Dtag, SharedArtefact]
+    alignments: SharedArtefact
+    grid: SharedArtefact
+    reference: SharedArtefact
+
+    @staticmethod
+    def from_objects(tmp_dir: Path, datasets, alignments, grid, reference) -> SharedArtefacts:
+        path = tmp_dir / PANDDA_DISTRIBUTED_ARTEFACT_DIR.format(key=secrets.token_hex(8))
+        path.mkdir(parents=True, exist_ok=True)
+
+        return SharedArtefacts(
+            path,
+            {dtag: SharedArtefact.from_object(dataset, path) for dtag, dataset in datasets.items()},
+            SharedArtefact.from_object(alignments, path),
+            SharedArtefact.from_object(grid, path),
+            SharedArtefact.from_object(reference, path),
+        )
+
+    def shell_task(self, func: Callable, shell, pandda_fs_model: PanDDAFSModel) -> LazyShellTask:
+        return LazyShellTask(
+            func,
+            shell,
+            {dtag: self.datasets[dtag] for dtag in shell.all_dtags},
+            self.alignments,
+            self.grid,
+            pandda_fs_model,
+            self.reference,
+        )
+
+    def clean(self):
+        for artefact_path in self.path.glob("*.pickle"):
+            os.remove(artefact_path)
+        try:
+            os.rmdir(self.path)
+        except Exception as e:
+            print(e)
@@ -1,11 +1,10 @@
-import pickle
-
 import fire
 
+from pandda_gemmi import serialisation
+
 
 def main(path: str):
-    with open(path, "rb") as f:
-        func = pickle.load(f)
+    func = serialisation.load(path)
 
     func()
 
@@ -1,4 +1,7 @@
-from pandda_gemmi.edalignment.alignments import Alignments, Alignment, Transform
-from pandda_gemmi.edalignment.grid import Grid, Partitioning
-from pandda_gemmi.edalignment.edmaps import Xmap, Xmaps, XmapArray, from_unaligned_dataset_c, \
+from pandda_gemmi.edalignment.alignments import Alignments, Alignment, AlignmentResult, Transform, \
+    get_alignment_results
+from pandda_gemmi.edalignment.alignment_cache import AlignmentCache
+from pandda_gemmi.edalignment.grid import Grid, Partitioning, PartitioningArrays
+from pandda_gemmi.edalignment.partitioning_cache import PartitioningCache
+from pandda_gemmi.edalignment.edmaps import Xmap, Xmaps, NativeSamplingPlan, XmapArray, from_unaligned_dataset_c, \
     from_unaligned_dataset_c_flat, from_unaligned_dataset_c_ray, from_unaligned_dataset_c_flat_ray
\ No newline at end of file
@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import os
+import hashlib
+import dataclasses
+from pathlib import Path
+
+from pandda_gemmi.constants import *
+from pandda_gemmi.python_types import *
+from pandda_gemmi.dataset import Dataset, Reference
+from pandda_gemmi.edalignment.alignments import AlignmentResult
+
+
+@dataclasses.dataclass()
+class AlignmentCache:
+    path: Path
+
+    @staticmethod
+    def from_dir(pandda_dir: Path) -> AlignmentCache:
+        path = pandda_dir / PANDDA_ALIGNMENT_CACHE_DIR
+        path.mkdir(parents=True, exist_ok=True)
+        return AlignmentCache(path)
+
+    @staticmethod
+    def get_key(reference: Reference, dataset: Dataset, marker_atom_search_radius: float) -> str:
+        # A local alignment depends only on the residue ids and CA positions of the two models
+        key = hashlib.sha1()
+        for structure in (reference.dataset.structure, dataset.structure):
+            structure_arrays = structure.arrays()
+            key.update(repr([(residue_id.model, residue_id.chain, residue_id.insertion)
+                             for residue_id in structure_arrays.residue_ids]).encode())
+            key.update(np.ascontiguousarray(structure_arrays.ca_positions).tobytes())
+        key.update(repr(float(marker_atom_search_radius)).encode())
+        return key.hexdigest()
+
+    def get(self,
+            reference: Reference,
+            dataset: Dataset,
+            marker_atom_search_radius=10.0,
+            log_residues=False,
+            ) -> AlignmentResult:
+        path = self.path / f"{AlignmentCache.get_key(reference, dataset, marker_atom_search_radius)}.npz"
+        if path.exists():
+            try:
+                return AlignmentResult.load(path)
+            except Exception as e:
+                print(f"WARNING: Could not read cached alignment {path}: {e}")
+
+        alignment_result = AlignmentResult.from_dataset(
+            reference,
+            dataset,
+            marker_atom_search_radius=marker_atom_search_radius,
+            log_residues=log_residues,
+        )
+
+        # Datasets are aligned concurrently, so only complete files are moved into place
+        temporary_path = self.path / f"{path.stem}.{os.getpid()}.tmp.npz"
+        alignment_result.save(temporary_path)
+        os.replace(temporary_path, path)
+
+        return alignment_result
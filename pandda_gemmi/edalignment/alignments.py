@@ -1,5 +1,8 @@
+from __future__ import annotations
+
 import typing
 import dataclasses
+from pathlib import Path
 
 import scipy
 from scipy import spatial
@@ -9,7 +12,7 @@ set_loky_pickler('pickle')
 
 from pandda_gemmi.python_types import *
 from pandda_gemmi.pandda_exceptions import *
-from pandda_gemmi.common import Dtag
+from pandda_gemmi.common import Dtag, Partial
 from pandda_gemmi.dataset import Dataset, ResidueID, Reference, Datasets
 
 from scipy.spatial.transform import Rotation as R
@@ -53,9 +56,13 @@ class Transform:
 
     @staticmethod
     def from_translation_rotation(translation, rotation, com_reference, com_moving):
+        return Transform.from_translation_matrix(translation, rotation.as_matrix(), com_reference, com_moving)
+
+    @staticmethod
+    def from_translation_matrix(translation, rotation_matrix, com_reference, com_moving):
         transform = gemmi.Transform()
         transform.vec.fromlist(translation.tolist())
-        transform.mat.fromlist(rotation.as_matrix().tolist())
+        transform.mat.fromlist(rotation_matrix.tolist())
 
         return Transform(transform, com_reference, com_moving)
 
@@ -209,6 +216,41 @@ class Transform:
         self.com_moving = data[2]
 
 
+def get_local_rotations(dataset_atom_array: np.ndarray,
+                        reference_atom_array: np.ndarray,
+                        neighbourhoods,
+                        counts: np.ndarray,
+                        ):
+    # Kabsch superposition of every neighbourhood at once on [residues, atoms, 3] arrays, with padding atoms masked
+    # out. Gives the same rotations and root sum square deviations as Rotation.align_vectors per neighbourhood.
+    num_residues, max_count = len(neighbourhoods), int(np.max(counts))
+    indexes = np.zeros((num_residues, max_count), dtype=int)
+    mask = np.arange(max_count)[np.newaxis, :] < counts[:, np.newaxis]
+    indexes[mask] = np.concatenate([np.array(neighbourhood, dtype=int) for neighbourhood in neighbourhoods])
+    weights = mask[:, :, np.newaxis].astype(float)
+
+    dataset_selection = dataset_atom_array[indexes] * weights
+    reference_selection = reference_atom_array[indexes] * weights
+    com_dataset = np.sum(dataset_selection, axis=1) / counts[:, np.newaxis]
+    com_reference = np.sum(reference_selection, axis=1) / counts[:, np.newaxis]
+
+    de_meaned = (dataset_selection - com_dataset[:, np.newaxis, :]) * weights
+    de_meaned_ref = (reference_selection - com_reference[:, np.newaxis, :]) * weights
+
+    # Rotations taking the reference neighbourhoods onto the dataset neighbourhoods, without reflections
+    covariance = np.einsum("rki,rkj->rij", de_meaned_ref, de_meaned)
+    u, _, vt = np.linalg.svd(covariance)
+    signs = np.sign(np.linalg.det(np.matmul(u, vt)))
+    signs[signs == 0] = 1.0
+    vt[:, 2, :] = vt[:, 2, :] * signs[:, np.newaxis]
+    rotations = np.matmul(np.transpose(vt, (0, 2, 1)), np.transpose(u, (0, 2, 1)))
+
+    residuals = de_meaned - np.einsum("rij,rkj->rki", rotations, de_meaned_ref)
+    rmsds = np.sqrt(np.sum(np.square(residuals) * weights, axis=(1, 2)))
+
+    return rotations, com_dataset, com_reference, rmsds
+
+
 @dataclasses.dataclass()
 class Alignment:
     transforms: typing.Dict[ResidueID, Transform]
@@ -234,119 +276,70 @@ class Alignment:
 
     @staticmethod
     def has_large_gap(reference: Reference, dataset: Dataset):
-        try:
-            Alignment.from_dataset(reference, dataset)
-
-        except ExceptionUnmatchedAlignmentMarker as e:
-            return False
-
-        except ExceptionNoCommonAtoms as e:
-            return False
-
-        return True
+        return AlignmentResult.from_dataset(reference, dataset).alignment is not None
 
     @staticmethod
-    def from_dataset(reference: Reference, dataset: Dataset, marker_atom_search_radius=10.0):
+    def from_dataset(reference: Reference,
+                     dataset: Dataset,
+                     marker_atom_search_radius=10.0,
+                     log_residues=False,
+                     ):
         # CV: 10A search radius? That seems excessive ...
 
-        print('\n\treference, dataset = ', reference.dtag.dtag, dataset.structure.path)
-        dataset_pos_list = []
-        reference_pos_list = []
-
-        # Iterate protein atoms, then pull out their atoms, and search them
-        for res_id in reference.dataset.structure.protein_residue_ids():
+        if log_residues:
+            print('\n\treference, dataset = ', reference.dtag.dtag, dataset.structure.path)
 
-            # Get the matchable CAs
-            try:
-                # Get reference residue
-                ref_res_span = reference.dataset.structure[res_id]
-                ref_res = ref_res_span[0]
+        reference_arrays = reference.dataset.structure.arrays()
+        dataset_arrays = dataset.structure.arrays()
+        residue_ids = reference_arrays.residue_ids
 
-                # Get corresponding reses
-                dataset_res_span = dataset.structure[res_id]
-                dataset_res      = dataset_res_span[0]
+        # Get the matchable CAs
+        reference_atom_array, dataset_atom_array = reference_arrays.common_ca_positions(dataset_arrays)
 
-                # Get the CAs
-                atom_ref     = ref_res["CA"][0]
-                atom_dataset = dataset_res["CA"][0]
-
-                # Get the shared atoms
-                reference_pos_list.append([atom_ref.pos.x, atom_ref.pos.y, atom_ref.pos.z, ])
-                dataset_pos_list.append([atom_dataset.pos.x, atom_dataset.pos.y, atom_dataset.pos.z, ])
-
-            except Exception as e:
-                print(f"WARNING: An exception occured in matching residues for alignment at residue id: {res_id}: {e}")
-                continue
-
-        dataset_atom_array   = np.array(dataset_pos_list)
-        reference_atom_array = np.array(reference_pos_list)
+        if log_residues:
+            for res_id in residue_ids:
+                if res_id not in dataset_arrays.residue_index:
+                    print(f"WARNING: No CA to match for alignment at residue id: {res_id}")
 
         if (reference_atom_array.shape[0] == 0) or (dataset_atom_array.shape[0] == 0):
             raise ExceptionNoCommonAtoms()
 
-        # dataset kdtree
-        dataset_tree = spatial.KDTree(dataset_atom_array)
-        # Other kdtree
-        reference_tree = spatial.KDTree(reference_atom_array)
-
         if reference_atom_array.size != dataset_atom_array.size:
             raise AlignmentUnmatchedAtomsError(reference_atom_array,
                                                dataset_atom_array,
                                                )
 
-        transforms = {}
-        rmsds = {}
-
-        # Start searching
-        for res_id in reference.dataset.structure.protein_residue_ids():
-            # Get reference residue
-            ref_res_span = reference.dataset.structure[res_id]
-            ref_res = ref_res_span[0]
-
-            # Get ca pos in reference model
-            reference_ca_pos = ref_res["CA"][0].pos
-
-            # # Get residue span in other dataset
-            # dataset_res_span = dataset.structure[res_id]
-            # dataset_res = dataset_res_span[0]
-
-            # # Get ca position in moving dataset model
-            # dataset_ca_pos = dataset_res["CA"][0].pos
-
-            # dataset selection
-            # dataset_indexes = dataset_tree.query_ball_point([dataset_ca_pos.x, dataset_ca_pos.y, dataset_ca_pos.z],
-            #                                                 7.0,
-            #                      ExceptionNoCommonAtoms                           )
-            # dataset_selection = dataset_atom_array[dataset_indexes]
-
-            # other selection
-            reference_indexes = reference_tree.query_ball_point(
-                [reference_ca_pos.x, reference_ca_pos.y, reference_ca_pos.z],
-                marker_atom_search_radius,
-            )
-            reference_selection = reference_atom_array[reference_indexes]
-            dataset_selection   =   dataset_atom_array[reference_indexes]
-
-            if dataset_selection.shape[0] == 0:
-                raise ExceptionUnmatchedAlignmentMarker(res_id)
+        # Matched CAs in the neighbourhood of every reference CA, padded to the largest neighbourhood
+        reference_tree = spatial.cKDTree(reference_atom_array)
+        neighbourhoods = reference_tree.query_ball_point(reference_arrays.ca_positions, marker_atom_search_radius)
+        counts = np.array([len(neighbourhood) for neighbourhood in neighbourhoods])
+        if np.any(counts == 0):
+            raise ExceptionUnmatchedAlignmentMarker(residue_ids[int(np.argmin(counts))])
 
-            rmsds[res_id], transforms[res_id] = Transform.from_atoms(
-                dataset_selection,
-                reference_selection,
-                # com_dataset=[dataset_ca_pos.x, dataset_ca_pos.y, dataset_ca_pos.z],
-                # com_reference=[reference_ca_pos.x, reference_ca_pos.y, reference_ca_pos.z],
-                com_dataset=np.mean(dataset_selection, axis=0),
-                com_reference=np.mean(reference_selection, axis=0),
+        rotations, com_dataset, com_reference, rmsds = get_local_rotations(
+            dataset_atom_array,
+            reference_atom_array,
+            neighbourhoods,
+            counts,
+        )
 
+        transforms = {}
+        translation = np.array([0.0, 0.0, 0.0])
+        for j, res_id in enumerate(residue_ids):
+            transforms[res_id] = Transform.from_translation_matrix(
+                translation,
+                rotations[j],
+                com_reference[j],
+                com_dataset[j],
             )
-            t = transforms[res_id]
-            rot = R.from_matrix(t.transform.mat)
-            rotvec = rot.as_rotvec(degrees=True)
-            rotang = np.linalg.norm(rotvec)
-            rotvec = rotvec / rotang
-            tra = t.transform.vec.tolist()
-            cen = t.com_moving - t.com_reference
-            print('\t\trmsd for residue %s|%s = %.4f with rotation axis = (%.5f,%.5f,%.5f) with angle %.5f and translation=(%.5f,%.5f,%.5f) and centre-shift=(%.5f,%.5f,%.5f)' % (res_id.chain,res_id.insertion,rmsds[res_id],rotvec[0],rotvec[1],rotvec[2],rotang,tra[0],tra[1],tra[2],cen[0],cen[1],cen[2]))
+
+        if log_residues:
+            rotvecs = R.from_matrix(rotations).as_rotvec(degrees=True)
+            for j, res_id in enumerate(residue_ids):
+                rotang = np.linalg.norm(rotvecs[j])
+                rotvec = rotvecs[j] / rotang
+                cen = com_dataset[j] - com_reference[j]
+                print('\t\trmsd for residue %s|%s = %.4f with rotation axis = (%.5f,%.5f,%.5f) with angle %.5f and translation=(%.5f,%.5f,%.5f) and centre-shift=(%.5f,%.5f,%.5f)' % (res_id.chain,res_id.insertion,rmsds[j],rotvec[0],rotvec[1],rotvec[2],rotang,translation[0],translation[1],translation[2],cen[0],cen[1],cen[2]))
 
         return Alignment(transforms)
 
@@ -421,15 +414,127 @@ class Alignment:
     #     self.transforms = alignment_gemmi
 
 
+@dataclasses.dataclass()
+class AlignmentResult:
+    alignment: typing.Optional[Alignment]
+    failure: typing.Optional[str]
+
+    @staticmethod
+    def from_dataset(reference: Reference,
+                     dataset: Dataset,
+                     marker_atom_search_radius=10.0,
+                     log_residues=False,
+                     ) -> AlignmentResult:
+        # Datasets whose models have gaps around a reference residue cannot be aligned: record why rather than
+        # raising, so the gap filter and the alignments come from the same computation
+        try:
+            alignment = Alignment.from_dataset(
+                reference,
+                dataset,
+                marker_atom_search_radius=marker_atom_search_radius,
+                log_residues=log_residues,
+            )
+
+        except (ExceptionUnmatchedAlignmentMarker, ExceptionNoCommonAtoms) as e:
+            return AlignmentResult(None, str(e))
+
+        return AlignmentResult(alignment, None)
+
+    def save(self, path: Path):
+        if self.alignment is None:
+            np.savez(path, failure=np.array(self.failure, dtype=str))
+            return
+
+        residue_ids = list(self.alignment.transforms.keys())
+        transforms = [self.alignment.transforms[residue_id] for residue_id in residue_ids]
+        np.savez(
+            path,
+            models=np.array([residue_id.model for residue_id in residue_ids], dtype=str),
+            chains=np.array([residue_id.chain for residue_id in residue_ids], dtype=str),
+            insertions=np.array([residue_id.insertion for residue_id in residue_ids], dtype=str),
+            translations=np.array([transform.transform.vec.tolist() for transform in transforms]).reshape(-1, 3),
+            rotations=np.array([transform.transform.mat.tolist() for transform in transforms]).reshape(-1, 3, 3),
+            com_reference=np.array([transform.com_reference for transform in transforms]).reshape(-1, 3),
+            com_moving=np.array([transform.com_moving for transform in transforms]).reshape(-1, 3),
+        )
+
+    @staticmethod
+    def load(path: Path) -> AlignmentResult:
+        with np.load(path) as f:
+            if "failure" in f:
+                return AlignmentResult(None, str(f["failure"]))
+
+            transforms = {}
+            for model, chain, insertion, translation, rotation, com_reference, com_moving in zip(
+                    f["models"], f["chains"], f["insertions"], f["translations"], f["rotations"],
+                    f["com_reference"], f["com_moving"],
+            ):
+                transforms[ResidueID(str(model), str(chain), str(insertion))] = Transform.from_translation_matrix(
+                    translation,
+                    rotation,
+                    com_reference,
+                    com_moving,
+                )
+
+            return AlignmentResult(Alignment(transforms), None)
+
+
+def get_alignment_results(reference: Reference,
+                          datasets: Datasets,
+                          process_local=None,
+                          log_residues=False,
+                          alignment_cache=None,
+                          ) -> typing.Dict[Dtag, AlignmentResult]:
+    dtags = list(datasets)
+
+    if alignment_cache:
+        align = alignment_cache.get
+    else:
+        align = AlignmentResult.from_dataset
+
+    if process_local:
+        results = process_local(
+            [
+                Partial(
+                    align,
+                    reference,
+                    datasets[dtag],
+                    log_residues=log_residues,
+                )
+                for dtag
+                in dtags
+            ]
+        )
+
+    else:
+        results = [align(reference, datasets[dtag], log_residues=log_residues) for dtag in dtags]
+
+    return {dtag: result for dtag, result in zip(dtags, results)}
+
+
 @dataclasses.dataclass()
 class Alignments:
     alignments: typing.Dict[Dtag, Alignment]
 
     @staticmethod
-    def from_datasets(reference: Reference, datasets: Datasets):
+    def from_datasets(reference: Reference, datasets: Datasets, process_local=None, log_residues=False):
+        alignment_results = get_alignment_results(
+            reference,
+            datasets,
+            process_local=process_local,
+            log_residues=log_residues,
+        )
+
+        return Alignments.from_alignment_results(alignment_results, datasets)
+
+    @staticmethod
+    def from_alignment_results(alignment_results: typing.Dict[Dtag, AlignmentResult], datasets):
         alignments = {}
         for dtag in datasets:
-            alignments[dtag] = Alignment.from_dataset(reference, datasets[dtag])
+            alignment_result = alignment_results[dtag]
+            if alignment_result.alignment is None:
+                raise Exception(f"Dataset {dtag.dtag} could not be aligned: {alignment_result.failure}")
+            alignments[dtag] = alignment_result.alignment
 
         return Alignments(alignments)
 
@@ -14,7 +14,7 @@ from pandda_gemmi.python_types import *
 from pandda_gemmi.common import Dtag, delayed
 from pandda_gemmi.dataset import StructureFactors, Reflections, Dataset, Datasets
 from pandda_gemmi.edalignment.alignments import Alignment, Alignments, Transform
-from pandda_gemmi.edalignment.grid import Grid, Partitioning
+from pandda_gemmi.edalignment.grid import Grid, Partitioning, PartitioningArrays
 
 
 @dataclasses.dataclass()
@@ -410,11 +410,124 @@ class Xmap:
 
         return Xmap(new_grid)
 
-    def __getstate__(self):
-        return XmapPython.from_gemmi(self.xmap)
+    def __reduce__(self):
+        return Xmap, (self.xmap,)
 
-    def __setstate__(self, xmap_python: XmapPython):
-        self.xmap = xmap_python.to_gemmi()
+
+@dataclasses.dataclass()
+class NativeSamplingPlan:
+    native_shape: Tuple[int, int, int]
+    native_unit_cell: UnitCellPython
+    point_array: np.ndarray
+    fractional_array: np.ndarray
+
+    @staticmethod
+    def from_partitioning(
+            native_grid: gemmi.FloatGrid,
+            alignment: Alignment,
+            grid: Grid,
+            partitioning: Partitioning,
+    ):
+        return NativeSamplingPlan.from_partitioning_arrays(
+            native_grid,
+            alignment,
+            grid,
+            PartitioningArrays.from_partitioning(partitioning),
+        )
+
+    @staticmethod
+    def from_partitioning_arrays(
+            native_grid: gemmi.FloatGrid,
+            alignment: Alignment,
+            grid: Grid,
+            partitioning_arrays: PartitioningArrays,
+    ):
+        native_shape = (native_grid.nu, native_grid.nv, native_grid.nw)
+        orthogonalization_matrix = np.array(native_grid.unit_cell.orthogonalization_matrix.tolist())
+        fractionalization_matrix = np.array(grid.grid.unit_cell.fractionalization_matrix.tolist())
+
+        # Map each native point into the fractional coordinates of the reference frame
+        residue_points = partitioning_arrays.residue_points()
+        point_arrays = []
+        fractional_arrays = []
+        for residue_id in grid.partitioning.partitioning:
+
+            if residue_id not in residue_points:
+                continue
+
+            point_array = residue_points[residue_id]
+            if point_array.shape[0] == 0:
+                continue
+
+            al = alignment[residue_id]
+            rotation = np.array(al.transform.mat.tolist())
+            translation = np.array(al.transform.vec.tolist())
+
+            native_positions = (point_array / np.array(native_shape)) @ orthogonalization_matrix.T
+            reference_positions = ((native_positions - al.com_moving) @ rotation.T) + translation + al.com_reference
+
+            point_arrays.append(point_array)
+            fractional_arrays.append(reference_positions @ fractionalization_matrix.T)
+
+        if len(point_arrays) == 0:
+            point_array = np.zeros((0, 3), dtype=np.int32)
+            fractional_array = np.zeros((0, 3), dtype=np.float64)
+        else:
+            point_array = np.vstack(point_arrays)
+            fractional_array = np.vstack(fractional_arrays)
+
+        return NativeSamplingPlan(
+            native_shape,
+            UnitCellPython.from_gemmi(native_grid.unit_cell),
+            point_array,
+            fractional_array,
+        )
+
+    def get_fractional_box(self, positions: List[Tuple[float, float, float]], margin: float):
+        native_unit_cell = self.native_unit_cell.to_gemmi()
+        fractionalization_matrix = np.array(native_unit_cell.fractionalization_matrix.tolist())
+
+        # A sphere of radius margin spans margin times the row norm along each fractional axis
+        fractional_positions = np.array(positions).reshape(-1, 3) @ fractionalization_matrix.T
+        fractional_margin = margin * np.linalg.norm(fractionalization_matrix, axis=1)
+
+        return (np.min(fractional_positions, axis=0) - fractional_margin,
+                np.max(fractional_positions, axis=0) + fractional_margin,
+                )
+
+    def crop(self, fractional_boxes: List[Tuple[np.ndarray, np.ndarray]]):
+        point_fractional_array = self.point_array / np.array(self.native_shape)
+
+        # Points may fall in a box through any lattice translation
+        in_boxes = np.zeros(self.point_array.shape[0], dtype=bool)
+        for box_minimum, box_maximum in fractional_boxes:
+            in_boxes = in_boxes | np.all(
+                np.mod(point_fractional_array - box_minimum, 1.0) <= (box_maximum - box_minimum),
+                axis=1,
+            )
+
+        return NativeSamplingPlan(
+            self.native_shape,
+            self.native_unit_cell,
+            self.point_array[in_boxes],
+            self.fractional_array[in_boxes],
+        )
+
+    def new_native_grid(self):
+        new_grid = gemmi.FloatGrid(*self.native_shape)
+        new_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")
+        new_grid.set_unit_cell(self.native_unit_cell.to_gemmi())
+        return new_grid
+
+    def interpolate(self, reference_grids: List[gemmi.FloatGrid]) -> List[Xmap]:
+        interpolated_grids = gemmi.interpolate_points_multiple(
+            reference_grids,
+            [self.new_native_grid() for _reference_grid in reference_grids],
+            self.point_array,
+            self.fractional_array,
+        )
+
+        return [Xmap(interpolated_grid) for interpolated_grid in interpolated_grids]
 
 
 @dataclasses.dataclass()
@@ -14,6 +14,7 @@ set_loky_pickler('pickle')
 from pandda_gemmi.constants import *
 from pandda_gemmi.python_types import *
 from pandda_gemmi.dataset import ResidueID, Reference, Structure, Symops
+from pandda_gemmi.edalignment.mask import rasterise_atoms, get_symmetry_positions, get_mask_grid
 
 
 @dataclasses.dataclass()
@@ -131,16 +132,13 @@ class Partitioning:
         protein_grid.set_unit_cell(protein_grid_unit_cell)
 
         # Mask
-        for atom in structure.all_atoms():
-            pos = atom.pos
-            pos_transformed = gemmi.Position(pos.x - grid_min_cart[0],
-                                             pos.y - grid_min_cart[1],
-                                             pos.z - grid_min_cart[2],
-                                             )
-            protein_grid.set_points_around(pos_transformed,
-                                           radius=mask_radius,
-                                           value=1,
-                                           )
+        protein_grid_array = np.array(protein_grid, copy=False, dtype=np.int8)
+        protein_grid_array[:, :, :] = rasterise_atoms(
+            protein_grid_array.shape,
+            protein_grid_unit_cell,
+            structure.arrays().atom_positions - np.array([grid_min_cart.x, grid_min_cart.y, grid_min_cart.z]),
+            [mask_radius, ],
+        )[0]
 
         # # Get the corresponding unit cell points
         coord_unit_cell_tuple = (np.mod(coord_tuple[0], grid.nu),
@@ -227,56 +225,29 @@ class Partitioning:
                        mask_radius: float,
                        mask_radius_symmetry: float,
                        ):
-        poss = []
         res_indexes = {}
 
-        for i, res_id in enumerate(structure.protein_residue_ids()):
-            res_span = structure[res_id]
-            res = res_span[0]
-            ca = res["CA"][0]
-            orthogonal = ca.pos
-            poss.append(orthogonal)
+        structure_arrays = structure.arrays()
+        for i, res_id in enumerate(structure_arrays.residue_ids):
             res_indexes[i] = res_id
 
-        ca_position_array = np.array([[x for x in pos] for pos in poss])
+        ca_position_array = structure_arrays.ca_positions
 
         kdtree = spatial.KDTree(ca_position_array)
 
-        mask = gemmi.Int8Grid(*[grid.nu, grid.nv, grid.nw])
-        mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-        mask.set_unit_cell(grid.unit_cell)
-        for atom in structure.protein_atoms():
-            pos = atom.pos
-            mask.set_points_around(pos,
-                                   radius=mask_radius,
-                                   value=1,
-                                   )
+        # Protein, inner and contact masks from one distance field
+        mask_arrays = rasterise_atoms(
+            (grid.nu, grid.nv, grid.nw),
+            grid.unit_cell,
+            structure_arrays.protein_positions,
+            [mask_radius, mask_radius_symmetry, 4.0],
+        )
+        spacegroup = gemmi.find_spacegroup_by_name("P 1")
+        mask = get_mask_grid(mask_arrays[0], spacegroup, grid.unit_cell)
+        inner_mask = get_mask_grid(mask_arrays[1], spacegroup, grid.unit_cell)
+        contact_mask = get_mask_grid(mask_arrays[2], spacegroup, grid.unit_cell)
         mask_array = np.array(mask, copy=False, dtype=np.int8)
 
-        # Get the inner mask
-        inner_mask = gemmi.Int8Grid(*[grid.nu, grid.nv, grid.nw])
-        inner_mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-        inner_mask.set_unit_cell(grid.unit_cell)
-        for atom in structure.protein_atoms():
-            pos = atom.pos
-            inner_mask.set_points_around(pos,
-                                   radius=mask_radius_symmetry,
-                                   value=1,
-                                   )
-        # mask_array = np.array(mask, copy=False, dtype=np.int8)
-
-        # Get the contact mask
-        contact_mask = gemmi.Int8Grid(*[grid.nu, grid.nv, grid.nw])
-        contact_mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
-        contact_mask.set_unit_cell(grid.unit_cell)
-        for atom in structure.protein_atoms():
-            pos = atom.pos
-            contact_mask.set_points_around(pos,
-                                         radius=4.0,
-                                         value=1,
-                                         )
-        # mask_array = np.array(mask, copy=False, dtype=np.int8)
-
         # Mask the symmetry points
         symmetry_mask = Partitioning.get_symmetry_contact_mask(structure, grid, mask, mask_radius_symmetry)
         symmetry_mask_array = np.array(symmetry_mask, copy=False, dtype=np.int8)
@@ -381,91 +352,26 @@ class Partitioning:
                                   symmetry_mask_radius: float = 3):
         protein_mask_array = np.array(protein_mask, copy=False, dtype=np.int8)
 
-        mask = gemmi.Int8Grid(*protein_mask_array.shape)
-        mask.spacegroup = protein_mask.spacegroup
-        mask.set_unit_cell(protein_mask.unit_cell)
-
         # Mask psacegroup summetry related
         symops = Symops.from_grid(grid)
 
         # Symmetry waters can be a problem for known hits! See BAZ2BA-x447 for an example
-        for atom in structure.all_atoms(exclude_waters=True):
-            position = atom.pos
-            fractional_position = mask.unit_cell.fractionalize(position)
-            wrapped_position = fractional_position.wrap_to_unit()
-            for symmetry_operation in symops.symops[1:]:
-                symmetry_position = gemmi.Fractional(*symmetry_operation.apply_to_xyz([wrapped_position[0],
-                                                                                       wrapped_position[1],
-                                                                                       wrapped_position[2],
-                                                                                       ]))
-                orthogonal_symmetry_position = mask.unit_cell.orthogonalize(symmetry_position)
-
-                mask.set_points_around(orthogonal_symmetry_position,
-                                       radius=symmetry_mask_radius,
-                                       value=1,
-                                       )
-
-        mask_array = np.array(mask, copy=False, dtype=np.int8)
-
-        equal_mask = protein_mask_array == mask_array
-
-        protein_mask_indicies = np.nonzero(protein_mask_array)
-        protein_mask_bool = np.full(protein_mask_array.shape, False)
-        protein_mask_bool[protein_mask_indicies] = True
-
-        mask_array[~protein_mask_bool] = 0
-
-        # ##################################
-        # Mask unit cell overlap
-        # ################################
-        # Make a temp mask to hold overlap
-        mask_unit_cell = gemmi.Int8Grid(*protein_mask_array.shape)
-        mask_unit_cell.spacegroup = protein_mask.spacegroup
-        mask_unit_cell.set_unit_cell(protein_mask.unit_cell)
-        mask_unit_cell_array = np.array(mask_unit_cell, copy=False, dtype=np.int8)
-
-        # Assign atoms to unit cells
-        unit_cell_index_dict = {}
-        for atom in structure.all_atoms():
-            position = atom.pos
-            fractional_position = mask_unit_cell.unit_cell.fractionalize(position)
-
-            unit_cell_index_tuple = (int(fractional_position.x),
-                                     int(fractional_position.y),
-                                     int(fractional_position.z),
-                                     )
-
-            if unit_cell_index_tuple not in unit_cell_index_dict:
-                unit_cell_index_dict[unit_cell_index_tuple] = []
-
-            unit_cell_index_dict[unit_cell_index_tuple].append(position)
-
-        # Create masks of those unit cells
-        unit_cell_mask_dict = {}
-        for unit_cell_index, unit_cell_position_list in unit_cell_index_dict.items():
-            unit_cell_mask = gemmi.Int8Grid(*protein_mask_array.shape)
-            unit_cell_mask.spacegroup = protein_mask.spacegroup
-            unit_cell_mask.set_unit_cell(protein_mask.unit_cell)
-
-            for position in unit_cell_position_list:
-                mask_unit_cell.set_points_around_non_overlapping(
-                    position,
-                    radius=symmetry_mask_radius,
-                    value=1,
-                )
-
-            unit_cell_mask_dict[unit_cell_index] = unit_cell_mask
-
-        # Overlay those masks
-        for unit_cell_index, unit_cell_mask in unit_cell_mask_dict.items():
-            unit_cell_mask_array = np.array(unit_cell_mask, copy=False, dtype=np.int8)
-            mask_unit_cell_array[unit_cell_mask_array == 1] += 1
+        symmetry_positions = get_symmetry_positions(
+            structure.arrays().non_water_positions(),
+            protein_mask.unit_cell,
+            symops.symops,
+        )
+        mask_array = rasterise_atoms(
+            protein_mask_array.shape,
+            protein_mask.unit_cell,
+            symmetry_positions,
+            [symmetry_mask_radius, ],
+        )[0]
 
-        # Select the unit cell overlapping points
-        mask_unit_cell_array_mask = mask_unit_cell_array > 1
+        # Only symmetry contacts with the protein
+        mask_array[protein_mask_array == 0] = 0
 
-        # mask them in the symmetry mask array
-        mask_array[mask_unit_cell_array_mask] = 1
+        mask = get_mask_grid(mask_array, protein_mask.spacegroup, protein_mask.unit_cell)
 
         return mask
 
@@ -511,34 +417,83 @@ class Partitioning:
         ccp4.update_ccp4_header(0, True)
         ccp4.write_ccp4_map(str(dir / PANDDA_TOTAL_MASK_FILE))
 
-    def __getstate__(self):
-        # partitioning_python = PartitoningPython.from_gemmi(self.partitioning)
-        partitioning_python = self.partitioning
-        protein_mask_python = Int8GridPython.from_gemmi(self.protein_mask)
-        inner_mask_python = Int8GridPython.from_gemmi(self.inner_mask)
-        contact_mask_python = Int8GridPython.from_gemmi(self.contact_mask)
-        symmetry_mask_python = Int8GridPython.from_gemmi(self.symmetry_mask)
-        return (partitioning_python,
-                protein_mask_python,
-                inner_mask_python,
-                contact_mask_python,
-                symmetry_mask_python,
-                self.total_mask
-                )
-
-    def __setstate__(self, data):
-        partitioning_gemmi = data[0]
-        protein_mask_gemmi = data[1].to_gemmi()
-        inner_mask_gemmi = data[2].to_gemmi()
-        contact_mask_gemmi = data[3].to_gemmi()
-        symmetry_mask_gemmi = data[4].to_gemmi()
-
-        self.partitioning = partitioning_gemmi
-        self.protein_mask = protein_mask_gemmi
-        self.inner_mask = inner_mask_gemmi
-        self.contact_mask = contact_mask_gemmi
-        self.symmetry_mask = symmetry_mask_gemmi
-        self.total_mask = data[5]
+    def __reduce__(self):
+        return Partitioning, (
+            self.partitioning,
+            self.protein_mask,
+            self.inner_mask,
+            self.contact_mask,
+            self.symmetry_mask,
+            self.total_mask,
+        )
+
+
+@dataclasses.dataclass()
+class PartitioningArrays:
+    residue_ids: typing.List[ResidueID]
+    point_array: np.ndarray
+    residue_rows: np.ndarray
+
+    @staticmethod
+    def from_partitioning(partitioning: Partitioning) -> PartitioningArrays:
+        residue_ids = list(partitioning.partitioning.keys())
+        point_arrays = []
+        residue_rows = []
+        for row, residue_id in enumerate(residue_ids):
+            residue_points = list(partitioning[residue_id].keys())
+            point_arrays.append(np.array(residue_points, dtype=np.int32).reshape(-1, 3))
+            residue_rows.append(np.full(len(residue_points), row, dtype=np.int32))
+
+        if len(point_arrays) == 0:
+            return PartitioningArrays([], np.zeros((0, 3), dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+        return PartitioningArrays(residue_ids, np.concatenate(point_arrays), np.concatenate(residue_rows))
+
+    def residue_points(self) -> typing.Dict[ResidueID, np.ndarray]:
+        # Points of each residue in their original order
+        order = np.argsort(self.residue_rows, kind="stable")
+        bounds = np.searchsorted(self.residue_rows[order], np.arange(len(self.residue_ids) + 1))
+        return {
+            residue_id: self.point_array[order[bounds[row]:bounds[row + 1]]]
+            for row, residue_id
+            in enumerate(self.residue_ids)
+        }
+
+    def to_partitioning(self, grid: gemmi.FloatGrid) -> Partitioning:
+        # Only the points are kept for native frame partitionings, so the masks are not restored
+        orthogonalization_matrix = np.array(grid.unit_cell.orthogonalization_matrix.tolist())
+        shape = np.array([grid.nu, grid.nv, grid.nw])
+
+        partitions = {}
+        for residue_id, residue_point_array in self.residue_points().items():
+            positions = (residue_point_array / shape) @ orthogonalization_matrix.T
+            partitions[residue_id] = {
+                tuple(point): tuple(position)
+                for point, position
+                in zip(residue_point_array.tolist(), positions.tolist())
+            }
+
+        return Partitioning(partitions, None, None, None, None, None)
+
+    def save(self, path: Path):
+        np.savez(
+            path,
+            models=np.array([residue_id.model for residue_id in self.residue_ids], dtype=str),
+            chains=np.array([residue_id.chain for residue_id in self.residue_ids], dtype=str),
+            insertions=np.array([residue_id.insertion for residue_id in self.residue_ids], dtype=str),
+            point_array=self.point_array,
+            residue_rows=self.residue_rows,
+        )
+
+    @staticmethod
+    def load(path: Path) -> PartitioningArrays:
+        with np.load(path) as f:
+            residue_ids = [
+                ResidueID(str(model), str(chain), str(insertion))
+                for model, chain, insertion
+                in zip(f["models"], f["chains"], f["insertions"])
+            ]
+            return PartitioningArrays(residue_ids, f["point_array"], f["residue_rows"])
 
 
 @dataclasses.dataclass()
@@ -599,18 +554,5 @@ class Grid:
         grid = self.grid
         return [grid.nu, grid.nv, grid.nw]
 
-    def __getstate__(self):
-        grid_python = Int8GridPython.from_gemmi(self.grid)
-        partitioning_python = self.partitioning.__getstate__()
-
-        return (grid_python, partitioning_python)
-
-    def __setstate__(self, data):
-        self.partitioning = Partitioning(data[1][0],
-                                         data[1][1].to_gemmi(),
-                                         data[1][2].to_gemmi(),
-                                         data[1][3].to_gemmi(),
-                                         data[1][4].to_gemmi(),
-                                         data[1][5]
-                                         )
-        self.grid = data[0].to_gemmi()
\ No newline at end of file
+    def __reduce__(self):
+        return Grid, (self.grid, self.partitioning)
\ No newline at end of file
@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+import typing
+
+from pandda_gemmi.constants import *
+from pandda_gemmi.python_types import *
+
+
+def get_grid_spacing(unit_cell: gemmi.UnitCell, shape: typing.Tuple[int, int, int]) -> np.ndarray:
+    # Distance between the planes of grid points along each axis, as used by gemmi to bound set_points_around
+    fractionalization_matrix = np.array(unit_cell.fractionalization_matrix.tolist())
+    return 1.0 / (np.array(shape) * np.linalg.norm(fractionalization_matrix, axis=1))
+
+
+def get_symmetry_positions(positions: np.ndarray, unit_cell: gemmi.UnitCell, symops) -> np.ndarray:
+    # Orthogonal positions of the atoms under every non-identity operation, from their unit cell wrapped positions
+    fractionalization_matrix = np.array(unit_cell.fractionalization_matrix.tolist())
+    orthogonalization_matrix = np.array(unit_cell.orthogonalization_matrix.tolist())
+
+    fractional_positions = positions @ fractionalization_matrix.T
+    wrapped_positions = fractional_positions - np.floor(fractional_positions)
+
+    symmetry_positions = []
+    for symmetry_operation in symops[1:]:
+        seitz = np.array(symmetry_operation.float_seitz())
+        symmetry_positions.append(wrapped_positions @ seitz[:3, :3].T + seitz[:3, 3])
+
+    if len(symmetry_positions) == 0:
+        return np.zeros((0, 3))
+
+    return np.concatenate(symmetry_positions, axis=0) @ orthogonalization_matrix.T
+
+
+def fold_periodic_axis(padded: np.ndarray, axis: int, size: int, padding: int) -> np.ndarray:
+    # Take the minimum over all of the padded points which wrap onto each point of the periodic axis
+    padded = np.moveaxis(padded, axis, 0)
+    folded = np.full((size,) + padded.shape[1:], np.inf)
+    start = 0
+    while start < padded.shape[0]:
+        target = (start - padding) % size
+        length = min(size - target, padded.shape[0] - start)
+        np.minimum(folded[target:target + length], padded[start:start + length], out=folded[target:target + length])
+        start += length
+
+    return np.moveaxis(folded, 0, axis)
+
+
+def get_distance_field(shape: typing.Tuple[int, int, int],
+                       unit_cell: gemmi.UnitCell,
+                       positions: np.ndarray,
+                       max_radius: float,
+                       max_elements: int = MASK_MAX_ELEMENTS,
+                       ) -> np.ndarray:
+    # Squared distance from each point of a periodic grid to the nearest atom, or inf beyond max_radius. Points are
+    # visited exactly as set_points_around does, so thresholding at any radius up to max_radius reproduces it.
+    fractionalization_matrix = np.array(unit_cell.fractionalization_matrix.tolist())
+    orthogonalization_matrix = np.array(unit_cell.orthogonalization_matrix.tolist())
+    shape_array = np.array(shape)
+
+    if positions.shape[0] == 0:
+        return np.full(shape, np.inf)
+
+    # Nearest grid point to each atom and the atom's offset from it
+    fractional_positions = positions @ fractionalization_matrix.T
+    fractional_positions = fractional_positions - np.floor(fractional_positions)
+    nearest_points = np.floor(fractional_positions * shape_array + 0.5).astype(int)
+    residuals = (fractional_positions - nearest_points / shape_array) @ orthogonalization_matrix.T
+
+    # Grid offsets in the box set_points_around searches
+    extents = np.ceil(max_radius / get_grid_spacing(unit_cell, shape)).astype(int)
+    offsets = np.stack(
+        np.meshgrid(*[np.arange(-extent, extent + 1) for extent in extents], indexing="ij"),
+        axis=-1,
+    ).reshape(-1, 3)
+    offset_positions = (offsets / shape_array) @ orthogonalization_matrix.T
+
+    # Write into a grid padded by the box so that indexes need no wrapping, then fold it onto the unit cell
+    padded_shape = shape_array + 1 + 2 * extents
+    strides = np.array([padded_shape[1] * padded_shape[2], padded_shape[2], 1])
+    padded = np.full(int(np.prod(padded_shape)), np.inf)
+    offset_indexes = offsets @ strides
+    point_indexes = (nearest_points + extents) @ strides
+
+    residual_norms = np.sum(np.square(residuals), axis=1)
+    offset_norms = np.sum(np.square(offset_positions), axis=1)
+    block_size = max(1, max_elements // offsets.shape[0])
+    for start in range(0, positions.shape[0], block_size):
+        stop = start + block_size
+        distances_squared = (residual_norms[start:stop, np.newaxis] + offset_norms[np.newaxis, :]
+                             - 2.0 * (residuals[start:stop] @ offset_positions.T))
+        indexes = point_indexes[start:stop, np.newaxis] + offset_indexes[np.newaxis, :]
+        np.minimum.at(padded, indexes.ravel(), distances_squared.ravel())
+
+    field = padded.reshape(padded_shape)
+    for axis in range(3):
+        field = fold_periodic_axis(field, axis, shape[axis], extents[axis])
+    field[field >= max_radius * max_radius] = np.inf
+
+    return field
+
+
+def get_local_mask_indexes(shape: typing.Tuple[int, int, int],
+                           unit_cell: gemmi.UnitCell,
+                           positions: np.ndarray,
+                           radius: float,
+                           max_elements: int = MASK_MAX_ELEMENTS,
+                           ) -> typing.Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # The int32 indexes, in np.nonzero order, of the points set_points_around would mark around the positions.
+    # Only a spherical stencil of offsets around each position's nearest grid point is tested, so no grid of the
+    # full shape is allocated. Distances are evaluated in the same order of operations as gemmi, so points exactly
+    # at the radius are decided the same way.
+    fractionalization_matrix = np.array(unit_cell.fractionalization_matrix.tolist())
+    orthogonalization_matrix = np.array(unit_cell.orthogonalization_matrix.tolist())
+    shape_array = np.array(shape)
+
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    if positions.shape[0] == 0:
+        return tuple(np.zeros(0, dtype=np.int32) for _ in range(3))
+
+    # Wrapped fractional positions and their nearest grid points
+    fractional_positions = sum(positions[:, j, np.newaxis] * fractionalization_matrix[np.newaxis, :, j]
+                               for j in range(3))
+    fractional_positions = fractional_positions - np.floor(fractional_positions)
+    scaled_positions = fractional_positions * shape_array
+    nearest_points = np.floor(scaled_positions) + ((scaled_positions - np.floor(scaled_positions)) >= 0.5)
+    nearest_points = nearest_points.astype(np.int64)
+
+    # Offsets in the box set_points_around searches, less those too far away for any offset from the nearest point
+    extents = np.ceil(radius / get_grid_spacing(unit_cell, shape)).astype(int)
+    offsets = np.stack(
+        np.meshgrid(*[np.arange(-extent, extent + 1) for extent in extents], indexing="ij"),
+        axis=-1,
+    ).reshape(-1, 3)
+    offset_positions = (offsets / shape_array) @ orthogonalization_matrix.T
+    max_residual = 0.5 * np.sum(np.linalg.norm(orthogonalization_matrix / shape_array[np.newaxis, :], axis=0))
+    offsets = offsets[np.linalg.norm(offset_positions, axis=1) < radius + max_residual + 1e-6]
+
+    # Mark the points in a box around the positions, so that overlapping points are merged without sorting them.
+    # The images of the nearest points closest to the first are used, so a cluster across a cell edge stays compact.
+    image_shifts = (nearest_points - nearest_points[0] + shape_array // 2) % shape_array - shape_array // 2 \
+                   - (nearest_points - nearest_points[0])
+    box_points = nearest_points + image_shifts
+    box_min = np.min(box_points, axis=0) - extents
+    box = np.zeros(np.max(box_points, axis=0) + extents - box_min + 1, dtype=bool)
+
+    inverse_shape = 1.0 / shape_array
+    block_size = max(1, max_elements // offsets.shape[0])
+    for start in range(0, positions.shape[0], block_size):
+        stop = start + block_size
+        points = nearest_points[start:stop, np.newaxis, :] + offsets[np.newaxis, :, :]
+        fractional_deltas = fractional_positions[start:stop, np.newaxis, :] - points * inverse_shape
+        distances_squared = sum(
+            np.square(sum(orthogonalization_matrix[i, j] * fractional_deltas[:, :, j] for j in range(3)))
+            for i in range(3)
+        )
+        position_rows, offset_rows = np.nonzero(distances_squared < radius * radius)
+        marked = box_points[start:stop][position_rows] + offsets[offset_rows] - box_min
+        box[marked[:, 0], marked[:, 1], marked[:, 2]] = True
+
+    # Wrap the marked points onto the grid
+    points = (np.argwhere(box) + box_min) % shape_array
+    strides = np.array([shape[1] * shape[2], shape[2], 1], dtype=np.int64)
+    point_indexes = np.unique(points @ strides)
+
+    return tuple(index.astype(np.int32) for index in np.unravel_index(point_indexes, shape))
+
+
+def rasterise_atoms(shape: typing.Tuple[int, int, int],
+                    unit_cell: gemmi.UnitCell,
+                    positions: np.ndarray,
+                    radii: typing.List[float],
+                    ) -> typing.List[np.ndarray]:
+    # Masks of the points within each radius of any atom from a single distance field
+    field = get_distance_field(shape, unit_cell, positions, max(radii))
+    return [(field < radius * radius).astype(np.int8) for radius in radii]
+
+
+def get_mask_grid(mask_array: np.ndarray, spacegroup: gemmi.SpaceGroup, unit_cell: gemmi.UnitCell) -> gemmi.Int8Grid:
+    mask = gemmi.Int8Grid(*mask_array.shape)
+    mask.spacegroup = spacegroup
+    mask.set_unit_cell(unit_cell)
+    grid_array = np.array(mask, copy=False, dtype=np.int8)
+    grid_array[:, :, :] = mask_array[:, :, :]
+    return mask
@@ -0,0 +1,78 @@
+from __future__ import annotations
+
+import os
+import hashlib
+import dataclasses
+from pathlib import Path
+
+from pandda_gemmi.constants import *
+from pandda_gemmi.python_types import *
+from pandda_gemmi.dataset import Structure
+from pandda_gemmi.edalignment.grid import Partitioning, PartitioningArrays
+
+
+@dataclasses.dataclass()
+class PartitioningCache:
+    path: Path
+
+    @staticmethod
+    def from_dir(pandda_dir: Path) -> PartitioningCache:
+        path = pandda_dir / PANDDA_PARTITIONING_CACHE_DIR
+        path.mkdir(parents=True, exist_ok=True)
+        return PartitioningCache(path)
+
+    @staticmethod
+    def get_key(structure: Structure,
+                grid: gemmi.FloatGrid,
+                mask_radius: float,
+                mask_radius_symmetry: float,
+                ) -> str:
+        # A partitioning depends only on the atoms, the grid and the mask radii
+        structure_arrays = structure.arrays()
+        key = hashlib.sha1()
+        key.update(repr([(residue_id.model, residue_id.chain, residue_id.insertion)
+                         for residue_id in structure_arrays.residue_ids]).encode())
+        key.update(np.ascontiguousarray(structure_arrays.ca_positions).tobytes())
+        key.update(np.ascontiguousarray(structure_arrays.protein_positions).tobytes())
+        key.update(np.ascontiguousarray(structure_arrays.atom_positions).tobytes())
+        key.update(np.ascontiguousarray(structure_arrays.atom_is_water).tobytes())
+        key.update(repr((
+            (grid.nu, grid.nv, grid.nw),
+            grid.unit_cell.parameters,
+            grid.spacegroup.xhm(),
+            float(mask_radius),
+            float(mask_radius_symmetry),
+        )).encode())
+        return key.hexdigest()
+
+    def get_arrays(self,
+                   structure: Structure,
+                   grid: gemmi.FloatGrid,
+                   mask_radius: float,
+                   mask_radius_symmetry: float,
+                   ) -> PartitioningArrays:
+        path = self.path / f"{PartitioningCache.get_key(structure, grid, mask_radius, mask_radius_symmetry)}.npz"
+        if path.exists():
+            try:
+                return PartitioningArrays.load(path)
+            except Exception as e:
+                print(f"WARNING: Could not read cached partitioning {path}: {e}")
+
+        partitioning_arrays = PartitioningArrays.from_partitioning(
+            Partitioning.from_structure(structure, grid, mask_radius, mask_radius_symmetry)
+        )
+
+        # Datasets may be processed concurrently, so only complete files are moved into place
+        temporary_path = self.path / f"{path.stem}.{os.getpid()}.tmp.npz"
+        partitioning_arrays.save(temporary_path)
+        os.replace(temporary_path, path)
+
+        return partitioning_arrays
+
+    def get(self,
+            structure: Structure,
+            grid: gemmi.FloatGrid,
+            mask_radius: float,
+            mask_radius_symmetry: float,
+            ) -> Partitioning:
+        return self.get_arrays(structure, grid, mask_radius, mask_radius_symmetry).to_partitioning(grid)
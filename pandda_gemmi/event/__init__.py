@@ -1,2 +1,3 @@
-from pandda_gemmi.event.event import Event, Events, Cluster, Clustering, Clusterings, get_event_mask_indicies
-from pandda_gemmi.event.event_scoring import score_clusters
\ No newline at end of file
+from pandda_gemmi.event.event import Event, Events, Cluster, Clustering, Clusterings, get_event_mask_indicies, \
+    get_event_map_reference_grid
+from pandda_gemmi.event.event_scoring import score_clusters, Conformers, ConformerCache
@@ -15,11 +15,35 @@ set_loky_pickler('pickle')
 from pandda_gemmi.python_types import *
 from pandda_gemmi.common import EventIDX, EventID, SiteID, Dtag, PositionsArray, delayed
 from pandda_gemmi.dataset import Reference, Dataset, StructureFactors
-from pandda_gemmi.edalignment import Grid, Xmap, Alignment, Xmaps, Partitioning
+from pandda_gemmi.edalignment import Grid, Xmap, Alignment, Xmaps, Partitioning, PartitioningCache
+from pandda_gemmi.edalignment.mask import get_local_mask_indexes
 from pandda_gemmi.model import Zmap, Zmaps, Model
 from pandda_gemmi.sites import Sites
 
 
+def get_event_map_reference_grid(xmap: Xmap, model: Model, event: Event) -> gemmi.FloatGrid:
+    reference_xmap_grid = xmap.xmap
+    reference_xmap_grid_array = np.array(reference_xmap_grid, copy=False)
+
+    event_map_reference_grid = gemmi.FloatGrid(*[reference_xmap_grid.nu,
+                                                 reference_xmap_grid.nv,
+                                                 reference_xmap_grid.nw,
+                                                 ]
+                                               )
+    event_map_reference_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")  # xmap.xmap.spacegroup
+    event_map_reference_grid.set_unit_cell(reference_xmap_grid.unit_cell)
+
+    event_map_reference_grid_array = np.array(event_map_reference_grid,
+                                              copy=False,
+                                              )
+
+    mean_array = model.mean
+    event_map_reference_grid_array[:, :, :] = (reference_xmap_grid_array - (event.bdc.bdc * mean_array)) / (
+            1 - event.bdc.bdc)
+
+    return event_map_reference_grid
+
+
 def save_event_map(
         path,
         xmap: Xmap,
@@ -34,29 +58,13 @@ def save_event_map(
         partitioning: Partitioning,
         sample_rate: float,
         # native_grid,
+        writer=None,
 ):
-    reference_xmap_grid = xmap.xmap
-    reference_xmap_grid_array = np.array(reference_xmap_grid, copy=True)
-
     # moving_xmap_grid: gemmi.FloatGrid = dataset.reflections.reflections.transform_f_phi_to_map(structure_factors.f,
     #                                                                                          structure_factors.phi,
     #                                                                                          )
 
-    event_map_reference_grid = gemmi.FloatGrid(*[reference_xmap_grid.nu,
-                                                 reference_xmap_grid.nv,
-                                                 reference_xmap_grid.nw,
-                                                 ]
-                                               )
-    event_map_reference_grid.spacegroup = gemmi.find_spacegroup_by_name("P 1")  # xmap.xmap.spacegroup
-    event_map_reference_grid.set_unit_cell(reference_xmap_grid.unit_cell)
-
-    event_map_reference_grid_array = np.array(event_map_reference_grid,
-                                              copy=False,
-                                              )
-
-    mean_array = model.mean
-    event_map_reference_grid_array[:, :, :] = (reference_xmap_grid_array - (event.bdc.bdc * mean_array)) / (
-            1 - event.bdc.bdc)
+    event_map_reference_grid = get_event_map_reference_grid(xmap, model, event)
 
     event_map_grid = Xmap.from_aligned_map_c(
         event_map_reference_grid,
@@ -97,7 +105,10 @@ def save_event_map(
     ccp4.setup()
     # ccp4.set_extent(box)
     # ccp4.grid.symmetrize_max()
-    ccp4.write_ccp4_map(str(path))
+    if writer is not None:
+        writer.submit(ccp4.write_ccp4_map, str(path))
+    else:
+        ccp4.write_ccp4_map(str(path))
 
 
 @dataclasses.dataclass()
@@ -123,21 +134,12 @@ class Cluster:
 
 def get_event_mask_indicies(zmap: Zmap, cluster_positions_array: np.ndarray):
     # cluster_positions_array = extrema_cart_coords_array[cluster_indicies]
-    positions = PositionsArray(cluster_positions_array).to_positions()
-    event_mask = gemmi.Int8Grid(*zmap.shape())
-    event_mask.spacegroup = zmap.spacegroup()
-    event_mask.set_unit_cell(zmap.unit_cell())
-    for position in positions:
-        event_mask.set_points_around(position,
-                                     radius=2.0,
-                                     value=1,
-                                     )
-
-    # event_mask.symmetrize_max()
-
-    event_mask_array = np.array(event_mask, copy=True, dtype=np.int8)
-    event_mask_indicies = np.nonzero(event_mask_array)
-    return event_mask_indicies
+    return get_local_mask_indexes(
+        zmap.shape(),
+        zmap.unit_cell(),
+        cluster_positions_array,
+        radius=2.0,
+    )
 
 
 @dataclasses.dataclass()
@@ -564,9 +566,8 @@ class Clustering:
         mask.spacegroup = zmap.spacegroup()
         mask.set_unit_cell(zmap.unit_cell())
 
-        for atom in reference.dataset.structure.protein_atoms():
-            pos = atom.pos
-            mask.set_points_around(pos,
+        for pos in reference.dataset.structure.arrays().protein_positions:
+            mask.set_points_around(gemmi.Position(*pos),
                                    radius=masks_radius,
                                    value=1,
                                    )
@@ -1039,6 +1040,7 @@ class Events:
             sample_rate,
             native_grid,
             mapper=False,
+            writer=None,
     ):
 
         processed_datasets = {}
@@ -1073,9 +1075,10 @@ class Events:
                 ) == 0:
                     event_dtag_list.append(dtag)
 
+            partitioning_cache = PartitioningCache.from_dir(pandda_fs_model.pandda_dir)
             results = mapper(
                 delayed(
-                    Partitioning.from_structure_multiprocess)(
+                    partitioning_cache.get)(
                     datasets[dtag].structure,
                     # grid,
                     native_grid,
@@ -1103,6 +1106,7 @@ class Events:
                     inner_mask_symmetry,
                     partitioning_dict[event_id.dtag],
                     sample_rate,
+                    writer,
                 )
                 for event_id
                 in event_id_list
@@ -1,4 +1,9 @@
+from __future__ import annotations
+
 from typing import *
+import os
+import hashlib
+import dataclasses
 
 # 3rd party
 import numpy as np
@@ -12,10 +17,13 @@ from pathlib import Path
 import time
 
 #
+from pandda_gemmi.constants import PANDDA_CONFORMER_CACHE_DIR
 from pandda_gemmi.dataset import Dataset
 # from pandda_gemmi.fs import PanDDAFSModel, ProcessedDataset
 from pandda_gemmi.event import Cluster
-from pandda_gemmi.autobuild import score_structure_signal_to_noise_density, EXPERIMENTAL_score_structure_signal_to_noise_density
+from pandda_gemmi.autobuild import score_structure_signal_to_noise_density, \
+    EXPERIMENTAL_score_structure_signal_to_noise_density, EXPERIMENTAL_score_loci_signal_to_noise_density, \
+    get_bond_midpoints, get_loci_array
 
 
 def get_structures_from_mol(mol: Chem.Mol, max_conformers) -> MutableMapping[int, gemmi.Structure]:
@@ -133,122 +141,162 @@ def structures_from_cif(source_ligand_cif, debug=False):
     return {0: structure}
 
 
-def get_conformers(
-        fragment_dataset,
-        pruning_threshold=5,
-        num_pose_samples=100,
-        max_conformers=10,
-        debug=False,
-) -> MutableMapping[int, Chem.Mol]:
-    # Decide how to load
-    fragment_structures = {}
-    if fragment_dataset.source_ligand_smiles:
-
-        if debug:
-            print(f'\t\tGetting mol from ligand smiles')
-        mol = get_fragment_mol_from_dataset_smiles_path(fragment_dataset.source_ligand_smiles)
-
-        # Generate conformers
-        m2: Chem.Mol = Chem.AddHs(mol)
-
-        # Generate conformers
-        cids = AllChem.EmbedMultipleConfs(m2, numConfs=num_pose_samples, pruneRmsThresh=pruning_threshold)
+@dataclasses.dataclass()
+class Conformers:
+    elements: np.ndarray
+    names: np.ndarray
+    positions: np.ndarray
 
-        # Translate to structures
-        fragment_structures: MutableMapping[int, gemmi.Structure] = get_structures_from_mol(m2, max_conformers)
-        if len(fragment_structures) > 0:
-            return fragment_structures
+    @staticmethod
+    def from_structures(structures: MutableMapping[int, gemmi.Structure]) -> Conformers:
+        # Every conformer has the same atoms, so only their positions need storing per conformer
+        elements, names, positions = [], [], []
+        for conformer_id, structure in structures.items():
+            atoms = [atom for model in structure for chain in model for residue in chain for atom in residue]
+            elements = [atom.element.name for atom in atoms]
+            names = [atom.name for atom in atoms]
+            positions.append([[atom.pos.x, atom.pos.y, atom.pos.z] for atom in atoms])
+
+        return Conformers(
+            np.array(elements, dtype=str),
+            np.array(names, dtype=str),
+            np.array(positions, dtype=float).reshape(len(positions), len(elements), 3),
+        )
+
+    def __len__(self):
+        return self.positions.shape[0]
+
+    def save(self, path: Path):
+        np.savez(path, elements=self.elements, names=self.names, positions=self.positions)
+
+    @staticmethod
+    def load(path: Path) -> Conformers:
+        with np.load(path) as f:
+            return Conformers(f["elements"], f["names"], f["positions"])
+
+
+def get_conformers_from_smiles(smiles_path: Path, pruning_threshold, num_pose_samples, max_conformers) -> Conformers:
+    mol = get_fragment_mol_from_dataset_smiles_path(smiles_path)
+
+    # Generate conformers
+    m2: Chem.Mol = Chem.AddHs(mol)
+
+    # Generate conformers
+    cids = AllChem.EmbedMultipleConfs(m2, numConfs=num_pose_samples, pruneRmsThresh=pruning_threshold)
+
+    # Translate to structures
+    return Conformers.from_structures(get_structures_from_mol(m2, max_conformers))
+
+
+def get_smiles_key(smiles_path: Path, pruning_threshold, num_pose_samples, max_conformers) -> str:
+    # Campaigns soak the same ligand into many crystals, so key on the canonical smiles rather than the file
+    mol = get_fragment_mol_from_dataset_smiles_path(smiles_path)
+    canonical_smiles = Chem.MolToSmiles(mol) if mol is not None else None
+    key = hashlib.sha1()
+    key.update(repr(("smiles", canonical_smiles, pruning_threshold, num_pose_samples, max_conformers)).encode())
+    return key.hexdigest()
+
+
+def get_file_key(path: Path, source: str) -> str:
+    key = hashlib.sha1()
+    key.update(source.encode())
+    with open(path, "rb") as f:
+        key.update(f.read())
+    return key.hexdigest()
+
+
+# Conformers already generated or loaded by this process
+CONFORMER_CACHE: Dict[str, Conformers] = {}
+
+
+@dataclasses.dataclass()
+class ConformerCache:
+    path: Optional[Path]
+
+    @staticmethod
+    def from_dir(pandda_dir: Path) -> ConformerCache:
+        path = pandda_dir / PANDDA_CONFORMER_CACHE_DIR
+        path.mkdir(parents=True, exist_ok=True)
+        return ConformerCache(path)
+
+    def get_cached(self, key: str, get_conformers_func) -> Conformers:
+        if key in CONFORMER_CACHE:
+            return CONFORMER_CACHE[key]
+
+        path = self.path / f"{key}.npz" if self.path else None
+        if path and path.exists():
+            try:
+                CONFORMER_CACHE[key] = Conformers.load(path)
+                return CONFORMER_CACHE[key]
+            except Exception as e:
+                print(f"WARNING: Could not read cached conformers {path}: {e}")
+
+        conformers = get_conformers_func()
+
+        # Datasets are processed concurrently, so only complete files are moved into place
+        if path:
+            temporary_path = self.path / f"{key}.{os.getpid()}.tmp.npz"
+            conformers.save(temporary_path)
+            os.replace(temporary_path, path)
+
+        CONFORMER_CACHE[key] = conformers
+        return conformers
+
+    def get(self,
+            fragment_dataset,
+            pruning_threshold=5,
+            num_pose_samples=100,
+            max_conformers=10,
+            debug=False,
+            ) -> Conformers:
+        # Decide how to load
+        fragment_conformers = Conformers.from_structures({})
+        if fragment_dataset.source_ligand_smiles:
+            if debug:
+                print(f'\t\tGetting mol from ligand smiles')
+            fragment_conformers = self.get_cached(
+                get_smiles_key(fragment_dataset.source_ligand_smiles, pruning_threshold, num_pose_samples,
+                               max_conformers),
+                lambda: get_conformers_from_smiles(fragment_dataset.source_ligand_smiles, pruning_threshold,
+                                                   num_pose_samples, max_conformers),
+            )
+            if len(fragment_conformers) > 0:
+                return fragment_conformers
+
+        if fragment_dataset.source_ligand_cif:
+            if debug:
+                print(f'\t\tGetting mol from cif')
+            fragment_conformers = self.get_cached(
+                get_file_key(fragment_dataset.source_ligand_cif, "cif"),
+                lambda: Conformers.from_structures(structures_from_cif(fragment_dataset.source_ligand_cif, debug)),
+            )
+            if len(fragment_conformers) > 0:
+                return fragment_conformers
+
+        if fragment_dataset.source_ligand_pdb:
+            if debug:
+                print(f'\t\tGetting mol from ligand pdb')
+            fragment_conformers = self.get_cached(
+                get_file_key(fragment_dataset.source_ligand_pdb, "pdb"),
+                lambda: Conformers.from_structures(
+                    {0: gemmi.read_structure(str(fragment_dataset.source_ligand_pdb))}),
+            )
+            if len(fragment_conformers) > 0:
+                return fragment_conformers
 
-    if fragment_dataset.source_ligand_cif:
         if debug:
-            print(f'\t\tGetting mol from cif')
-        fragment_structures = structures_from_cif(fragment_dataset.source_ligand_cif, debug)
-        if len(fragment_structures) > 0:
-            return fragment_structures
-
-    if fragment_dataset.source_ligand_pdb:
-        if debug:
-            print(f'\t\tGetting mol from ligand pdb')
-        fragment_structures = {0: gemmi.read_structure(str(fragment_dataset.source_ligand_pdb))}
-        if len(fragment_structures) > 0:
-            return fragment_structures
-
-    if debug:
-        print(fragment_structures)
-
-    return fragment_structures
-
+            print(fragment_conformers)
 
-def get_structure_mean(structure):
-    xs = []
-    ys = []
-    zs = []
-    for model in structure:
-        for chain in model:
-            for residue in chain:
-                for atom in residue:
-                    # print(atom.pos)
-                    pos: gemmi.Position = atom.pos
-                    xs.append(pos.x)
-                    ys.append(pos.y)
-                    zs.append(pos.z)
+        return fragment_conformers
 
-    mean_x = np.mean(np.array(xs))
-    mean_y = np.mean(np.array(ys))
-    mean_z = np.mean(np.array(zs))
-
-    return mean_x, mean_y, mean_z
-
-
-def center_structure(structure, point):
-    mean_x, mean_y, mean_z = get_structure_mean(structure)
-
-    for model in structure:
-        for chain in model:
-            for residue in chain:
-                for atom in residue:
-                    pos: gemmi.Position = atom.pos
-                    new_x = pos.x - mean_x + point[0]
-                    new_y = pos.y - mean_y + point[1]
-                    new_z = pos.z - mean_z + point[2]
-                    atom.pos = gemmi.Position(new_x, new_y, new_z)
-
-    return structure
-
-
-def transform_structure(structure, translation, rotation_matrix):
-    mean_x, mean_y, mean_z = get_structure_mean(structure)
-    structure_copy = structure.clone()
-    structure_copy = center_structure(structure_copy, [0.0, 0.0, 0.0])
-
-    transform: gemmi.Transform = gemmi.Transform()
-    transform.mat.fromlist(rotation_matrix.tolist())
-    transform.vec.fromlist([0.0, 0.0, 0.0])
-
-    for model in structure_copy:
-        for chain in model:
-            for residue in chain:
-                for atom in residue:
-                    pos: gemmi.Position = atom.pos
-                    rotated_vec = transform.apply(pos)
-                    rotated_position = gemmi.Position(rotated_vec.x, rotated_vec.y, rotated_vec.z)
-                    atom.pos = rotated_position
-
-    structure_copy = center_structure(
-        structure_copy,
-        [
-            mean_x + translation[0],
-            mean_y + translation[1],
-            mean_z + translation[2]
-        ]
-    )
 
-    return structure_copy
+def transform_positions(positions: np.ndarray, translation, rotation_matrix: np.ndarray) -> np.ndarray:
+    # Rotate about the mean position, then translate
+    mean = np.mean(positions, axis=0)
+    return ((positions - mean) @ rotation_matrix.T) + mean + np.array(translation)
 
 
-def score_fit(structure, grid, params):
-    x, y, z, rx, ry, rz = params
-
+def get_rotation_matrix(rx, ry, rz) -> np.ndarray:
     rotation = spsp.transform.Rotation.from_euler(
         "xyz",
         [
@@ -257,108 +305,49 @@ def score_fit(structure, grid, params):
             rz*360,
         ],
         degrees=True)
-    rotation_matrix: np.ndarray = rotation.as_matrix()
-    structure_copy = transform_structure(
-        structure,
+    return rotation.as_matrix()
+
+
+def score_fit(probe_positions, grid, params):
+    x, y, z, rx, ry, rz = params
+
+    rotation_matrix: np.ndarray = get_rotation_matrix(rx, ry, rz)
+    transformed_positions = transform_positions(
+        probe_positions,
         [x, y, z],
         rotation_matrix
     )
 
-    vals = []
-    n = 0
-    for model in structure_copy:
-        for chain in model:
-            for residue in chain:
-                for atom in residue:
-                    if atom.element.name != "H":
-                        vals.append(
-                            grid.interpolate_value(
-                                atom.pos
-                            )
-                        )
-                        n = n + 1
-
-    positive_score = sum([1 if val > 0.5 else 0 for val in vals])
-    penalty = sum([-1 if val < -0.0 else 0 for val in vals])
+    vals = np.array([grid.interpolate_value(gemmi.Position(*pos)) for pos in transformed_positions])
+    n = len(vals)
+
+    positive_score = np.sum(vals > 0.5)
+    penalty = -np.sum(vals < -0.0)
     score = (positive_score + penalty) / n
 
     # return 1 - (sum([1 if val > 2.0 else 0 for val in vals ]) / n)
     return 1-score
 
 
-def get_probe_structure(structure):
-    structure_clone = structure.clone()
-    structure_clone.remove_hydrogens()
-
-    j = 0
-    verticies = {}
-    for model in structure:
-        for chain in model:
-            for residue in chain:
-                for atom_1 in residue:
-                    # print(atom_1.element.name)
-                    if atom_1.element.name != "H":
-                        verticies[j] = atom_1
-                        j = j + 1
-    edges = {}
-    for atom_1_index in verticies:
-        for atom_2_index in verticies:
-            if atom_1_index == atom_2_index:
-                continue
-            atom_1 = verticies[atom_1_index]
-            atom_2 = verticies[atom_2_index]
-            pos_1 = atom_1.pos
-            pos_2 = atom_2.pos
-            distance = pos_1.dist(pos_2)
-            if distance < 2.0:
-                virtual_atom = gemmi.Atom()
-                new_pos = gemmi.Position(
-                    (pos_1.x + pos_2.x) / 2,
-                    (pos_1.y + pos_2.y) / 2,
-                    (pos_1.z + pos_2.z) / 2,
-
-                )
-                atom_symbol: str = "C"
-                virtual_atom.name = atom_symbol
-                gemmi_element: gemmi.Element = gemmi.Element(atom_symbol)
-                virtual_atom.element = gemmi_element
-                virtual_atom.pos = new_pos
-
-                if atom_1_index < atom_2_index:
-                    edges[(atom_1_index, atom_2_index)] = virtual_atom
-
-                else:
-                    edges[(atom_2_index, atom_1_index)] = virtual_atom
+def get_probe_positions(heavy_positions: np.ndarray) -> np.ndarray:
+    # The heavy atoms, with a virtual atom at the midpoint of each bond
+    return np.concatenate([heavy_positions, get_bond_midpoints(heavy_positions, 2.0)], axis=0)
 
-    for model in structure_clone:
-        for chain in model:
-            for residue in chain:
-                for edge_index in edges:
-                    virtual_atom = edges[edge_index]
-                    residue.add_atom(virtual_atom)
 
-    # print(f"Number of real atoms: {len(verticies)}")
-    # print(f"Number of virtual atoms: {len(edges)}")
-    return structure_clone
-
-
-def score_conformer(cluster: Cluster, conformer, zmap_grid, debug=False):
+def score_conformer(cluster: Cluster, conformer_positions, conformer_elements, zmap_grid, debug=False):
     # Center the conformer at the cluster
     centroid_cart = cluster.centroid
 
     if debug:
         print(f"\t\t\t\tCartesian centroid of event is: {centroid_cart}")
 
-    centered_structure = center_structure(
-        conformer,
-        centroid_cart,
-    )
+    centered_positions = conformer_positions - np.mean(conformer_positions, axis=0) + np.array(centroid_cart)
 
-    # Get the probe structure
-    probe_structure = get_probe_structure(centered_structure)
+    # Get the probe
+    probe_positions = get_probe_positions(centered_positions[conformer_elements != "H"])
 
     if debug:
-        print(f"\t\t\t\tprobe structure: {probe_structure}")
+        print(f"\t\t\t\tprobe positions: {probe_positions.shape}")
 
     # Optimise
     if debug:
@@ -389,7 +378,7 @@ def score_conformer(cluster: Cluster, conformer, zmap_grid, debug=False):
 
     res = optimize.differential_evolution(
         lambda params: score_fit(
-            probe_structure,
+            probe_positions,
             zmap_grid,
             params
         ),
@@ -422,17 +411,9 @@ def score_conformer(cluster: Cluster, conformer, zmap_grid, debug=False):
 
     # Get optimised fit
     x, y, z, rx, ry, rz = res.x
-    rotation = spsp.transform.Rotation.from_euler(
-        "xyz",
-        [
-            rx*360,
-            ry*360,
-            rz*360,
-        ],
-        degrees=True)
-    rotation_matrix: np.ndarray = rotation.as_matrix()
-    optimised_structure = transform_structure(
-        probe_structure,
+    rotation_matrix: np.ndarray = get_rotation_matrix(rx, ry, rz)
+    optimised_positions = transform_positions(
+        probe_positions,
         [x, y, z],
         rotation_matrix
     )
@@ -450,8 +431,8 @@ def score_conformer(cluster: Cluster, conformer, zmap_grid, debug=False):
     # )
     # score = float(res.fun) / (int(cluster.values.size) + 1)
 
-    score, log = EXPERIMENTAL_score_structure_signal_to_noise_density(
-        optimised_structure,
+    score, log = EXPERIMENTAL_score_loci_signal_to_noise_density(
+        get_loci_array(optimised_positions),
         zmap_grid,
     )
 
@@ -471,8 +452,14 @@ def score_fragment_conformers(cluster, fragment_conformers, zmap_grid, debug=Fal
     if debug:
         print(f"\t\t\t\tScoring conformers")
     scores = {}
-    for conformer_id, conformer in fragment_conformers.items():
-        scores[conformer_id] = score_conformer(cluster, conformer, zmap_grid, debug)
+    for conformer_id in range(len(fragment_conformers)):
+        scores[conformer_id] = score_conformer(
+            cluster,
+            fragment_conformers.positions[conformer_id],
+            fragment_conformers.elements,
+            zmap_grid,
+            debug,
+        )
 
     if debug:
         print(f"\t\t\t\tConformer scores are: {scores}")
@@ -492,10 +479,13 @@ def score_clusters(
         clusters: Dict[Tuple[int, int], Cluster],
         zmaps,
         fragment_dataset,
-        debug=False):
-    if debug:
-        print(f"\t\t\tGetting fragment conformers...")
-    fragment_conformers = get_conformers(fragment_dataset, debug=debug)
+        debug=False,
+        fragment_conformers: Optional[Conformers] = None,
+):
+    if fragment_conformers is None:
+        if debug:
+            print(f"\t\t\tGetting fragment conformers...")
+        fragment_conformers = ConformerCache(None).get(fragment_dataset, debug=debug)
 
     scores = {}
 
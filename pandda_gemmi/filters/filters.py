@@ -1,9 +1,12 @@
-from pandda_gemmi.dataset import Reference, Datasets
-from pandda_gemmi.edalignment import Alignment
+import typing
 
+from pandda_gemmi.common import Dtag
+from pandda_gemmi.dataset import Datasets
+from pandda_gemmi.edalignment import AlignmentResult
 
-def remove_models_with_large_gaps(datasets, reference: Reference):
-    new_dtags = filter(lambda dtag: Alignment.has_large_gap(reference, datasets.datasets[dtag]),
+
+def remove_models_with_large_gaps(datasets, alignment_results: typing.Dict[Dtag, AlignmentResult]):
+    new_dtags = filter(lambda dtag: alignment_results[dtag].alignment is not None,
                        datasets.datasets,
                        )
 
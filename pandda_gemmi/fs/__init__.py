@@ -1 +1,3 @@
-from pandda_gemmi.fs.fs import PanDDAFSModel, ShellDirs, MeanMapFile, StdMapFile, ProcessedDataset
\ No newline at end of file
+from pandda_gemmi.fs.fs import PanDDAFSModel, ShellDirs, MeanMapFile, StdMapFile, ProcessedDataset
+from pandda_gemmi.fs.map_store import MapStore
+from pandda_gemmi.fs.writer import BackgroundWriter, get_writer
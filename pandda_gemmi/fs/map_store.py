@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import typing
+import dataclasses
+from pathlib import Path
+
+import fire
+
+from pandda_gemmi.constants import *
+from pandda_gemmi.python_types import *
+
+
+@dataclasses.dataclass()
+class MapStore:
+    path: Path
+    compression: str = ARGS_MAP_COMPRESSION_DEFAULT
+    chunk_size: int = 32
+
+    @staticmethod
+    def from_dir(path: Path,
+                 compression: str = ARGS_MAP_COMPRESSION_DEFAULT,
+                 ):
+        return MapStore(path / PANDDA_MAP_STORE_FILE, compression)
+
+    def get_compression(self):
+        if self.compression == "zstd":
+            import hdf5plugin
+            return hdf5plugin.Zstd()
+        elif self.compression == "blosc":
+            import hdf5plugin
+            return hdf5plugin.Blosc(cname="zstd", clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE)
+        elif self.compression == "gzip":
+            return {"compression": "gzip", "compression_opts": 4}
+        elif self.compression == "none":
+            return {}
+        else:
+            raise Exception(f"Map store compression was somehow set to the invalid value: {self.compression}")
+
+    def save_ccp4(self, name: str, ccp4, quantisation_step: float = 0.0):
+        import h5py
+
+        array = np.array(ccp4.grid, copy=False)
+        mode = ccp4.header_i32(4)
+
+        # Round maps to multiples of the quantisation step
+        attrs = {}
+        if quantisation_step > 0.0:
+            data = np.clip(np.round(array / quantisation_step), -32767, 32767).astype(np.int16)
+            attrs["quantisation_step"] = quantisation_step
+        else:
+            data = np.asarray(array, order="C")
+
+        if data.size == 0:
+            chunks = None
+        elif data.ndim == 1:
+            chunks = True
+        else:
+            chunks = tuple(min(self.chunk_size, size) for size in data.shape)
+
+        with h5py.File(str(self.path), "a") as f:
+            if name in f:
+                del f[name]
+            dataset = f.create_dataset(
+                name,
+                data=data,
+                chunks=chunks,
+                **(self.get_compression() if chunks else {}),
+            )
+            dataset.attrs["mode"] = mode
+            dataset.attrs["origin"] = [ccp4.header_i32(5), ccp4.header_i32(6), ccp4.header_i32(7)]
+            dataset.attrs["cell_grid"] = [ccp4.header_i32(8), ccp4.header_i32(9), ccp4.header_i32(10)]
+            dataset.attrs["unit_cell"] = [
+                ccp4.grid.unit_cell.a,
+                ccp4.grid.unit_cell.b,
+                ccp4.grid.unit_cell.c,
+                ccp4.grid.unit_cell.alpha,
+                ccp4.grid.unit_cell.beta,
+                ccp4.grid.unit_cell.gamma,
+            ]
+            dataset.attrs["spacegroup"] = ccp4.grid.spacegroup.xhm()
+            for key, value in attrs.items():
+                dataset.attrs[key] = value
+
+    def load_ccp4(self, name: str):
+        import h5py
+
+        with h5py.File(str(self.path), "r") as f:
+            dataset = f[name]
+            data = dataset[()]
+            attrs = dict(dataset.attrs)
+
+        if "quantisation_step" in attrs:
+            array = data.astype(np.float32) * float(attrs["quantisation_step"])
+        else:
+            array = data
+
+        mode = int(attrs["mode"])
+        if mode == 0:
+            ccp4 = gemmi.Ccp4Mask()
+            grid = gemmi.Int8Grid(*array.shape)
+        else:
+            ccp4 = gemmi.Ccp4Map()
+            grid = gemmi.FloatGrid(*array.shape)
+        grid.spacegroup = gemmi.find_spacegroup_by_name(str(attrs["spacegroup"]))
+        grid.set_unit_cell(gemmi.UnitCell(*[float(x) for x in attrs["unit_cell"]]))
+        grid_array = np.array(grid, copy=False)
+        grid_array[:, :, :] = array[:, :, :]
+
+        ccp4.grid = grid
+        ccp4.update_ccp4_header(mode, True)
+
+        # Restore the position of cropped maps in the cell
+        for j, (origin, cell_grid) in enumerate(zip(attrs["origin"], attrs["cell_grid"])):
+            ccp4.set_header_i32(5 + j, int(origin))
+            ccp4.set_header_i32(8 + j, int(cell_grid))
+
+        return ccp4
+
+    def keys(self) -> typing.List[str]:
+        import h5py
+
+        with h5py.File(str(self.path), "r") as f:
+            return list(f.keys())
+
+    def export_ccp4(self, out_dir: Path, names: typing.Optional[typing.List[str]] = None) -> typing.List[Path]:
+        out_dir = Path(out_dir)
+        if names is None:
+            names = self.keys()
+
+        paths = []
+        for name in names:
+            path = out_dir / name
+            self.load_ccp4(name).write_ccp4_map(str(path))
+            paths.append(path)
+
+        return paths
+
+
+def export_ccp4(map_store_path: str, out_dir: typing.Optional[str] = None, *names: str):
+    map_store_path = Path(map_store_path)
+    if out_dir is None:
+        out_dir = map_store_path.parent
+
+    paths = MapStore(map_store_path).export_ccp4(
+        Path(out_dir),
+        list(names) if len(names) > 0 else None,
+    )
+
+    for path in paths:
+        print(path)
+
+
+if __name__ == "__main__":
+    fire.Fire(export_ccp4)
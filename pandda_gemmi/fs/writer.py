@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+import os
+import json
+import queue
+import atexit
+import threading
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+from pandda_gemmi.constants import *
+
+
+def write_log(log: Dict, log_path: Path):
+    if log_path.exists():
+        os.remove(log_path)
+
+    with open(log_path, "w") as f:
+        json.dump(log, f, indent=4)
+
+
+# Owns the file output of a process. Writes are run on a single thread from a bounded queue, so producers block
+# rather than accumulate unwritten maps, and log updates are held until the next flush.
+class BackgroundWriter:
+    def __init__(self, max_pending: int = IO_WRITER_MAX_PENDING):
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.pending_logs: Dict[Path, Dict] = {}
+        self.errors: List[Exception] = []
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            task = self.queue.get()
+            try:
+                if task is None:
+                    return
+                func, args, kwargs = task
+                func(*args, **kwargs)
+            except Exception as e:
+                with self.lock:
+                    self.errors.append(e)
+            finally:
+                self.queue.task_done()
+
+    def submit(self, func: Callable, *args: Any, **kwargs: Any):
+        self.queue.put((func, args, kwargs))
+
+    def update_log(self, log: Dict, log_path: Path):
+        # The latest state of the log is dumped on flush
+        with self.lock:
+            self.pending_logs[log_path] = log
+
+    def flush_logs(self):
+        with self.lock:
+            pending_logs = self.pending_logs
+            self.pending_logs = {}
+
+        for log_path, log in pending_logs.items():
+            # Serialise now so later changes to the log do not race the write
+            self.submit(write_log, json.loads(json.dumps(log)), log_path)
+
+    def flush(self):
+        self.flush_logs()
+        self.queue.join()
+
+        with self.lock:
+            errors = self.errors
+            self.errors = []
+
+        if len(errors) > 0:
+            raise errors[0]
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+
+_writer: Optional[BackgroundWriter] = None
+_writer_pid: Optional[int] = None
+
+
+def get_writer() -> BackgroundWriter:
+    global _writer
+    global _writer_pid
+
+    # Forked workers must not share the parent's thread
+    if _writer is None or _writer_pid != os.getpid():
+        _writer = BackgroundWriter()
+        _writer_pid = os.getpid()
+
+    return _writer
+
+
+@atexit.register
+def _flush_writer():
+    if _writer is not None and _writer_pid == os.getpid():
+        _writer.close()
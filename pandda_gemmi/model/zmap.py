@@ -418,7 +418,7 @@ class Model:
 
         return term1 + np.sum(term2 + term3, axis=0)  # 1 + m
 
-    def save_maps(self, pandda_dir: Path, shell: Shell, grid: Grid, p1: bool = True):
+    def save_maps(self, pandda_dir: Path, shell: Shell, grid: Grid, p1: bool = True, writer=None):
         # Mean map
         mean_array = self.mean
 
@@ -436,9 +436,13 @@ class Model:
         else:
             ccp4.grid.symmetrize_max()
         ccp4.update_ccp4_header(2, True)
-        ccp4.write_ccp4_map(str(pandda_dir / PANDDA_MEAN_MAP_FILE.format(number=shell.number,
-                                                                         res=shell.res_min.resolution,
-                                                                         )))
+        mean_map_path = pandda_dir / PANDDA_MEAN_MAP_FILE.format(number=shell.number,
+                                                                 res=shell.res_min.resolution,
+                                                                 )
+        if writer is not None:
+            writer.submit(ccp4.write_ccp4_map, str(mean_map_path))
+        else:
+            ccp4.write_ccp4_map(str(mean_map_path))
 
         # sigma_s_m map
         sigma_s_m_array = self.sigma_s_m
@@ -456,10 +460,13 @@ class Model:
         else:
             ccp4.grid.symmetrize_max()
         ccp4.update_ccp4_header(2, True)
-        ccp4.write_ccp4_map(str(pandda_dir / PANDDA_SIGMA_S_M_FILE.format(
-            number=shell.number,
-                                                                          res=shell.res_min.resolution,
-                                                                          )))
+        sigma_s_m_map_path = pandda_dir / PANDDA_SIGMA_S_M_FILE.format(number=shell.number,
+                                                                       res=shell.res_min.resolution,
+                                                                       )
+        if writer is not None:
+            writer.submit(ccp4.write_ccp4_map, str(sigma_s_m_map_path))
+        else:
+            ccp4.write_ccp4_map(str(sigma_s_m_map_path))
 
 
 @dataclasses.dataclass()
@@ -556,7 +563,7 @@ class Zmap:
     def unit_cell(self):
         return self.zmap.unit_cell
 
-    def save(self, path: Path, p1: bool = True):
+    def save(self, path: Path, p1: bool = True, writer=None):
         ccp4 = gemmi.Ccp4Map()
         ccp4.grid = self.zmap
         if p1:
@@ -564,13 +571,13 @@ class Zmap:
         else:
             ccp4.grid.symmetrize_max()
         ccp4.update_ccp4_header(2, True)
-        ccp4.write_ccp4_map(str(path))
-
-    def __getstate__(self):
-        return XmapPython.from_gemmi(self.zmap)
+        if writer is not None:
+            writer.submit(ccp4.write_ccp4_map, str(path))
+        else:
+            ccp4.write_ccp4_map(str(path))
 
-    def __setstate__(self, zmap_pyhton: XmapPython):
-        self.zmap = zmap_pyhton.to_gemmi()
+    def __reduce__(self):
+        return Zmap, (self.zmap,)
 
 
 @dataclasses.dataclass()
@@ -1,12 +1,14 @@
 from __future__ import annotations
 
 import os
+from pathlib import Path
 from typing import *
 import time
 from time import sleep
 from functools import partial
-import pickle
 import secrets
+import weakref
+import itertools
 
 from dask.distributed import progress
 import numpy as np
@@ -21,11 +23,12 @@ import gemmi
 import ray
 
 from pandda_gemmi import constants
+from pandda_gemmi import serialisation
 from pandda_gemmi.common import Dtag, Partial
-from pandda_gemmi.dataset import StructureFactors, Dataset, Datasets, Resolution
-from pandda_gemmi.fs import PanDDAFSModel
+from pandda_gemmi.dataset import StructureFactors, Dataset, Datasets, Resolution, Reference
+from pandda_gemmi.fs import PanDDAFSModel, MapStore, BackgroundWriter
 from pandda_gemmi.shells import Shell
-from pandda_gemmi.edalignment import Alignment, Grid, Xmap, Partitioning
+from pandda_gemmi.edalignment import Alignment, Grid, Xmap, Partitioning, NativeSamplingPlan
 from pandda_gemmi.model import Model, Zmap
 from pandda_gemmi.event import Event
 
@@ -162,13 +165,73 @@ def process_local_dask(funcs: List[Partial], client=None):
     return results
 
 
+# Objects which are never modified once built, so may be put in the ray object store once and then shared by every
+# later task for as long as they are alive
+RAY_SHARED_TYPES = (Grid, Reference, Model, Xmap)
+RAY_SHARED_REFS: Dict[int, Tuple[weakref.ref, ray.ObjectRef]] = {}
+
+
+def get_ray_shared_ref(arg):
+    arg_id = id(arg)
+    if arg_id in RAY_SHARED_REFS:
+        return RAY_SHARED_REFS[arg_id][1]
+
+    ref = ray.put(arg)
+    RAY_SHARED_REFS[arg_id] = (weakref.ref(arg, lambda _: RAY_SHARED_REFS.pop(arg_id, None)), ref)
+    return ref
+
+
+def get_ray_task_refs(funcs):
+    # Arguments given to more than one task are put in the object store once rather than serialised with each task
+    arg_counts = {}
+    for f in funcs:
+        for arg in itertools.chain(f.args, f.kwargs.values()):
+            arg_counts[id(arg)] = arg_counts.get(id(arg), 0) + 1
+
+    refs = {}
+    for f in funcs:
+        for arg in itertools.chain(f.args, f.kwargs.values()):
+            arg_id = id(arg)
+            if arg_id in refs:
+                continue
+            if isinstance(arg, RAY_SHARED_TYPES):
+                refs[arg_id] = get_ray_shared_ref(arg)
+            elif arg_counts[arg_id] > 1 and not isinstance(arg, (str, int, float, bool, type(None), ray.ObjectRef)):
+                refs[arg_id] = ray.put(arg)
+
+    return refs
+
+
 def process_local_ray(funcs):
     assert ray.is_initialized() == True
-    tasks = [f.func.remote(*f.args, **f.kwargs) for f in funcs]
+    refs = get_ray_task_refs(funcs)
+    tasks = [
+        f.func.remote(
+            *[refs.get(id(arg), arg) for arg in f.args],
+            **{key: refs.get(id(arg), arg) for key, arg in f.kwargs.items()},
+        )
+        for f
+        in funcs
+    ]
     results = ray.get(tasks)
     return results
 
 
+def get_ray_object_store_memory():
+    if not ray.is_initialized():
+        return None
+
+    # Used is the part of the capacity the resource API does not report as available
+    capacity = ray.cluster_resources().get("object_store_memory", 0.0)
+    available = ray.available_resources().get("object_store_memory", 0.0)
+    return {
+        "Capacity": capacity,
+        "Used": capacity - available,
+        "Available": available,
+        "Shared objects": len(RAY_SHARED_REFS),
+    }
+
+
 def process_shell_dask(funcs: List[Partial]):
     from dask.distributed import worker_client
 
@@ -331,17 +394,14 @@ class Run:
         self.input_file = input_file
         self.output_file = output_file
 
-        with open(input_file, 'wb') as f:
-            pickle.dump(func, f)
+        serialisation.dump(func, input_file)
 
     def __call__(self):
-        with open(self.input_file, 'rb') as f:
-            f = pickle.load(f)
+        f = serialisation.load(self.input_file)
 
         result = f()
 
-        with open(self.output_file, "wb") as f:
-            pickle.dump(result, f)
+        serialisation.dump(result, self.output_file)
 
         return self.output_file
 
@@ -387,8 +447,7 @@ def process_global_dask(
     # Load all the pickled results
     results_loaded = []
     for result in results:
-        with open(result, 'rb') as f:
-            results_loaded.append(pickle.load(f))
+        results_loaded.append(serialisation.load(result))
 
     for run_func in run_funcs:
         run_func.clean()
@@ -1979,13 +2038,8 @@ def truncate(datasets: Dict[Dtag, Dataset], resolution: Resolution, structure_fa
     # truncate on reflections
     new_datasets_reflections = {}
     for dtag in dataset_resolution_truncated:
-        reflections = dataset_resolution_truncated[dtag].reflections.reflections
-        reflections_array = np.array(reflections)
-
         truncated_dataset = dataset_resolution_truncated[dtag].truncate_reflections(common_reflections,
                                                                                     )
-        reflections = truncated_dataset.reflections.reflections
-        reflections_array = np.array(reflections)
 
         new_datasets_reflections[dtag] = truncated_dataset
 
@@ -2032,6 +2086,7 @@ def save_native_frame_zmap(
         mask_radius_symmetry: float,
         partitioning: Partitioning,
         sample_rate: float,
+        writer: Optional[BackgroundWriter] = None,
 ):
     reference_frame_zmap_grid = zmap.zmap
     # reference_frame_zmap_grid_array = np.array(reference_frame_zmap_grid, copy=True)
@@ -2060,7 +2115,56 @@ def save_native_frame_zmap(
     ccp4.grid = event_map_grid.xmap
     ccp4.update_ccp4_header(2, True)
     ccp4.setup()
-    ccp4.write_ccp4_map(str(path))
+    if writer is not None:
+        writer.submit(ccp4.write_ccp4_map, str(path))
+    else:
+        ccp4.write_ccp4_map(str(path))
+
+
+def save_native_frame_maps(
+        paths,
+        reference_frame_grids: List[gemmi.FloatGrid],
+        native_sampling_plan: NativeSamplingPlan,
+        fractional_boxes: Optional[List[Tuple[np.ndarray, np.ndarray]]] = None,
+        map_store: Optional[MapStore] = None,
+        quantisation_steps: Optional[List[float]] = None,
+        writer: Optional[BackgroundWriter] = None,
+):
+    # Only sample the native points that will be written
+    if fractional_boxes is not None:
+        native_sampling_plan = native_sampling_plan.crop(fractional_boxes)
+
+    native_frame_xmaps = native_sampling_plan.interpolate(reference_frame_grids)
+
+    for j, (path, native_frame_xmap) in enumerate(zip(paths, native_frame_xmaps)):
+        ccp4 = gemmi.Ccp4Map()
+        ccp4.grid = native_frame_xmap.xmap
+        ccp4.update_ccp4_header(2, True)
+        ccp4.setup()
+
+        if fractional_boxes is not None:
+            box_minimum, box_maximum = fractional_boxes[j]
+            box = gemmi.FractionalBox()
+            box.extend(gemmi.Fractional(*box_minimum))
+            box.extend(gemmi.Fractional(*box_maximum))
+            ccp4.set_extent(box)
+            ccp4.update_ccp4_header(2, True)
+
+        if map_store is not None:
+            write_func = partial(
+                map_store.save_ccp4,
+                Path(path).name,
+                ccp4,
+                quantisation_steps[j] if quantisation_steps is not None else 0.0,
+            )
+        else:
+            write_func = partial(ccp4.write_ccp4_map, str(path))
+
+        # Hand the write off so the caller can continue with the next map
+        if writer is not None:
+            writer.submit(write_func)
+        else:
+            write_func()
 
 
 def save_reference_frame_zmap(path,
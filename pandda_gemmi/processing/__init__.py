@@ -1,2 +1,4 @@
 from pandda_gemmi.processing.processing import process_shell, ShellResult
-from pandda_gemmi.processing.process_multiple_models import process_shell_multiple_models, analyse_model, analyse_model_ray
+from pandda_gemmi.processing.process_multiple_models import process_shell_multiple_models, analyse_model, analyse_model_ray, \
+    score_model_events, score_model_events_ray, process_shells_task_graph
+from pandda_gemmi.processing.task_graph import GraphTask, TaskGraph
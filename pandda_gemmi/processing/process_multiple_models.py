@@ -8,6 +8,7 @@ from functools import partial
 import os
 import json
 from typing import Set
+from pathlib import Path
 import pickle
 
 printer = pprint.PrettyPrinter()
@@ -23,19 +24,24 @@ from pandda_gemmi.logs import (
 from pandda_gemmi import constants
 from pandda_gemmi.pandda_functions import (
     process_local_serial,
+    get_ray_object_store_memory,
     truncate,
     save_native_frame_zmap,
+    save_native_frame_maps,
     save_reference_frame_zmap,
 )
 from pandda_gemmi.python_types import *
 from pandda_gemmi.common import Dtag, EventID, Partial
-from pandda_gemmi.fs import PanDDAFSModel, MeanMapFile, StdMapFile
+from pandda_gemmi.fs import PanDDAFSModel, ProcessedDataset, MeanMapFile, StdMapFile, MapStore, get_writer
 from pandda_gemmi.dataset import (StructureFactors, Dataset, Datasets,
                                   Resolution, )
 from pandda_gemmi.shells import Shell, ShellMultipleModels
-from pandda_gemmi.edalignment import Partitioning, Xmap, XmapArray, Grid, from_unaligned_dataset_c
+from pandda_gemmi.edalignment import Partitioning, PartitioningCache, Alignment, Xmap, XmapArray, Grid, \
+    NativeSamplingPlan, from_unaligned_dataset_c
 from pandda_gemmi.model import Zmap, Model, Zmaps
-from pandda_gemmi.event import Event, Clusterings, Clustering, Events, get_event_mask_indicies, score_clusters
+from pandda_gemmi.event import Event, Clusterings, Clustering, Events, get_event_mask_indicies, score_clusters, \
+    get_event_map_reference_grid, ConformerCache
+from pandda_gemmi.processing.task_graph import GraphTask, TaskGraph
 
 
 @dataclasses.dataclass()
@@ -166,6 +172,7 @@ def event_score_and_report(
         min_bdc, max_bdc,
         reference,
         debug=True,
+        fragment_conformers=None,
 ):
     # Get the events and their BDCs
     if debug:
@@ -198,9 +205,8 @@ def event_score_and_report(
     inner_mask = gemmi.Int8Grid(*[grid.grid.nu, grid.grid.nv, grid.grid.nw])
     inner_mask.spacegroup = gemmi.find_spacegroup_by_name("P 1")
     inner_mask.set_unit_cell(grid.grid.unit_cell)
-    for atom in reference.dataset.structure.protein_atoms():
-        pos = atom.pos
-        inner_mask.set_points_around(pos,
+    for pos in reference.dataset.structure.arrays().protein_positions:
+        inner_mask.set_points_around(gemmi.Position(*pos),
                                      radius=2.0,
                                      value=1,
                                      )
@@ -257,6 +263,7 @@ def event_score_and_report(
             {(0, 0): event_map_reference_grid},
             processed_dataset,
             debug=debug,
+            fragment_conformers=fragment_conformers,
         )
         time_scoring_finish = time.time()
         if debug:
@@ -393,6 +400,96 @@ def EXPERIMENTAL_select_model(
     return selected_model_number, log
 
 
+def get_model_statistics(zmap: Zmap, clusterings_large: Clusterings, grid: Grid, contour_level: float):
+    grid_voxel_volume = grid.volume() / grid.size()
+
+    zmap_array = zmap.to_array(copy=False)
+    zmap_outlier_size = int(np.sum(zmap_array[grid.partitioning.total_mask == 1] > contour_level))
+
+    large_cluster_volumes = [
+        float(cluster.size(grid))
+        for clustering in clusterings_large.clusterings.values()
+        for cluster in clustering.clustering.values()
+    ]
+
+    return {
+        'zmap_outlier_volume': zmap_outlier_size * grid_voxel_volume,
+        'num_large_clusters': len(large_cluster_volumes),
+        'large_cluster_volume': sum(large_cluster_volumes),
+        'max_large_cluster_volume': max(large_cluster_volumes + [0.0, ]),
+    }
+
+
+def prune_models(model_statistics: Dict[int, Dict], top_k: int):
+    log = {}
+
+    # Models without large clusters have no events to score
+    candidates = []
+    for model_number, statistics in model_statistics.items():
+        if statistics['num_large_clusters'] == 0:
+            log[model_number] = "Pruned: no large clusters"
+        else:
+            candidates.append(model_number)
+
+    # A model is dominated if another has an event at least as large from no more outlying density
+    undominated = []
+    for model_number in candidates:
+        statistics = model_statistics[model_number]
+        dominators = [
+            other_model_number
+            for other_model_number
+            in candidates
+            if (other_model_number != model_number)
+               and (model_statistics[other_model_number]['max_large_cluster_volume']
+                    >= statistics['max_large_cluster_volume'])
+               and (model_statistics[other_model_number]['zmap_outlier_volume']
+                    <= statistics['zmap_outlier_volume'])
+               and ((model_statistics[other_model_number]['max_large_cluster_volume']
+                     > statistics['max_large_cluster_volume'])
+                    or (model_statistics[other_model_number]['zmap_outlier_volume']
+                        < statistics['zmap_outlier_volume']))
+        ]
+        if len(dominators) > 0:
+            log[model_number] = f"Pruned: dominated by model {dominators[0]}"
+        else:
+            undominated.append(model_number)
+
+    # Keep the models with the largest events, preferring quieter maps
+    ranked = sorted(
+        undominated,
+        key=lambda _model_number: (
+            -model_statistics[_model_number]['max_large_cluster_volume'],
+            model_statistics[_model_number]['zmap_outlier_volume'],
+        )
+    )
+    if top_k > 0:
+        survivors = ranked[:top_k]
+    else:
+        survivors = ranked
+
+    for rank, model_number in enumerate(ranked):
+        if model_number in survivors:
+            log[model_number] = f"Survived: rank {rank}"
+        else:
+            log[model_number] = f"Pruned: rank {rank} outside top {top_k}"
+
+    return survivors, log
+
+
+def get_selectable_model_results(model_results: Dict[int, Dict], surviving_model_numbers: List[int]):
+    if len(surviving_model_numbers) > 0:
+        return {
+            model_number: model_results[model_number] for model_number in surviving_model_numbers
+        }
+
+    # If nothing survives pruning every model can still be selected, with no scored events
+    return {
+        model_number: {**model_result, 'event_scores': {}}
+        for model_number, model_result
+        in model_results.items()
+    }
+
+
 #
 # def select_model(model_results: Dict[int, Dict], grid):
 #     model_scores = {}
@@ -586,6 +683,47 @@ def EXPERIMENTAL_select_model(
 #     # return selected_model
 
 
+def get_model(
+        test_dtags,
+        comparison_set_dtags: List[Dtag],
+        masked_xmap_array: XmapArray,
+        grid: Grid,
+        process_local,
+):
+    # Get the relevant dtags' xmaps
+    masked_train_characterisation_xmap_array: XmapArray = masked_xmap_array.from_dtags(
+        comparison_set_dtags)
+    masked_train_all_xmap_array: XmapArray = masked_xmap_array.from_dtags(
+        comparison_set_dtags + [test_dtag for test_dtag in test_dtags])
+
+    mean_array: np.ndarray = Model.mean_from_xmap_array(masked_train_characterisation_xmap_array,
+                                                        )  # Size of grid.partitioning.total_mask > 0
+    # dataset_log[constants.LOG_DATASET_MEAN] = summarise_array(mean_array)
+    # update_log(dataset_log, dataset_log_path)
+
+    sigma_is: Dict[Dtag, float] = Model.sigma_is_from_xmap_array(masked_train_all_xmap_array,
+                                                                 mean_array,
+                                                                 1.5,
+                                                                 )  # size of n
+    # dataset_log[constants.LOG_DATASET_SIGMA_I] = {_dtag.dtag: float(sigma_i) for _dtag, sigma_i in sigma_is.items()}
+    # update_log(dataset_log, dataset_log_path)
+
+    sigma_s_m: np.ndarray = Model.sigma_sms_from_xmaps(masked_train_characterisation_xmap_array,
+                                                       mean_array,
+                                                       sigma_is,
+                                                       process_local,
+                                                       )  # size of total_mask > 0
+    # dataset_log[constants.LOG_DATASET_SIGMA_S] = summarise_array(sigma_s_m)
+    # update_log(dataset_log, dataset_log_path)
+
+    return Model.from_mean_is_sms(
+        mean_array,
+        sigma_is,
+        sigma_s_m,
+        grid,
+    )
+
+
 def get_models(
         test_dtags,
         comparison_sets: Dict[int, List[Dtag]],
@@ -600,41 +738,13 @@ def get_models(
 
     models = {}
     for comparison_set_id, comparison_set_dtags in comparison_sets.items():
-        # comparison_set_dtags =
-
-        # Get the relevant dtags' xmaps
-        masked_train_characterisation_xmap_array: XmapArray = masked_xmap_array.from_dtags(
-            comparison_set_dtags)
-        masked_train_all_xmap_array: XmapArray = masked_xmap_array.from_dtags(
-            comparison_set_dtags + [test_dtag for test_dtag in test_dtags])
-
-        mean_array: np.ndarray = Model.mean_from_xmap_array(masked_train_characterisation_xmap_array,
-                                                            )  # Size of grid.partitioning.total_mask > 0
-        # dataset_log[constants.LOG_DATASET_MEAN] = summarise_array(mean_array)
-        # update_log(dataset_log, dataset_log_path)
-
-        sigma_is: Dict[Dtag, float] = Model.sigma_is_from_xmap_array(masked_train_all_xmap_array,
-                                                                     mean_array,
-                                                                     1.5,
-                                                                     )  # size of n
-        # dataset_log[constants.LOG_DATASET_SIGMA_I] = {_dtag.dtag: float(sigma_i) for _dtag, sigma_i in sigma_is.items()}
-        # update_log(dataset_log, dataset_log_path)
-
-        sigma_s_m: np.ndarray = Model.sigma_sms_from_xmaps(masked_train_characterisation_xmap_array,
-                                                           mean_array,
-                                                           sigma_is,
-                                                           process_local,
-                                                           )  # size of total_mask > 0
-        # dataset_log[constants.LOG_DATASET_SIGMA_S] = summarise_array(sigma_s_m)
-        # update_log(dataset_log, dataset_log_path)
-
-        model: Model = Model.from_mean_is_sms(
-            mean_array,
-            sigma_is,
-            sigma_s_m,
+        models[comparison_set_id] = get_model(
+            test_dtags,
+            comparison_set_dtags,
+            masked_xmap_array,
             grid,
+            process_local,
         )
-        models[comparison_set_id] = model
 
     return models
 
@@ -653,6 +763,7 @@ def analyse_model(
         cluster_cutoff_distance_multiplier,
         min_blob_volume,
         min_blob_z_peak,
+        score_events=True,
         debug=False
 ):
     if debug:
@@ -823,22 +934,29 @@ def analyse_model(
     #     pandda_fs_model
     # )
 
-    if debug:
-        print("\t\tScoring events...")
-    event_scores: Dict[int, float] = event_score_and_report(
-        test_dtag,
-        model_number,
-        dataset_processed_dataset,
-        dataset_xmap,
-        clusterings_large,
-        model,
-        grid,
-        dataset_alignment,
-        max_site_distance_cutoff,
-        min_bdc, max_bdc,
-        reference,
-        debug=debug
-    )
+    # Get the cheap statistics used to prune models before scoring
+    model_statistics = get_model_statistics(zmaps[test_dtag], clusterings_large, grid, contour_level)
+    model_log[constants.LOG_DATASET_MODEL_STATISTICS] = model_statistics
+
+    if score_events:
+        if debug:
+            print("\t\tScoring events...")
+        event_scores: Dict[int, float] = event_score_and_report(
+            test_dtag,
+            model_number,
+            dataset_processed_dataset,
+            dataset_xmap,
+            clusterings_large,
+            model,
+            grid,
+            dataset_alignment,
+            max_site_distance_cutoff,
+            min_bdc, max_bdc,
+            reference,
+            debug=debug
+        )
+    else:
+        event_scores = None
 
     time_model_analysis_finish = time.time()
 
@@ -849,6 +967,7 @@ def analyse_model(
         'clusterings_peaked': clusterings_peaked,
         'clusterings_merged': clusterings_merged,
         'event_scores': event_scores,
+        'model_statistics': model_statistics,
     }
     model_log["Model analysis time"] = time_model_analysis_finish - time_model_analysis_start
     if debug:
@@ -873,6 +992,7 @@ def analyse_model_ray(
         cluster_cutoff_distance_multiplier,
         min_blob_volume,
         min_blob_z_peak,
+        score_events=True,
         debug=False
 ):
     return analyse_model(
@@ -890,9 +1010,75 @@ def analyse_model_ray(
         cluster_cutoff_distance_multiplier,
         min_blob_volume,
         min_blob_z_peak,
+        score_events,
         debug
     )
 
+
+def score_model_events(
+        model,
+        model_number,
+        clusterings_large,
+        test_dtag,
+        dataset_xmap,
+        reference,
+        grid,
+        dataset_processed_dataset,
+        dataset_alignment,
+        max_site_distance_cutoff,
+        min_bdc, max_bdc,
+        debug=False,
+        fragment_conformers=None,
+):
+    return event_score_and_report(
+        test_dtag,
+        model_number,
+        dataset_processed_dataset,
+        dataset_xmap,
+        clusterings_large,
+        model,
+        grid,
+        dataset_alignment,
+        max_site_distance_cutoff,
+        min_bdc, max_bdc,
+        reference,
+        debug=debug,
+        fragment_conformers=fragment_conformers,
+    )
+
+
+@ray.remote
+def score_model_events_ray(
+        model,
+        model_number,
+        clusterings_large,
+        test_dtag,
+        dataset_xmap,
+        reference,
+        grid,
+        dataset_processed_dataset,
+        dataset_alignment,
+        max_site_distance_cutoff,
+        min_bdc, max_bdc,
+        debug=False,
+        fragment_conformers=None,
+):
+    return score_model_events(
+        model,
+        model_number,
+        clusterings_large,
+        test_dtag,
+        dataset_xmap,
+        reference,
+        grid,
+        dataset_processed_dataset,
+        dataset_alignment,
+        max_site_distance_cutoff,
+        min_bdc, max_bdc,
+        debug,
+        fragment_conformers,
+    )
+
 def dump_and_load(ob, name):
     print(f"Testing: {name}")
 
@@ -922,11 +1108,11 @@ def dump_and_load(ob, name):
 def process_dataset_multiple_models(
         test_dtag,
         models,
-        shell: ShellMultipleModels,
-        dataset_truncated_datasets,
-        alignments,
-        dataset_xmaps,
-        pandda_fs_model: PanDDAFSModel,
+        dataset_truncated_dataset: Dataset,
+        dataset_alignment: Alignment,
+        dataset_xmap: Xmap,
+        dataset_processed_dataset: ProcessedDataset,
+        pandda_dir: Path,
         reference,
         grid,
         contour_level,
@@ -941,14 +1127,24 @@ def process_dataset_multiple_models(
         sample_rate,
         statmaps,
         analyse_model_func,
+        score_events_func,
+        model_selection_top_k,
+        crop_event_maps,
+        event_map_margin,
+        map_output_format,
+        map_compression,
+        zmap_quantisation_step,
         process_local=process_local_serial,
+        flush_writes=True,
         debug=False,
 ):
     if debug:
         print(f'\tProcessing dtag: {test_dtag}')
     time_dataset_start = time.time()
 
-    dataset_log_path = pandda_fs_model.processed_datasets.processed_datasets[test_dtag].log_path
+    writer = get_writer()
+
+    dataset_log_path = dataset_processed_dataset.log_path
     dataset_log = {}
     dataset_log["Model analysis time"] = {}
 
@@ -960,11 +1156,11 @@ def process_dataset_multiple_models(
     # analyse_model_paramaterised = partial(
     #     analyse_model,
     #     test_dtag=test_dtag,
-    #     dataset_xmap=dataset_xmaps[test_dtag],
+    #     dataset_xmap=dataset_xmap,
     #     reference=reference,
     #     grid=grid,
-    #     dataset_processed_dataset=pandda_fs_model.processed_datasets[test_dtag],
-    #     dataset_alignment=alignments[test_dtag],
+    #     dataset_processed_dataset=dataset_processed_dataset,
+    #     dataset_alignment=dataset_alignment,
     #     max_site_distance_cutoff=max_site_distance_cutoff,
     #     min_bdc=min_bdc, max_bdc=max_bdc,
     #     contour_level=contour_level,
@@ -992,17 +1188,18 @@ def process_dataset_multiple_models(
                 model,
                 model_number,
                 test_dtag=test_dtag,
-                dataset_xmap=dataset_xmaps[test_dtag],
+                dataset_xmap=dataset_xmap,
                 reference=reference,
                 grid=grid,
-                dataset_processed_dataset=pandda_fs_model.processed_datasets[test_dtag],
-                dataset_alignment=alignments[test_dtag],
+                dataset_processed_dataset=dataset_processed_dataset,
+                dataset_alignment=dataset_alignment,
                 max_site_distance_cutoff=max_site_distance_cutoff,
                 min_bdc=min_bdc, max_bdc=max_bdc,
                 contour_level=contour_level,
                 cluster_cutoff_distance_multiplier=cluster_cutoff_distance_multiplier,
                 min_blob_volume=min_blob_volume,
                 min_blob_z_peak=min_blob_z_peak,
+                score_events=False,
                 debug=debug
             )
             for model_number, model
@@ -1012,6 +1209,58 @@ def process_dataset_multiple_models(
     model_results = {model_number: result[0] for model_number, result in zip(models, results)}
     dataset_log["Model logs"] = {model_number: result[1] for model_number, result in zip(models, results)}  #
 
+    ###################################################################
+    # # Prune the models on their cheap statistics...
+    ###################################################################
+    surviving_model_numbers, model_pruning_log = prune_models(
+        {model_number: model_result['model_statistics'] for model_number, model_result in model_results.items()},
+        model_selection_top_k,
+    )
+    dataset_log[constants.LOG_DATASET_MODEL_PRUNING] = {
+        int(model_number): decision for model_number, decision in model_pruning_log.items()
+    }
+
+    if debug:
+        print(f"\tModels surviving pruning: {surviving_model_numbers}")
+
+    ###################################################################
+    # # ...and score the events of those that survive
+    ###################################################################
+    time_model_scoring_start = time.time()
+
+    # The ligand conformers are the same for every model and event, so get them once per dataset
+    fragment_conformers = ConformerCache.from_dir(pandda_dir).get(
+        dataset_processed_dataset,
+        debug=debug,
+    )
+
+    event_scores = process_local(
+        [
+            Partial(
+                score_events_func,
+                models[model_number],
+                model_number,
+                model_results[model_number]['clusterings_large'],
+                test_dtag=test_dtag,
+                dataset_xmap=dataset_xmap,
+                reference=reference,
+                grid=grid,
+                dataset_processed_dataset=dataset_processed_dataset,
+                dataset_alignment=dataset_alignment,
+                max_site_distance_cutoff=max_site_distance_cutoff,
+                min_bdc=min_bdc, max_bdc=max_bdc,
+                debug=debug,
+                fragment_conformers=fragment_conformers,
+            )
+            for model_number
+            in surviving_model_numbers
+        ]
+    )
+    for model_number, model_event_scores in zip(surviving_model_numbers, event_scores):
+        model_results[model_number]['event_scores'] = model_event_scores
+    time_model_scoring_finish = time.time()
+    dataset_log[constants.LOG_DATASET_MODEL_SCORING_TIME] = time_model_scoring_finish - time_model_scoring_start
+
     time_model_analysis_finish = time.time()
 
     dataset_log["Time to analyse all models"] = time_model_analysis_finish - time_model_analysis_start
@@ -1025,7 +1274,7 @@ def process_dataset_multiple_models(
     # dump_and_load(dataset_xmaps[test_dtag], "xmap")
     # dump_and_load(reference, "reference")
     # dump_and_load(grid, "grid")
-    # dump_and_load(pandda_fs_model.processed_datasets[test_dtag], "processed_dataset")
+    # dump_and_load(dataset_processed_dataset, "processed_dataset")
     # dump_and_load(alignments, "alignments")
     # # dump_and_load(alignments, "func")
     # dump_and_load([model for model in models.values()][0], "model")
@@ -1044,10 +1293,11 @@ def process_dataset_multiple_models(
     ###################################################################
     if debug:
         print(f"\tSelecting model...")
+    selectable_model_results = get_selectable_model_results(model_results, surviving_model_numbers)
     selected_model_number, model_selection_log = EXPERIMENTAL_select_model(
-        model_results,
+        selectable_model_results,
         grid.partitioning.inner_mask,
-        pandda_fs_model.processed_datasets[test_dtag],
+        dataset_processed_dataset,
         debug=debug,
     )
     selected_model = models[selected_model_number]
@@ -1059,95 +1309,6 @@ def process_dataset_multiple_models(
     if debug:
         print(f'\tSelected model is: {selected_model_number}')
 
-    ###################################################################
-    # # Output the z map
-    ###################################################################
-    time_output_zmap_start = time.time()
-
-    native_grid = dataset_truncated_datasets[test_dtag].reflections.reflections.transform_f_phi_to_map(
-        structure_factors.f,
-        structure_factors.phi,
-        # sample_rate=sample_rate,  # TODO: make this d_min/0.5?
-        sample_rate=dataset_truncated_datasets[test_dtag].reflections.resolution().resolution / 0.5
-    )
-
-    partitioning = Partitioning.from_structure_multiprocess(
-        dataset_truncated_datasets[test_dtag].structure,
-        native_grid,
-        outer_mask,
-        inner_mask_symmetry,
-    )
-    # pandda_fs_model.processed_datasets.processed_datasets[dtag].z_map_file.save_reference_frame_zmap(zmap)
-
-    save_native_frame_zmap(
-        pandda_fs_model.processed_datasets.processed_datasets[test_dtag].z_map_file.path,
-        zmap,
-        dataset_truncated_datasets[test_dtag],
-        alignments[test_dtag],
-        grid,
-        structure_factors,
-        outer_mask,
-        inner_mask_symmetry,
-        partitioning,
-        sample_rate,
-    )
-
-    # TODO: Remove altogether
-    # if debug:
-    #     for model_number, model_result in model_results.items():
-    #         save_reference_frame_zmap(
-    #             pandda_fs_model.processed_datasets.processed_datasets[
-    #                 test_dtag].z_map_file.path.parent / f'{model_number}_ref.ccp4',
-    #                 model_result['zmap']
-    #         )
-    #         save_native_frame_zmap(
-    #             pandda_fs_model.processed_datasets.processed_datasets[
-    #                 test_dtag].z_map_file.path.parent / f'{model_number}_native.ccp4',
-    #             model_result['zmap'],
-    #             dataset_truncated_datasets[test_dtag],
-    #             alignments[test_dtag],
-    #             grid,
-    #             structure_factors,
-    #             outer_mask,
-    #             inner_mask_symmetry,
-    #             partitioning,
-    #             sample_rate,
-    #         )
-
-    if statmaps:
-        mean_map_file = MeanMapFile.from_zmap_file(
-            pandda_fs_model.processed_datasets.processed_datasets[test_dtag].z_map_file)
-        mean_map_file.save_native_frame_mean_map(
-            selected_model,
-            zmap,
-            dataset_truncated_datasets[test_dtag],
-            alignments[test_dtag],
-            grid,
-            structure_factors,
-            outer_mask,
-            inner_mask_symmetry,
-            partitioning,
-            sample_rate,
-        )
-
-        std_map_file = StdMapFile.from_zmap_file(pandda_fs_model.processed_datasets.processed_datasets[
-                                                     test_dtag].z_map_file)
-        std_map_file.save_native_frame_std_map(
-            test_dtag,
-            selected_model,
-            zmap,
-            dataset_truncated_datasets[test_dtag],
-            alignments[test_dtag],
-            grid,
-            structure_factors,
-            outer_mask,
-            inner_mask_symmetry,
-            partitioning,
-            sample_rate,
-        )
-    time_output_zmap_finish = time.time()
-    dataset_log['Time to output z map'] = time_output_zmap_finish - time_output_zmap_start
-
     ###################################################################
     # # Find the events
     ###################################################################
@@ -1156,9 +1317,9 @@ def process_dataset_multiple_models(
     events: Events = Events.from_clusters(
         selected_model_clusterings,
         selected_model,
-        dataset_xmaps,
+        {test_dtag: dataset_xmap},
         grid,
-        alignments[test_dtag],
+        dataset_alignment,
         max_site_distance_cutoff,
         min_bdc, max_bdc,
         None,
@@ -1166,37 +1327,118 @@ def process_dataset_multiple_models(
 
     time_event_finish = time.time()
     dataset_log[constants.LOG_DATASET_EVENT_TIME] = time_event_finish - time_event_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     ###################################################################
-    # # Generate event maps
+    # # Get the native frame sampling plan
     ###################################################################
-    time_event_map_start = time.time()
+    time_sampling_plan_start = time.time()
 
-    # Save the event maps!
-    # printer.pprint(events)
-    events.save_event_maps(
-        dataset_truncated_datasets,
-        alignments,
-        dataset_xmaps,
-        selected_model,
-        pandda_fs_model,
-        grid,
-        structure_factors,
+    native_grid = dataset_truncated_dataset.reflections.reflections.transform_f_phi_to_map(
+        structure_factors.f,
+        structure_factors.phi,
+        # sample_rate=sample_rate,  # TODO: make this d_min/0.5?
+        sample_rate=dataset_truncated_dataset.reflections.resolution().resolution / 0.5
+    )
+
+    partitioning_arrays = PartitioningCache.from_dir(pandda_dir).get_arrays(
+        dataset_truncated_dataset.structure,
+        native_grid,
         outer_mask,
         inner_mask_symmetry,
-        sample_rate,
+    )
+
+    native_sampling_plan = NativeSamplingPlan.from_partitioning_arrays(
         native_grid,
-        mapper=process_local_serial,
+        dataset_alignment,
+        grid,
+        partitioning_arrays,
     )
 
+    time_sampling_plan_finish = time.time()
+    dataset_log[constants.LOG_DATASET_NATIVE_SAMPLING_PLAN_TIME] = time_sampling_plan_finish - time_sampling_plan_start
+
+    ###################################################################
+    # # Output the z map, statistical maps and event maps
+    ###################################################################
+    time_event_map_start = time.time()
+
+    if map_output_format == "hdf5":
+        map_store = MapStore.from_dir(dataset_processed_dataset.path, map_compression)
+    else:
+        map_store = None
+
+    native_frame_map_paths = [dataset_processed_dataset.z_map_file.path, ]
+    reference_frame_grids = [zmap.zmap, ]
+    quantisation_steps = [zmap_quantisation_step, ]
+
+    if statmaps:
+        native_frame_map_paths.append(MeanMapFile.from_zmap_file(dataset_processed_dataset.z_map_file).path)
+        reference_frame_grids.append(Zmap.grid_from_grid_template(zmap.zmap, selected_model.mean))
+        quantisation_steps.append(0.0)
+
+        native_frame_map_paths.append(StdMapFile.from_zmap_file(dataset_processed_dataset.z_map_file).path)
+        reference_frame_grids.append(
+            Zmap.grid_from_grid_template(
+                zmap.zmap,
+                np.sqrt(np.square(selected_model.sigma_s_m) + np.square(selected_model.sigma_is[test_dtag])),
+            )
+        )
+        quantisation_steps.append(0.0)
+
+    event_map_paths = []
+    event_map_reference_frame_grids = []
+    event_map_boxes = []
+    for event_id, event in events.events.items():
+        dataset_processed_dataset.event_map_files.add_event(event)
+        event_map_paths.append(dataset_processed_dataset.event_map_files[event_id.event_idx].path)
+        event_map_reference_frame_grids.append(
+            get_event_map_reference_grid(dataset_xmap, selected_model, event)
+        )
+        if crop_event_maps:
+            event_map_boxes.append(
+                native_sampling_plan.get_fractional_box(event.native_positions, event_map_margin)
+            )
+
+    if crop_event_maps:
+        save_native_frame_maps(
+            native_frame_map_paths,
+            reference_frame_grids,
+            native_sampling_plan,
+            map_store=map_store,
+            quantisation_steps=quantisation_steps,
+            writer=writer,
+        )
+        if len(event_map_paths) > 0:
+            save_native_frame_maps(
+                event_map_paths,
+                event_map_reference_frame_grids,
+                native_sampling_plan,
+                event_map_boxes,
+                map_store=map_store,
+                writer=writer,
+            )
+    else:
+        save_native_frame_maps(
+            native_frame_map_paths + event_map_paths,
+            reference_frame_grids + event_map_reference_frame_grids,
+            native_sampling_plan,
+            map_store=map_store,
+            quantisation_steps=quantisation_steps + [0.0 for _ in event_map_paths],
+            writer=writer,
+        )
+
     time_event_map_finish = time.time()
     dataset_log[constants.LOG_DATASET_EVENT_MAP_TIME] = time_event_map_finish - time_event_map_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     time_dataset_finish = time.time()
     dataset_log[constants.LOG_DATASET_TIME] = time_dataset_finish - time_dataset_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
+
+    # Datasets processed in other processes must be on disk before their results are returned
+    if flush_writes:
+        writer.flush()
 
     return DatasetResult(
         dtag=test_dtag.dtag,
@@ -1205,6 +1447,18 @@ def process_dataset_multiple_models(
     )
 
 
+def check_dataset_task_payload(dataset_task: partial):
+    payload_size = len(pickle.dumps(dataset_task.keywords))
+    xmap_size = dataset_task.keywords["dataset_xmap"].to_array().nbytes
+    print(
+        f"\tTask payload for {dataset_task.args[0].dtag}: {payload_size} bytes of dataset data and "
+        f"{len(pickle.dumps(dataset_task.func))} bytes shared with the shell"
+    )
+    assert payload_size < constants.DATASET_TASK_MAX_PAYLOAD_XMAPS * xmap_size, \
+        f"Task for {dataset_task.args[0].dtag} carries {payload_size} bytes of dataset data: more than its own " \
+        f"xmap of {xmap_size} bytes can account for"
+
+
 def process_shell_multiple_models(
         shell: ShellMultipleModels,
         datasets: Dict[Dtag, Dataset],
@@ -1228,6 +1482,13 @@ def process_shell_multiple_models(
         statmaps,
         load_xmap_func,
         analyse_model_func,
+        score_events_func,
+        model_selection_top_k,
+        crop_event_maps,
+        event_map_margin,
+        map_output_format,
+        map_compression,
+        zmap_quantisation_step,
         debug=False,
 ):
     if debug:
@@ -1246,6 +1507,8 @@ def process_shell_multiple_models(
         process_local_in_dataset = process_local_serial
         process_local_over_datasets = process_local
 
+    writer = get_writer()
+
     time_shell_start = time.time()
     shell_log_path = pandda_fs_model.shell_dirs.shell_dirs[shell.res].log_path
     shell_log = {}
@@ -1258,7 +1521,7 @@ def process_shell_multiple_models(
         if dtag in shell.all_dtags
     }
     shell_log[constants.LOG_SHELL_DATASETS] = [dtag.dtag for dtag in shell_datasets]
-    update_log(shell_log, shell_log_path)
+    writer.update_log(shell_log, shell_log_path)
 
     ###################################################################
     # # Homogonise shell datasets by truncation of resolution
@@ -1324,7 +1587,7 @@ def process_shell_multiple_models(
 
     time_xmaps_finish = time.time()
     shell_log[constants.LOG_SHELL_XMAP_TIME] = time_xmaps_finish - time_xmaps_start
-    update_log(shell_log, shell_log_path)
+    writer.update_log(shell_log, shell_log_path)
 
     ###################################################################
     # # Get the models to test
@@ -1347,9 +1610,7 @@ def process_shell_multiple_models(
     process_dataset_paramaterized = Partial(
         process_dataset_multiple_models,
         models=models,
-        shell=shell,
-        alignments=alignments,
-        pandda_fs_model=pandda_fs_model,
+        pandda_dir=pandda_fs_model.pandda_dir,
         reference=reference,
         grid=grid,
         contour_level=contour_level,
@@ -1366,36 +1627,37 @@ def process_shell_multiple_models(
         sample_rate=shell.res / 0.5,
         statmaps=statmaps,
         analyse_model_func=analyse_model_func,
+        score_events_func=score_events_func,
+        model_selection_top_k=model_selection_top_k,
+        crop_event_maps=crop_event_maps,
+        event_map_margin=event_map_margin,
+        map_output_format=map_output_format,
+        map_compression=map_compression,
+        zmap_quantisation_step=zmap_quantisation_step,
         process_local=process_local_in_dataset,
+        flush_writes=process_local_over_datasets != process_local_serial,
         debug=debug,
     )
 
-    # Process each dataset in the shell
-    all_train_dtags_unmerged = [_dtag for l in shell.train_dtags.values() for _dtag in l]
-    all_train_dtags = []
-    for _dtag in all_train_dtags_unmerged:
-        if _dtag not in all_train_dtags:
-            all_train_dtags.append(_dtag)
+    # Process each dataset in the shell, sending each task only the test dataset's own data
+    dataset_tasks = [
+        partial(
+            process_dataset_paramaterized,
+            test_dtag,
+            dataset_truncated_dataset=shell_truncated_datasets[test_dtag],
+            dataset_alignment=alignments[test_dtag],
+            dataset_xmap=xmaps[test_dtag],
+            dataset_processed_dataset=pandda_fs_model.processed_datasets[test_dtag],
+        )
+        for test_dtag
+        in shell.test_dtags
+    ]
 
     if debug:
-        print(f"\tAll train datasets are: {all_train_dtags}")
-    # dataset_dtags = {_dtag:  for _dtag in shell.test_dtags for n in shell.train_dtags}
-    dataset_dtags = {_dtag: [_dtag] + all_train_dtags for _dtag in shell.test_dtags}
-    if debug:
-        print(f"\tDataset dtags are: {dataset_dtags}")
-    results = process_local_over_datasets(
-        [
-            partial(
-                process_dataset_paramaterized,
-                test_dtag,
-                dataset_truncated_datasets={_dtag: shell_truncated_datasets[_dtag] for _dtag in
-                                            dataset_dtags[test_dtag]},
-                dataset_xmaps={_dtag: xmaps[_dtag] for _dtag in dataset_dtags[test_dtag]},
-            )
-            for test_dtag
-            in shell.test_dtags
-        ],
-    )
+        for dataset_task in dataset_tasks:
+            check_dataset_task_payload(dataset_task)
+
+    results = process_local_over_datasets(dataset_tasks)
 
     # Update shell log with dataset results
     shell_log[constants.LOG_SHELL_DATASET_LOGS] = {}
@@ -1403,12 +1665,319 @@ def process_shell_multiple_models(
         if result:
             shell_log[constants.LOG_SHELL_DATASET_LOGS][result.dtag] = result.log
 
+    object_store_memory = get_ray_object_store_memory()
+    if object_store_memory:
+        shell_log[constants.LOG_SHELL_OBJECT_STORE_MEMORY] = object_store_memory
+
     time_shell_finish = time.time()
     shell_log[constants.LOG_SHELL_TIME] = time_shell_finish - time_shell_start
-    update_log(shell_log, shell_log_path)
+    writer.update_log(shell_log, shell_log_path)
+    writer.flush()
 
     return ShellResult(
         shell=shell,
         dataset_results={dtag: result for dtag, result in zip(shell.test_dtags, results) if result},
         log=shell_log,
     )
+
+
+def get_shell_common_reflections(
+        shell_datasets: Dict[Dtag, Dataset],
+        resolution: Resolution,
+        structure_factors: StructureFactors,
+):
+    return Datasets(
+        {
+            dtag: dataset.truncate_resolution(resolution)
+            for dtag, dataset
+            in shell_datasets.items()
+        }
+    ).common_reflections(structure_factors)
+
+
+def truncate_shell_dataset(common_reflections, dataset: Dataset, resolution: Resolution) -> Dataset:
+    return dataset.truncate_resolution(resolution).truncate_reflections(common_reflections)
+
+
+def load_shell_xmap(
+        truncated_dataset: Dataset,
+        alignment: Alignment,
+        load_xmap_func,
+        grid: Grid,
+        structure_factors: StructureFactors,
+        sample_rate: float,
+):
+    return load_xmap_func(
+        truncated_dataset,
+        alignment,
+        grid=grid,
+        structure_factors=structure_factors,
+        sample_rate=sample_rate,
+    )
+
+
+def fit_shell_model(*xmaps, dtags: List[Dtag], test_dtags: List[Dtag], comparison_set_dtags: List[Dtag], grid: Grid):
+    masked_xmap_array = XmapArray.from_xmaps(
+        {dtag: xmap for dtag, xmap in zip(dtags, xmaps)},
+        grid,
+    )
+    return get_model(
+        test_dtags,
+        comparison_set_dtags,
+        masked_xmap_array,
+        grid,
+        process_local_serial,
+    )
+
+
+def process_shell_dataset(
+        dataset_truncated_dataset: Dataset,
+        dataset_xmap: Xmap,
+        *models: Model,
+        test_dtag: Dtag,
+        model_numbers: List[int],
+        dataset_alignment: Alignment,
+        dataset_processed_dataset: ProcessedDataset,
+        process_dataset_func,
+):
+    return process_dataset_func(
+        test_dtag,
+        models={model_number: model for model_number, model in zip(model_numbers, models)},
+        dataset_truncated_dataset=dataset_truncated_dataset,
+        dataset_alignment=dataset_alignment,
+        dataset_xmap=dataset_xmap,
+        dataset_processed_dataset=dataset_processed_dataset,
+    )
+
+
+def write_shell_log(
+        *results: DatasetResult,
+        shell: ShellMultipleModels,
+        shell_dtags: List[Dtag],
+        shell_working_resolution: Resolution,
+        shell_log_path: Path,
+        time_shells_start: float,
+):
+    writer = get_writer()
+
+    shell_log = {}
+    shell_log[constants.LOG_SHELL_DATASETS] = [dtag.dtag for dtag in shell_dtags]
+    shell_log["Shell Working Resolution"] = shell_working_resolution.resolution
+
+    # Update shell log with dataset results
+    shell_log[constants.LOG_SHELL_DATASET_LOGS] = {}
+    for result in results:
+        if result:
+            shell_log[constants.LOG_SHELL_DATASET_LOGS][result.dtag] = result.log
+
+    # Shells overlap in the graph, so this is the time from the start of the graph to the shell's last dataset
+    shell_log[constants.LOG_SHELL_TIME] = time.time() - time_shells_start
+    writer.update_log(shell_log, shell_log_path)
+    writer.flush()
+
+    return ShellResult(
+        shell=shell,
+        dataset_results={dtag: result for dtag, result in zip(shell.test_dtags, results) if result},
+        log=shell_log,
+    )
+
+
+def process_shells_task_graph(
+        shells: Dict[float, ShellMultipleModels],
+        datasets: Dict[Dtag, Dataset],
+        alignments,
+        grid,
+        pandda_fs_model: PanDDAFSModel,
+        reference,
+        structure_factors: StructureFactors,
+        sample_rate: float,
+        contour_level,
+        cluster_cutoff_distance_multiplier,
+        min_blob_volume,
+        min_blob_z_peak,
+        outer_mask,
+        inner_mask_symmetry,
+        max_site_distance_cutoff,
+        min_bdc,
+        max_bdc,
+        statmaps,
+        load_xmap_func,
+        analyse_model_func,
+        score_events_func,
+        model_selection_top_k,
+        crop_event_maps,
+        event_map_margin,
+        map_output_format,
+        map_compression,
+        zmap_quantisation_step,
+        n_jobs=1,
+        method="forkserver",
+        debug=False,
+):
+    time_shells_start = time.time()
+
+    tasks = []
+    for shell_number, (res, shell) in enumerate(shells.items()):
+        if debug:
+            print(f"Adding shell at resolution: {shell.res} to the task graph")
+
+        shell_dtags = [dtag for dtag in datasets if dtag in shell.all_dtags]
+        shell_working_resolution = Resolution(
+            min([datasets[dtag].reflections.resolution().resolution for dtag in shell_dtags]))
+
+        ###################################################################
+        # # Homogonise shell datasets by truncation of resolution
+        ###################################################################
+        common_reflections_key = ("common_reflections", res)
+        tasks.append(
+            GraphTask(
+                common_reflections_key,
+                Partial(
+                    get_shell_common_reflections,
+                    {dtag: datasets[dtag] for dtag in shell_dtags},
+                    shell_working_resolution,
+                    structure_factors,
+                ),
+                [],
+                constants.TASK_GRAPH_COST_COMMON_REFLECTIONS_PER_DATASET * len(shell_dtags),
+                shell_number,
+            )
+        )
+
+        # Each dataset is truncated once, for both its xmap and, if it is a test dataset, its processing
+        for dtag in shell_dtags:
+            tasks.append(
+                GraphTask(
+                    ("truncated", res, dtag),
+                    Partial(
+                        truncate_shell_dataset,
+                        datasets[dtag],
+                        shell_working_resolution,
+                    ),
+                    [common_reflections_key],
+                    constants.TASK_GRAPH_COST_TRUNCATE,
+                    shell_number,
+                )
+            )
+
+        ###################################################################
+        # # Generate aligned Xmaps
+        ###################################################################
+        for dtag in shell_dtags:
+            tasks.append(
+                GraphTask(
+                    ("xmap", res, dtag),
+                    Partial(
+                        load_shell_xmap,
+                        alignments[dtag],
+                        load_xmap_func,
+                        grid=grid,
+                        structure_factors=structure_factors,
+                        sample_rate=shell.res / 0.5,
+                    ),
+                    [("truncated", res, dtag)],
+                    constants.TASK_GRAPH_COST_XMAP,
+                    shell_number,
+                )
+            )
+
+        ###################################################################
+        # # Get the models to test
+        ###################################################################
+        # Each model only waits on the xmaps of its own comparator cluster and the shell's test datasets
+        for model_number, comparison_set_dtags in shell.train_dtags.items():
+            model_dtags = [
+                dtag
+                for dtag
+                in shell_dtags
+                if (dtag in comparison_set_dtags) or (dtag in shell.test_dtags)
+            ]
+            tasks.append(
+                GraphTask(
+                    ("model", res, model_number),
+                    Partial(
+                        fit_shell_model,
+                        dtags=model_dtags,
+                        test_dtags=list(shell.test_dtags),
+                        comparison_set_dtags=list(comparison_set_dtags),
+                        grid=grid,
+                    ),
+                    [("xmap", res, dtag) for dtag in model_dtags],
+                    constants.TASK_GRAPH_COST_MODEL_PER_XMAP * len(model_dtags),
+                    shell_number,
+                )
+            )
+
+        ###################################################################
+        # # Process each test dataset
+        ###################################################################
+        process_dataset_paramaterized = Partial(
+            process_dataset_multiple_models,
+            pandda_dir=pandda_fs_model.pandda_dir,
+            reference=reference,
+            grid=grid,
+            contour_level=contour_level,
+            cluster_cutoff_distance_multiplier=cluster_cutoff_distance_multiplier,
+            min_blob_volume=min_blob_volume,
+            min_blob_z_peak=min_blob_z_peak,
+            structure_factors=structure_factors,
+            outer_mask=outer_mask,
+            inner_mask_symmetry=inner_mask_symmetry,
+            max_site_distance_cutoff=max_site_distance_cutoff,
+            min_bdc=min_bdc,
+            max_bdc=max_bdc,
+            sample_rate=shell.res / 0.5,
+            statmaps=statmaps,
+            analyse_model_func=analyse_model_func,
+            score_events_func=score_events_func,
+            model_selection_top_k=model_selection_top_k,
+            crop_event_maps=crop_event_maps,
+            event_map_margin=event_map_margin,
+            map_output_format=map_output_format,
+            map_compression=map_compression,
+            zmap_quantisation_step=zmap_quantisation_step,
+            process_local=process_local_serial,
+            flush_writes=n_jobs != 1,
+            debug=debug,
+        )
+        model_numbers = list(shell.train_dtags)
+        for test_dtag in shell.test_dtags:
+            tasks.append(
+                GraphTask(
+                    ("dataset", res, test_dtag),
+                    Partial(
+                        process_shell_dataset,
+                        test_dtag=test_dtag,
+                        model_numbers=model_numbers,
+                        dataset_alignment=alignments[test_dtag],
+                        dataset_processed_dataset=pandda_fs_model.processed_datasets[test_dtag],
+                        process_dataset_func=process_dataset_paramaterized,
+                    ),
+                    [("truncated", res, test_dtag), ("xmap", res, test_dtag)] + [
+                        ("model", res, model_number) for model_number in model_numbers
+                    ],
+                    constants.TASK_GRAPH_COST_DATASET_PER_MODEL * len(model_numbers),
+                    shell_number,
+                )
+            )
+
+        tasks.append(
+            GraphTask(
+                ("shell", res),
+                Partial(
+                    write_shell_log,
+                    shell=shell,
+                    shell_dtags=shell_dtags,
+                    shell_working_resolution=shell_working_resolution,
+                    shell_log_path=pandda_fs_model.shell_dirs.shell_dirs[shell.res].log_path,
+                    time_shells_start=time_shells_start,
+                ),
+                [("dataset", res, test_dtag) for test_dtag in shell.test_dtags],
+                constants.TASK_GRAPH_COST_SHELL_LOG,
+                shell_number,
+            )
+        )
+
+    results = TaskGraph.from_tasks(tasks).run(n_jobs=n_jobs, method=method)
+
+    return [results[("shell", res)] for res in shells]
@@ -26,11 +26,11 @@ from pandda_gemmi.pandda_functions import (
 )
 from pandda_gemmi.python_types import *
 from pandda_gemmi.common import Dtag, EventID, Partial
-from pandda_gemmi.fs import PanDDAFSModel, MeanMapFile, StdMapFile
+from pandda_gemmi.fs import PanDDAFSModel, MeanMapFile, StdMapFile, get_writer
 from pandda_gemmi.dataset import (StructureFactors, Dataset, Datasets,
                                   Resolution, )
 from pandda_gemmi.shells import Shell
-from pandda_gemmi.edalignment import Partitioning, Xmap, XmapArray
+from pandda_gemmi.edalignment import Partitioning, PartitioningCache, Xmap, XmapArray
 from pandda_gemmi.model import Zmap, Model, Zmaps
 from pandda_gemmi.event import Event, Clusterings, Clustering, Events, get_event_mask_indicies
 
@@ -49,14 +49,6 @@ class ShellResult:
     log: Dict
 
 
-def update_log(shell_log, shell_log_path):
-    if shell_log_path.exists():
-        os.remove(shell_log_path)
-
-    with open(shell_log_path, "w") as f:
-        json.dump(shell_log, f)
-
-
 def process_dataset(
         test_dtag,
         shell,
@@ -78,13 +70,15 @@ def process_dataset(
         sample_rate,
         statmaps,
         process_local=process_local_serial,
+        flush_writes=False,
 ):
     time_dataset_start = time.time()
+    writer = get_writer()
 
     dataset_log_path = pandda_fs_model.processed_datasets.processed_datasets[test_dtag].log_path
     dataset_log = {}
     dataset_log[constants.LOG_DATASET_TRAIN] = [_dtag.dtag for _dtag in shell.train_dtags[test_dtag]]
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     masked_xmap_array = XmapArray.from_xmaps(
         dataset_xmaps,
@@ -103,14 +97,14 @@ def process_dataset(
     mean_array: np.ndarray = Model.mean_from_xmap_array(masked_train_xmap_array,
                                                         )  # Size of grid.partitioning.total_mask > 0
     dataset_log[constants.LOG_DATASET_MEAN] = summarise_array(mean_array)
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     sigma_is: Dict[Dtag, float] = Model.sigma_is_from_xmap_array(masked_train_xmap_array,
                                                                  mean_array,
                                                                  1.5,
                                                                  )  # size of n
     dataset_log[constants.LOG_DATASET_SIGMA_I] = {_dtag.dtag: float(sigma_i) for _dtag, sigma_i in sigma_is.items()}
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     sigma_s_m: np.ndarray = Model.sigma_sms_from_xmaps(masked_train_xmap_array,
                                                        mean_array,
@@ -118,7 +112,7 @@ def process_dataset(
                                                        process_local,
                                                        )  # size of total_mask > 0
     dataset_log[constants.LOG_DATASET_SIGMA_S] = summarise_array(sigma_s_m)
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     model: Model = Model.from_mean_is_sms(
         mean_array,
@@ -128,7 +122,7 @@ def process_dataset(
     )
     time_model_finish = time.time()
     dataset_log[constants.LOG_DATASET_MODEL_TIME] = time_model_finish - time_model_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     # Calculate z maps
     time_z_maps_start = time.time()
@@ -138,7 +132,7 @@ def process_dataset(
     )
     time_z_maps_finish = time.time()
     dataset_log[constants.LOG_DATASET_Z_MAPS_TIME] = time_z_maps_finish - time_z_maps_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     zmap = zmaps[test_dtag]
 
@@ -149,7 +143,7 @@ def process_dataset(
         sample_rate=dataset_truncated_datasets[test_dtag].reflections.resolution().resolution / 0.5
     )
 
-    partitioning = Partitioning.from_structure_multiprocess(
+    partitioning = PartitioningCache.from_dir(pandda_fs_model.pandda_dir).get(
         dataset_truncated_datasets[test_dtag].structure,
         native_grid,
         outer_mask,
@@ -168,6 +162,7 @@ def process_dataset(
         inner_mask_symmetry,
         partitioning,
         sample_rate,
+        writer=writer,
     )
 
     # for dtag in zmaps:
@@ -268,7 +263,7 @@ def process_dataset(
     # )
     dataset_log[constants.LOG_DATASET_INITIAL_CLUSTERS_NUM] = sum(
         [len(clustering) for clustering in clusterings.clusterings.values()])
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
     cluster_sizes = {}
     for dtag, clustering in clusterings.clusterings.items():
         for cluster_num, cluster in clustering.clustering.items():
@@ -285,7 +280,7 @@ def process_dataset(
         ))
         if j < 10
     }
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     # Filter out small clusters
     clusterings_large: Clusterings = clusterings.filter_size(grid,
@@ -296,7 +291,7 @@ def process_dataset(
     #      zip(clusterings_large.clusterings, clusterings_large.clusterings.values())}))
     dataset_log[constants.LOG_DATASET_LARGE_CLUSTERS_NUM] = sum(
         [len(clustering) for clustering in clusterings_large.clusterings.values()])
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     # Filter out weak clusters (low peak z score)
     clusterings_peaked: Clusterings = clusterings_large.filter_peak(grid,
@@ -306,7 +301,7 @@ def process_dataset(
     #      zip(clusterings_peaked.clusterings, clusterings_peaked.clusterings.values())}))
     dataset_log[constants.LOG_DATASET_PEAKED_CLUSTERS_NUM] = sum(
         [len(clustering) for clustering in clusterings_peaked.clusterings.values()])
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     # Add the event masks
     for clustering_id, clustering in clusterings_peaked.clusterings.items():
@@ -321,7 +316,7 @@ def process_dataset(
     #      zip(clusterings_merged.clusterings, clusterings_merged.clusterings.values())}))
     dataset_log[constants.LOG_DATASET_MERGED_CLUSTERS_NUM] = sum(
         [len(clustering) for clustering in clusterings_merged.clusterings.values()])
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     # Add the event mask
     # for clustering_id, clustering in clusterings_merged.clusterings.items():
@@ -330,7 +325,7 @@ def process_dataset(
 
     time_cluster_finish = time.time()
     dataset_log[constants.LOG_DATASET_CLUSTER_TIME] = time_cluster_finish - time_cluster_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     ###################################################################
     # # Find the events
@@ -350,7 +345,7 @@ def process_dataset(
 
     time_event_finish = time.time()
     dataset_log[constants.LOG_DATASET_EVENT_TIME] = time_event_finish - time_event_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     ###################################################################
     # # Generate event maps
@@ -372,15 +367,20 @@ def process_dataset(
         sample_rate,
         native_grid,
         mapper=process_local_serial,
+        writer=writer,
     )
 
     time_event_map_finish = time.time()
     dataset_log[constants.LOG_DATASET_EVENT_MAP_TIME] = time_event_map_finish - time_event_map_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
 
     time_dataset_finish = time.time()
     dataset_log[constants.LOG_DATASET_TIME] = time_dataset_finish - time_dataset_start
-    update_log(dataset_log, dataset_log_path)
+    writer.update_log(dataset_log, dataset_log_path)
+
+    # Datasets processed in other processes must be on disk before their results are returned
+    if flush_writes:
+        writer.flush()
 
     return DatasetResult(
         dtag=test_dtag.dtag,
@@ -414,6 +414,7 @@ def process_shell(
         load_xmap_func,
 ):
     time_shell_start = time.time()
+    writer = get_writer()
     shell_log_path = pandda_fs_model.shell_dirs.shell_dirs[shell.res].log_path
     shell_log = {}
 
@@ -425,7 +426,7 @@ def process_shell(
         if dtag in shell.all_dtags
     }
     shell_log[constants.LOG_SHELL_DATASETS] = [dtag.dtag for dtag in shell_datasets]
-    update_log(shell_log, shell_log_path)
+    writer.update_log(shell_log, shell_log_path)
 
     ###################################################################
     # # Homogonise shell datasets by truncation of resolution
@@ -472,7 +473,7 @@ def process_shell(
 
     time_xmaps_finish = time.time()
     shell_log[constants.LOG_SHELL_XMAP_TIME] = time_xmaps_finish - time_xmaps_start
-    update_log(shell_log, shell_log_path)
+    writer.update_log(shell_log, shell_log_path)
 
     ###################################################################
     # # Process each test dataset
@@ -508,6 +509,7 @@ def process_shell(
         sample_rate=sample_rate,
         statmaps=statmaps,
         process_local=process_local_in_dataset,
+        flush_writes=process_local_over_datasets != process_local_serial,
     )
 
     # Process each dataset in the shell
@@ -533,7 +535,8 @@ def process_shell(
 
     time_shell_finish = time.time()
     shell_log[constants.LOG_SHELL_TIME] = time_shell_finish - time_shell_start
-    update_log(shell_log, shell_log_path)
+    writer.update_log(shell_log, shell_log_path)
+    writer.flush()
 
     return ShellResult(
         shell=shell,
@@ -0,0 +1,179 @@
+from __future__ import annotations
+
+import heapq
+import dataclasses
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Any, Callable, Dict, Hashable, List
+
+
+@dataclasses.dataclass()
+class GraphTask:
+    key: Hashable
+    func: Callable
+    dependencies: List[Hashable]
+    cost: float
+    group: int = 0
+
+
+def run_graph_task(func: Callable, *dependency_results):
+    return func(*dependency_results)
+
+
+@dataclasses.dataclass()
+class TaskGraph:
+    tasks: Dict[Hashable, GraphTask]
+
+    @staticmethod
+    def from_tasks(tasks: List[GraphTask]) -> TaskGraph:
+        return TaskGraph({task.key: task for task in tasks})
+
+    def dependents(self) -> Dict[Hashable, List[Hashable]]:
+        dependents = {key: [] for key in self.tasks}
+        for key, task in self.tasks.items():
+            for dependency in task.dependencies:
+                if dependency not in self.tasks:
+                    raise Exception(f"Task {key} depends on {dependency}, which is not in the graph")
+                dependents[dependency].append(key)
+        return dependents
+
+    def topological_order(self) -> List[Hashable]:
+        dependents = self.dependents()
+        num_waiting = {key: len(task.dependencies) for key, task in self.tasks.items()}
+        order = [key for key, num in num_waiting.items() if num == 0]
+        for key in order:
+            for dependent in dependents[key]:
+                num_waiting[dependent] -= 1
+                if num_waiting[dependent] == 0:
+                    order.append(dependent)
+
+        if len(order) != len(self.tasks):
+            raise Exception(f"Task graph has a cycle through: {[key for key, num in num_waiting.items() if num > 0]}")
+
+        return order
+
+    def priorities(self) -> Dict[Hashable, float]:
+        # The cost of the most expensive chain of tasks from each task to the end of the graph
+        dependents = self.dependents()
+        priorities = {}
+        for key in reversed(self.topological_order()):
+            priorities[key] = self.tasks[key].cost + max(
+                [priorities[dependent] for dependent in dependents[key]],
+                default=0.0,
+            )
+        return priorities
+
+    def run_ray(self) -> Dict[Hashable, Any]:
+        import ray
+
+        run_graph_task_ray = ray.remote(run_graph_task)
+        dependents = self.dependents()
+        priorities = self.priorities()
+        num_waiting = {key: len(task.dependencies) for key, task in self.tasks.items()}
+        num_consumers = {key: len(dependents[key]) for key in self.tasks}
+
+        # Every task is submitted up front with the ObjectRefs of its dependencies, so ray starts each one as soon as
+        # its own dependencies are done. Submitting in the same order as run lets ray start earlier shells first
+        ready = [
+            (self.tasks[key].group, -priorities[key], number, key)
+            for number, key
+            in enumerate(self.tasks)
+            if num_waiting[key] == 0
+        ]
+        heapq.heapify(ready)
+        numbers = {key: number for number, key in enumerate(self.tasks)}
+
+        refs = {}
+        outputs = {}
+        while ready:
+            _, _, _, key = heapq.heappop(ready)
+            task = self.tasks[key]
+            ref = run_graph_task_ray.remote(task.func, *[refs[dependency] for dependency in task.dependencies])
+            if num_consumers[key] > 0:
+                refs[key] = ref
+            else:
+                outputs[key] = ref
+
+            # Ray keeps intermediate results alive for the tasks that consume them, so the refs here can go once
+            # every consumer has been submitted
+            for dependency in task.dependencies:
+                num_consumers[dependency] -= 1
+                if num_consumers[dependency] == 0:
+                    del refs[dependency]
+
+            for dependent in dependents[key]:
+                num_waiting[dependent] -= 1
+                if num_waiting[dependent] == 0:
+                    heapq.heappush(
+                        ready,
+                        (self.tasks[dependent].group, -priorities[dependent], numbers[dependent], dependent),
+                    )
+
+        return {key: result for key, result in zip(outputs, ray.get(list(outputs.values())))}
+
+    def run(self, n_jobs: int = 1, method: str = "forkserver") -> Dict[Hashable, Any]:
+        if method == "ray":
+            return self.run_ray()
+
+        dependents = self.dependents()
+        priorities = self.priorities()
+        num_waiting = {key: len(task.dependencies) for key, task in self.tasks.items()}
+        num_consumers = {key: len(dependents[key]) for key in self.tasks}
+
+        # Tasks of earlier groups run first, so an earlier shell's models and datasets run and release its xmaps
+        # before a later shell's xmaps pile up. Within a group the longest chain of work goes first
+        ready = [
+            (self.tasks[key].group, -priorities[key], number, key)
+            for number, key
+            in enumerate(self.tasks)
+            if num_waiting[key] == 0
+        ]
+        heapq.heapify(ready)
+        numbers = {key: number for number, key in enumerate(self.tasks)}
+
+        results = {}
+        outputs = {}
+
+        def complete(key, result):
+            if num_consumers[key] > 0:
+                results[key] = result
+            else:
+                outputs[key] = result
+
+            # Intermediate results are released once every task that consumes them has run
+            for dependency in self.tasks[key].dependencies:
+                num_consumers[dependency] -= 1
+                if num_consumers[dependency] == 0:
+                    del results[dependency]
+
+            for dependent in dependents[key]:
+                num_waiting[dependent] -= 1
+                if num_waiting[dependent] == 0:
+                    heapq.heappush(
+                        ready,
+                        (self.tasks[dependent].group, -priorities[dependent], numbers[dependent], dependent),
+                    )
+
+        def get_args(key):
+            task = self.tasks[key]
+            return [task.func] + [results[dependency] for dependency in task.dependencies]
+
+        if n_jobs == 1:
+            while ready:
+                _, _, _, key = heapq.heappop(ready)
+                complete(key, run_graph_task(*get_args(key)))
+            return outputs
+
+        with ProcessPoolExecutor(n_jobs, mp_context=mp.get_context(method)) as executor:
+            running = {}
+            while ready or running:
+                # Only fill free workers, so every submission is the highest priority task ready at that point
+                while ready and len(running) < n_jobs:
+                    _, _, _, key = heapq.heappop(ready)
+                    running[executor.submit(run_graph_task, *get_args(key))] = key
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    complete(running.pop(future), future.result())
+
+        return outputs
@@ -7,6 +7,9 @@ import numpy as np
 
 import gemmi
 
+# Registers the pickle reducers for gemmi's grids, mtzs and structures
+from pandda_gemmi import serialisation
+
 
 @dataclass()
 class SpacegroupPython:
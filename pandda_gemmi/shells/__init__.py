@@ -1,2 +1,3 @@
 from pandda_gemmi.shells.shells import Shell, Shells
 from pandda_gemmi.shells.shells_multiple_models import ShellMultipleModels, ShellsMultipleModels, get_shells_multiple_models
+from pandda_gemmi.shells.shell_planner import ShellCost, ShellCostModel, ShellPlan, get_shells_multiple_models_planned
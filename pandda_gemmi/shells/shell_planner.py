@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import dataclasses
+from typing import *
+
+import numpy as np
+
+from pandda_gemmi import constants
+from pandda_gemmi.common import Dtag
+from pandda_gemmi.dataset import Dataset
+from pandda_gemmi.edalignment import Grid
+from pandda_gemmi.comparators import ComparatorCluster
+from pandda_gemmi.shells.shells_multiple_models import (
+    ShellMultipleModels,
+    get_lowest_valid_res,
+    get_sorted_cluster_dtags,
+    get_shell_train_dtags,
+    get_shell,
+)
+
+
+@dataclasses.dataclass()
+class ShellCost:
+    num_datasets: int
+    num_models: int
+    load_voxels: float
+    model_voxels: float
+    analysis_voxels: float
+    memory: float
+
+    def total(self) -> float:
+        return self.load_voxels + self.model_voxels + self.analysis_voxels
+
+    def to_dict(self) -> Dict:
+        return {
+            "Datasets": self.num_datasets,
+            "Models": self.num_models,
+            "Load and FFT voxels": self.load_voxels,
+            "Model voxels": self.model_voxels,
+            "Analysis voxels": self.analysis_voxels,
+            "Total voxels": self.total(),
+            "Memory (GB)": self.memory / 2 ** 30,
+        }
+
+
+@dataclasses.dataclass()
+class ShellCostModel:
+    fft_voxels: Dict[Dtag, float]
+    grid_voxels: int
+    masked_voxels: int
+
+    @staticmethod
+    def from_datasets(datasets: Dict[Dtag, Dataset], grid: Grid) -> ShellCostModel:
+        return ShellCostModel(
+            {
+                dtag: dataset.reflections.reflections.cell.volume / constants.SHELL_PLAN_FFT_SPACING ** 3
+                for dtag, dataset
+                in datasets.items()
+            },
+            grid.grid.nu * grid.grid.nv * grid.grid.nw,
+            int(np.count_nonzero(grid.partitioning.total_mask)),
+        )
+
+    def cost(self, test_dtags: List[Dtag], train_dtags: Dict[int, List[Dtag]], all_dtags: Set[Dtag]) -> ShellCost:
+        num_models = len(train_dtags)
+
+        # Every dataset in the shell is truncated, FFT'd and sampled onto the reference grid, each model is fit
+        # over its training set and the test datasets, and every test dataset is analysed against every model
+        load_voxels = sum(self.fft_voxels[dtag] + self.grid_voxels for dtag in all_dtags)
+        model_voxels = sum(
+            (len(cluster_dtags) + len(test_dtags)) * self.masked_voxels
+            for cluster_dtags
+            in train_dtags.values()
+        )
+        analysis_voxels = len(test_dtags) * num_models * self.masked_voxels
+
+        # The shell holds all its xmaps, and a mean and standard deviation for each model
+        memory = (len(all_dtags) * self.grid_voxels + 2 * num_models * self.masked_voxels) * \
+                 constants.SHELL_PLAN_BYTES_PER_VOXEL
+
+        return ShellCost(
+            len(all_dtags),
+            num_models,
+            load_voxels,
+            model_voxels,
+            analysis_voxels,
+            memory,
+        )
+
+    def shell_cost(self, shell: ShellMultipleModels) -> ShellCost:
+        return self.cost(shell.test_dtags, shell.train_dtags, shell.all_dtags)
+
+
+@dataclasses.dataclass()
+class ShellPlan:
+    costs: Dict[float, ShellCost]
+
+    @staticmethod
+    def from_shells(shells: Dict[float, ShellMultipleModels], cost_model: ShellCostModel) -> ShellPlan:
+        return ShellPlan({res: cost_model.shell_cost(shell) for res, shell in shells.items()})
+
+    def total(self) -> float:
+        return sum(cost.total() for cost in self.costs.values())
+
+    def num_loads(self) -> int:
+        return sum(cost.num_datasets for cost in self.costs.values())
+
+    def max_memory(self) -> float:
+        return max([cost.memory for cost in self.costs.values()], default=0.0)
+
+    def summary(self) -> Dict:
+        return {
+            "Shells": {float(res): cost.to_dict() for res, cost in self.costs.items()},
+            "Number of shells": len(self.costs),
+            "Xmap loads": self.num_loads(),
+            "Total voxels": self.total(),
+            "Max shell memory (GB)": self.max_memory() / 2 ** 30,
+        }
+
+    def report(self) -> str:
+        lines = [f"\t{'Resolution':>10} {'Datasets':>8} {'Models':>6} {'Total voxels':>14} {'Memory (GB)':>11}"]
+        for res, cost in self.costs.items():
+            lines.append(
+                f"\t{res:>10.3f} {cost.num_datasets:>8} {cost.num_models:>6} {cost.total():>14.4g} "
+                f"{cost.memory / 2 ** 30:>11.2f}"
+            )
+        lines.append(
+            f"\t{len(self.costs)} shells, {self.num_loads()} xmap loads, {self.total():.4g} voxels, at most "
+            f"{self.max_memory() / 2 ** 30:.2f} GB in one shell"
+        )
+        return "\n".join(lines)
+
+
+def get_shells_multiple_models_planned(
+        datasets: Dict[Dtag, Dataset],
+        comparators: Dict[int, ComparatorCluster],
+        min_characterisation_datasets,
+        high_res_increment,
+        only_datasets: Optional[List[str]],
+        cost_model: ShellCostModel,
+        max_shell_memory: Optional[float] = None,
+        debug=False,
+):
+    resolutions = {dtag: datasets[dtag].reflections.resolution().resolution for dtag in datasets}
+    lowest_valid_res = get_lowest_valid_res(resolutions, min_characterisation_datasets)
+    sorted_cluster_dtags = get_sorted_cluster_dtags(comparators)
+
+    test_dtags = [
+        dtag
+        for dtag
+        in datasets
+        if (not only_datasets) or (dtag.dtag in only_datasets)
+    ]
+    if len(test_dtags) == 0 or len(comparators) == 0:
+        return {}
+
+    # Boundaries are placed on a finer step than the increment. Bin 0 holds the test datasets below the lowest valid
+    # resolution, and bin k those in [boundary k - 1, boundary k)
+    step = high_res_increment / constants.SHELL_PLAN_SUBDIVISIONS
+    num_bins = int(np.ceil((max(resolutions[dtag] for dtag in test_dtags) - lowest_valid_res) / step)) + 2
+    boundaries = lowest_valid_res + step * np.arange(num_bins)
+    bins = [[] for _ in range(num_bins)]
+    for dtag in test_dtags:
+        bins[int(np.searchsorted(boundaries, resolutions[dtag], side="right"))].append(dtag)
+
+    # A shell spanning bins i to j keeps every test dataset within one increment of the shell's resolution
+    max_bins_per_shell = constants.SHELL_PLAN_SUBDIVISIONS
+    memory_cap = max_shell_memory * 2 ** 30 if max_shell_memory else None
+
+    train_dtags = {}
+    costs = {}
+
+    def get_segment(i, j):
+        if j not in train_dtags:
+            train_dtags[j] = get_shell_train_dtags(
+                float(boundaries[j]),
+                resolutions,
+                sorted_cluster_dtags,
+                min_characterisation_datasets,
+            )
+        segment_test_dtags = [dtag for bin_dtags in bins[i:j + 1] for dtag in bin_dtags]
+        return segment_test_dtags, train_dtags[j]
+
+    def get_cost(i, j):
+        if (i, j) not in costs:
+            segment_test_dtags, segment_train_dtags = get_segment(i, j)
+            costs[(i, j)] = cost_model.cost(
+                segment_test_dtags,
+                segment_train_dtags,
+                set(segment_test_dtags).union(*segment_train_dtags.values()),
+            )
+        return costs[(i, j)]
+
+    # Choose the shells covering the first j + 1 bins at least cost, given the best plans for fewer bins
+    best = {-1: (0.0, None)}
+    for j in range(num_bins):
+        # Empty bins get no shell, and shells end on a bin with test datasets so their resolution is no lower than
+        # it needs to be
+        if len(bins[j]) == 0:
+            best[j] = (best[j - 1][0], None)
+            continue
+
+        options = []
+        for i in range(max(0, j - max_bins_per_shell + 1), j + 1):
+            cost = get_cost(i, j)
+            # Single bins over the memory cap can not be split any further, so are kept
+            if memory_cap and (cost.memory > memory_cap) and (i < j):
+                continue
+            options.append((best[i - 1][0] + cost.total(), i))
+
+        best[j] = min(options)
+
+    # Walk back through the chosen shells
+    shells = {}
+    j = num_bins - 1
+    while j >= 0:
+        i = best[j][1]
+        if i is None:
+            j = j - 1
+            continue
+
+        res = float(boundaries[j])
+        segment_test_dtags, segment_train_dtags = get_segment(i, j)
+        if memory_cap and (get_cost(i, j).memory > memory_cap):
+            print(f"\tShell at {res} needs {get_cost(i, j).memory / 2 ** 30} GB, more than the shell memory cap")
+        shells[res] = get_shell(res, segment_test_dtags, segment_train_dtags)
+        j = i - 1
+
+    if debug:
+        print(f"\tLowest valid resolution is: {lowest_valid_res}. Planned shells at: {sorted(shells)}")
+
+    return {res: shells[res] for res in sorted(shells)}
@@ -27,6 +27,55 @@ class ShellMultipleModels:
     # res_min: Resolution
 
 
+def get_lowest_valid_res(resolutions: Dict[Dtag, float], min_characterisation_datasets: int) -> float:
+    # Find the minimum resolutioin with enough training data
+    return sorted(resolutions.values())[min_characterisation_datasets + 1]
+
+
+def get_sorted_cluster_dtags(comparators: Dict[int, ComparatorCluster]) -> Dict[int, List[Dtag]]:
+    # Sort dtags by distance to cluster
+    return {
+        cluster_num: sorted(
+            comparator_cluster.dtag_distance_to_cluster,
+            key=lambda _dtag: comparator_cluster.dtag_distance_to_cluster[_dtag]
+        )
+        for cluster_num, comparator_cluster
+        in comparators.items()
+    }
+
+
+def get_shell_train_dtags(
+        res: float,
+        resolutions: Dict[Dtag, float],
+        sorted_cluster_dtags: Dict[int, List[Dtag]],
+        min_characterisation_datasets: int,
+) -> Dict[int, List[Dtag]]:
+    shell_train = {}
+    for cluster_num, sorted_distance_to_cluster in sorted_cluster_dtags.items():
+        shell_train[cluster_num] = []
+
+        # Iterate over dtags, from closest to cluster to furthest, adding those of the right resolution until
+        # comparison set is full
+        for dtag in sorted_distance_to_cluster:
+            if resolutions[dtag] < res:
+                shell_train[cluster_num].append(dtag)
+
+                # If enough datasets for training, exit loop and move onto next cluster
+                if len(shell_train[cluster_num]) >= min_characterisation_datasets:
+                    break
+
+    return shell_train
+
+
+def get_shell(res: float, test_dtags: List[Dtag], train_dtags: Dict[int, List[Dtag]]) -> ShellMultipleModels:
+    return ShellMultipleModels(
+        res,
+        list(test_dtags),
+        train_dtags,
+        set(test_dtags).union(*train_dtags.values()),
+    )
+
+
 def get_shells_multiple_models(
         datasets: Dict[Dtag, Dataset],
         comparators: Dict[int, ComparatorCluster],
@@ -42,45 +91,24 @@ def get_shells_multiple_models(
     # Get the dictionary of resolutions for convenience
     resolutions = {dtag: datasets[dtag].reflections.resolution().resolution for dtag in datasets}
 
-    # Find the minimum resolutioin with enough training data
-    dtags_by_resolution = [ x for x in sorted(resolutions,
-           key=lambda _dtag: resolutions[_dtag])]
-    lowest_valid_res = datasets[dtags_by_resolution[min_characterisation_datasets+1]].reflections.resolution(
-
-    ).resolution
+    lowest_valid_res = get_lowest_valid_res(resolutions, min_characterisation_datasets)
     if debug:
         print(f'\tLowest valid resolution is: {lowest_valid_res}')
 
     # Get the shells: start with the highest res dataset and count up in increments of high_res_increment to the
     # Lowest res dataset
-    # reses = np.arange(min(resolutions.values()), max(resolutions.values()), high_res_increment)
-    # reses = np.arange(min(resolutions.values()), max(resolutions.values()), high_res_increment)
     reses = np.arange(lowest_valid_res, max(resolutions.values()), high_res_increment)
 
-    shells_test = {res: set() for res in reses}
-    shells_train = {res: {} for res in reses}
+    shells_test = {res: [] for res in reses}
 
     # Iterate over comparators, getting the resolution range, the lowest res in it, and then including all
     # in the set of the first shell of sufficiently low res
-    for res in reses:
-        for cluster_num, comparator_cluster in comparators.items():
-            shells_train[res][cluster_num] = []
-
-            # Sort dtags by distance to cluster
-            sorted_distance_to_cluster = sorted(
-                comparator_cluster.dtag_distance_to_cluster,
-                key=lambda _dtag: comparator_cluster.dtag_distance_to_cluster[_dtag]
-                                                )
-
-            # Iterate over dtags, from closest to cluster to furthest, adding those of the right resolution until
-            # comparison set is full
-            for dtag in sorted_distance_to_cluster:
-                if datasets[dtag].reflections.resolution().resolution < res:
-                    shells_train[res][cluster_num].append(dtag)
-
-                    # If enough datasets for training, exit loop and move onto next cluster
-                    if len(shells_train[res][cluster_num]) >= min_characterisation_datasets:
-                        break
+    sorted_cluster_dtags = get_sorted_cluster_dtags(comparators)
+    shells_train = {
+        res: get_shell_train_dtags(res, resolutions, sorted_cluster_dtags, min_characterisation_datasets)
+        for res
+        in reses
+    }
 
     # Add each testing dtag to the appropriate shell
     for dtag in datasets:
@@ -89,47 +117,18 @@ def get_shells_multiple_models(
             if dtag.dtag not in only_datasets:
                 continue
 
-        # Find the first shell whose res is higher
-        dtag_res = datasets[dtag].reflections.resolution().resolution
+        # Find the first shell whose res is higher, making sure they only appear in one shell
         for res in reses:
-            if res > dtag_res:
-                shells_test[res] = shells_test[res].union({dtag, })
-
-                # Make sure they only appear in one shell
+            if res > resolutions[dtag]:
+                shells_test[res].append(dtag)
                 break
 
-    # Create shells
+    # Create shells, leaving out any that are empty
     shells = {}
-    for j, res in enumerate(reses):
-
-        # Collect a set of all dtags
-        all_dtags = set()
-
-        # Add all the test dtags
-        for dtag in shells_test[res]:
-            all_dtags = all_dtags.union({dtag, })
-
-        # Add all the train dtags
-        for cluster_num, cluster_dtags in shells_train[res].items():
-            all_dtags = all_dtags.union(cluster_dtags)
-
-        # Create the shell
-        shell = ShellMultipleModels(
-            res,
-            [x for x in shells_test[res]],
-            shells_train[res],
-            all_dtags,
-        )
-        shells[res] = shell
-
-    # Delete any shells that are empty
-    shells_to_delete = []
     for res in reses:
         if len(shells_test[res]) == 0 or len(shells_train[res]) == 0:
-            shells_to_delete.append(res)
-
-    for res in shells_to_delete:
-        del shells[res]
+            continue
+        shells[res] = get_shell(res, shells_test[res], shells_train[res])
 
     return shells
 
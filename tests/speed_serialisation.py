@@ -0,0 +1,94 @@
+import pickle
+import time
+import tempfile
+from pathlib import Path
+
+import fire
+import numpy as np
+import gemmi
+
+from pandda_gemmi import serialisation
+from pandda_gemmi.python_types import StructurePython, MtzPython, XmapPython
+from pandda_gemmi.dataset import Structure, Reflections
+from pandda_gemmi.edalignment import Xmap
+
+
+def time_round_trip(func, num_repeats):
+    time_start = time.time()
+    for _ in range(num_repeats):
+        func()
+    return (time.time() - time_start) / num_repeats
+
+
+def speed_serialisation(pdb_file, mtz_file, xmap_file=None, num_repeats=10):
+    structure = Structure.from_file(Path(pdb_file))
+    reflections = Reflections.from_file(Path(mtz_file))
+    if xmap_file:
+        xmap = Xmap.from_file(Path(xmap_file))
+    else:
+        xmap = Xmap(
+            gemmi.FloatGrid(
+                np.random.rand(160, 160, 160).astype(np.float32),
+                gemmi.UnitCell(80.0, 80.0, 80.0, 90.0, 90.0, 90.0),
+                gemmi.find_spacegroup_by_name("P 21 21 21"),
+            )
+        )
+
+    tmp_file = Path(tempfile.mkdtemp()) / "speed_serialisation.pickle"
+
+    def file_round_trip(obj):
+        with open(tmp_file, "wb") as f:
+            pickle.dump(obj, f)
+        with open(tmp_file, "rb") as f:
+            return pickle.load(f)
+
+    def serialisation_file_round_trip(obj):
+        serialisation.dump(obj, tmp_file)
+        return serialisation.load(tmp_file)
+
+    # The python types the pipeline previously pickled through, and the objects as they are pickled now
+    benchmarks = {
+        "Structure": (
+            lambda: StructurePython.from_gemmi(structure.structure),
+            lambda python_type: python_type.to_gemmi(),
+            structure,
+        ),
+        "Reflections": (
+            lambda: MtzPython.from_gemmi(reflections.reflections),
+            lambda python_type: python_type.to_gemmi(),
+            reflections,
+        ),
+        "Xmap": (
+            lambda: XmapPython.from_gemmi(xmap.xmap),
+            lambda python_type: python_type.to_gemmi(),
+            xmap,
+        ),
+    }
+
+    for name, (to_python_type, from_python_type, obj) in benchmarks.items():
+        times = {
+            "python types in memory": lambda: from_python_type(pickle.loads(pickle.dumps(to_python_type()))),
+            "protocol 5 in memory": lambda: pickle.loads(pickle.dumps(obj, protocol=5)),
+            "python types through a file": lambda: from_python_type(file_round_trip(to_python_type())),
+            "protocol 5 out of band through a file": lambda: serialisation_file_round_trip(obj),
+        }
+        print(f"{name}:")
+        for description, func in times.items():
+            print(f"\t{description}: {time_round_trip(func, num_repeats)}s")
+
+    # Structures are reduced to a minimal pdb, compared here with packing every atom into one record array
+    def reducer_round_trip(reducer):
+        func, args = reducer(structure.structure)
+        return func(*pickle.loads(pickle.dumps(args, protocol=5)))
+
+    structure_reducers = {
+        "minimal pdb": serialisation.reduce_structure,
+        "packed atom records": serialisation.reduce_structure_records,
+    }
+    print("Structure reducers:")
+    for description, reducer in structure_reducers.items():
+        print(f"\t{description}: {time_round_trip(lambda: reducer_round_trip(reducer), num_repeats)}s")
+
+
+if __name__ == "__main__":
+    fire.Fire(speed_serialisation)
@@ -0,0 +1,93 @@
+import operator
+from pathlib import Path
+from functools import partial
+
+import pytest
+
+from pandda_gemmi.distribution.fscluster import FSCluster, FSFuture, FutureStatus, QueueQueryError
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def get_cluster(output_dir, max_queue_query_failures=10):
+    return FSCluster(
+        "LOCAL",
+        num_workers=2,
+        output_dir=output_dir,
+        poll_interval=0.1,
+        max_poll_interval=0.5,
+        sentinel_grace_period=1.0,
+        max_queue_query_failures=max_queue_query_failures,
+    )
+
+
+def fail_queries(scheduler, num_failures):
+    queued = scheduler.queued
+    calls = []
+
+    def flaky_queued(job_ids, debug=False):
+        calls.append(job_ids)
+        if len(calls) <= num_failures:
+            raise QueueQueryError("socket timed out")
+        return queued(job_ids, debug)
+
+    scheduler.queued = flaky_queued
+
+
+def test_local(tmp_path, monkeypatch):
+    # The workers run the distribution entry point as a script, so need to find the package
+    monkeypatch.setenv("PYTHONPATH", str(REPO_DIR))
+    cluster = get_cluster(tmp_path)
+
+    funcs = [partial(operator.add, 1, 2), partial(operator.mul, 3, 4), partial(max, [5, 7, 6])]
+    assert cluster(funcs) == [3, 12, 7]
+
+
+def test_local_failure(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(REPO_DIR))
+    cluster = get_cluster(tmp_path)
+
+    funcs = [partial(operator.add, 1, 2), partial(operator.truediv, 1, 0)]
+    with pytest.raises(Exception, match="1 out of 2 jobs failed"):
+        cluster(funcs)
+    assert len(list(tmp_path.glob("*.failed"))) == 1
+
+
+def test_sentinel_grace_period(tmp_path):
+    future = FSFuture(
+        "key",
+        tmp_path / "run.sh",
+        tmp_path / "input.pickle",
+        tmp_path / "output.pickle",
+        tmp_path / "key.done",
+        tmp_path / "key.failed",
+        job_id="1",
+    )
+    assert future.status({"1"}) == FutureStatus.RUNNING
+
+    # A job that has left the queue is still running until its sentinel is late by more than the grace period
+    assert future.status(set(), grace_period=60.0) == FutureStatus.RUNNING
+    (tmp_path / "key.done").touch()
+    assert future.status(set(), grace_period=60.0) == FutureStatus.DONE
+
+    (tmp_path / "key.done").unlink()
+    assert future.status(set(), grace_period=0.0) == FutureStatus.FAILED
+
+
+def test_local_queue_query_failures(tmp_path, monkeypatch):
+    # Jobs are not failed because the scheduler could not be asked about them for a while
+    monkeypatch.setenv("PYTHONPATH", str(REPO_DIR))
+    cluster = get_cluster(tmp_path)
+    fail_queries(cluster.scheduler, 3)
+
+    funcs = [partial(sorted, [3, 1, 2]), partial(operator.add, 1, 2)]
+    assert cluster(funcs) == [[1, 2, 3], 3]
+
+
+def test_local_repeated_queue_query_failures(tmp_path, monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(REPO_DIR))
+    cluster = get_cluster(tmp_path, max_queue_query_failures=2)
+    fail_queries(cluster.scheduler, 2)
+
+    with pytest.raises(QueueQueryError):
+        cluster([partial(sorted, [3, 1, 2])])
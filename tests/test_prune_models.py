@@ -0,0 +1,59 @@
+from pandda_gemmi.processing.process_multiple_models import prune_models, get_selectable_model_results
+
+
+def statistics(num_large_clusters, max_large_cluster_volume, zmap_outlier_volume):
+    return {
+        'num_large_clusters': num_large_clusters,
+        'max_large_cluster_volume': max_large_cluster_volume,
+        'zmap_outlier_volume': zmap_outlier_volume,
+    }
+
+
+def test_no_large_clusters():
+    survivors, log = prune_models({0: statistics(0, 0.0, 10.0), 1: statistics(2, 5.0, 20.0)}, 3)
+    assert survivors == [1]
+    assert log[0] == "Pruned: no large clusters"
+
+
+def test_dominated():
+    # Model 1 has a smaller event from more outlying density than model 0
+    survivors, log = prune_models({0: statistics(1, 10.0, 20.0), 1: statistics(1, 5.0, 30.0)}, 3)
+    assert survivors == [0]
+    assert log[1] == "Pruned: dominated by model 0"
+
+
+def test_ties_do_not_dominate():
+    survivors, log = prune_models({0: statistics(1, 10.0, 20.0), 1: statistics(3, 10.0, 20.0)}, 3)
+    assert sorted(survivors) == [0, 1]
+
+
+def test_top_k():
+    # None of these dominate each other: larger events come with noisier maps
+    model_statistics = {
+        model_number: statistics(1, 10.0 * (model_number + 1), 10.0 * (model_number + 1))
+        for model_number
+        in range(5)
+    }
+    survivors, log = prune_models(model_statistics, 2)
+    assert survivors == [4, 3]
+    assert log[2] == "Pruned: rank 2 outside top 2"
+
+    survivors, log = prune_models(model_statistics, 0)
+    assert survivors == [4, 3, 2, 1, 0]
+
+
+def test_nothing_survives():
+    model_statistics = {0: statistics(0, 0.0, 10.0), 1: statistics(0, 0.0, 20.0)}
+    survivors, log = prune_models(model_statistics, 3)
+    assert survivors == []
+    assert set(log) == {0, 1}
+
+    # Every model can still be selected, without scored events
+    model_results = {
+        model_number: {'model_statistics': model_statistics[model_number], 'event_scores': {1: 0.5}}
+        for model_number
+        in model_statistics
+    }
+    selectable_model_results = get_selectable_model_results(model_results, survivors)
+    assert set(selectable_model_results) == {0, 1}
+    assert all(result['event_scores'] == {} for result in selectable_model_results.values())
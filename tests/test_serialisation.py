@@ -0,0 +1,105 @@
+import pickle
+from pathlib import Path
+
+import pytest
+import numpy as np
+import gemmi
+
+from pandda_gemmi import serialisation
+from pandda_gemmi.dataset import Structure, Reflections
+from pandda_gemmi.edalignment import Xmap, Grid, Partitioning
+from pandda_gemmi.model import Zmap
+
+TEST_DATA_DIR = Path(__file__).parent.parent / "_gemmi" / "tests"
+
+
+def round_trips(obj, tmp_path):
+    yield pickle.loads(pickle.dumps(obj, protocol=4))
+    yield pickle.loads(pickle.dumps(obj, protocol=5))
+    serialisation.dump(obj, tmp_path / "obj.pickle")
+    yield serialisation.load(tmp_path / "obj.pickle")
+
+
+def get_float_grid():
+    array = np.asfortranarray(np.random.rand(30, 40, 50).astype(np.float32))
+    return gemmi.FloatGrid(
+        array,
+        gemmi.UnitCell(30.0, 40.0, 50.0, 90.0, 100.0, 90.0),
+        gemmi.find_spacegroup_by_name("P 1 21 1"),
+    )
+
+
+def get_int8_grid():
+    grid = gemmi.Int8Grid(30, 40, 50)
+    grid.spacegroup = gemmi.find_spacegroup_by_name("P 1 21 1")
+    grid.set_unit_cell(gemmi.UnitCell(30.0, 40.0, 50.0, 90.0, 100.0, 90.0))
+    np.array(grid, copy=False)[3:9, 4:7, 1:20] = 1
+    return grid
+
+
+def assert_grids_equal(grid, other):
+    assert type(grid) is type(other)
+    assert np.array_equal(np.array(grid), np.array(other))
+    assert grid.unit_cell.parameters == other.unit_cell.parameters
+    assert grid.spacegroup.xhm() == other.spacegroup.xhm()
+
+
+def test_structure(tmp_path):
+    structure = Structure.from_file(TEST_DATA_DIR / "1orc.pdb")
+    for loaded in round_trips(structure, tmp_path):
+        assert loaded.path == structure.path
+        assert loaded.structure.make_minimal_pdb() == structure.structure.make_minimal_pdb()
+        assert np.array_equal(loaded.arrays().atom_positions, structure.arrays().atom_positions)
+
+
+@pytest.mark.parametrize("file_name", ["4oz7.pdb", "5cvz_final.pdb"])
+def test_structure_records(file_name):
+    structure = gemmi.read_structure(str(TEST_DATA_DIR / file_name))
+    structure.setup_entities()
+    func, args = serialisation.reduce_structure_records(structure)
+    loaded = func(*pickle.loads(pickle.dumps(args, protocol=5)))
+    assert loaded.make_minimal_pdb() == structure.make_minimal_pdb()
+    assert loaded.spacegroup_hm == structure.spacegroup_hm
+    assert loaded.cell.parameters == structure.cell.parameters
+
+
+def test_reflections(tmp_path):
+    reflections = Reflections.from_file(TEST_DATA_DIR / "5e5z.mtz")
+    for loaded in round_trips(reflections, tmp_path):
+        assert loaded.path == reflections.path
+        assert np.array_equal(np.array(loaded.reflections), np.array(reflections.reflections), equal_nan=True)
+        assert loaded.reflections.column_labels() == reflections.reflections.column_labels()
+        assert [column.type for column in loaded.reflections.columns] == \
+               [column.type for column in reflections.reflections.columns]
+        assert loaded.reflections.spacegroup.xhm() == reflections.reflections.spacegroup.xhm()
+        assert loaded.reflections.cell.parameters == reflections.reflections.cell.parameters
+        assert np.isclose(loaded.resolution().resolution, reflections.resolution().resolution)
+
+
+def test_xmap_and_zmap(tmp_path):
+    xmap = Xmap(get_float_grid())
+    for loaded in round_trips(xmap, tmp_path):
+        assert_grids_equal(loaded.xmap, xmap.xmap)
+
+    zmap = Zmap(get_float_grid())
+    for loaded in round_trips(zmap, tmp_path):
+        assert_grids_equal(loaded.zmap, zmap.zmap)
+
+
+def test_grid(tmp_path):
+    mask = get_int8_grid()
+    partitioning = Partitioning(
+        {("A", "1"): {(1, 2, 3): (0.5, 0.25, 1.0), (2, 2, 3): (1.0, 0.25, 1.0)}},
+        mask,
+        mask,
+        None,
+        mask,
+        np.array(mask, copy=True),
+    )
+    grid = Grid(get_float_grid(), partitioning)
+    for loaded in round_trips(grid, tmp_path):
+        assert_grids_equal(loaded.grid, grid.grid)
+        assert loaded.partitioning.partitioning == partitioning.partitioning
+        assert_grids_equal(loaded.partitioning.inner_mask, mask)
+        assert loaded.partitioning.contact_mask is None
+        assert np.array_equal(loaded.partitioning.total_mask, partitioning.total_mask)
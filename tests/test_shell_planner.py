@@ -0,0 +1,112 @@
+import random
+import dataclasses
+
+from pandda_gemmi.common import Dtag
+from pandda_gemmi.comparators import ComparatorCluster
+from pandda_gemmi.shells import (
+    get_shells_multiple_models,
+    get_shells_multiple_models_planned,
+    ShellCostModel,
+    ShellPlan,
+)
+
+HIGH_RES_INCREMENT = 0.05
+MIN_CHARACTERISATION_DATASETS = 25
+
+
+@dataclasses.dataclass()
+class FakeResolution:
+    resolution: float
+
+
+@dataclasses.dataclass()
+class FakeReflections:
+    res: float
+
+    def resolution(self):
+        return FakeResolution(self.res)
+
+
+@dataclasses.dataclass()
+class FakeDataset:
+    reflections: FakeReflections
+
+
+def get_datasets_and_comparators():
+    random.seed(0)
+    centres = [1.52, 1.61, 1.77, 1.95, 2.2]
+    datasets = {
+        Dtag(f"x{i}"): FakeDataset(FakeReflections(random.choice(centres) + random.uniform(-0.02, 0.02)))
+        for i
+        in range(300)
+    }
+    comparators = {
+        cluster_num: ComparatorCluster(
+            None, [], None, None, {dtag: random.random() for dtag in datasets},
+        )
+        for cluster_num
+        in range(3)
+    }
+    return datasets, comparators
+
+
+def get_cost_model(datasets):
+    return ShellCostModel({dtag: 80.0 ** 3 / 0.125 for dtag in datasets}, 100 ** 3, 30000)
+
+
+def test_planned_shells_cover_datasets_within_increment():
+    datasets, comparators = get_datasets_and_comparators()
+    shells = get_shells_multiple_models_planned(
+        datasets, comparators, MIN_CHARACTERISATION_DATASETS, HIGH_RES_INCREMENT, None, get_cost_model(datasets),
+    )
+
+    test_dtags = [dtag for shell in shells.values() for dtag in shell.test_dtags]
+    assert sorted(test_dtags, key=lambda dtag: dtag.dtag) == sorted(datasets, key=lambda dtag: dtag.dtag)
+
+    lowest_shell_res = min(shells)
+    for res, shell in shells.items():
+        for dtag in shell.test_dtags:
+            dtag_res = datasets[dtag].reflections.res
+            assert dtag_res < res
+            assert (res - dtag_res <= HIGH_RES_INCREMENT + 1e-9) or (res == lowest_shell_res)
+        for cluster_dtags in shell.train_dtags.values():
+            assert all(datasets[dtag].reflections.res < res for dtag in cluster_dtags)
+
+
+def test_planned_shells_cost_less_than_fixed():
+    datasets, comparators = get_datasets_and_comparators()
+    cost_model = get_cost_model(datasets)
+    fixed_plan = ShellPlan.from_shells(
+        get_shells_multiple_models(
+            datasets, comparators, MIN_CHARACTERISATION_DATASETS, 60, HIGH_RES_INCREMENT, None,
+        ),
+        cost_model,
+    )
+    plan = ShellPlan.from_shells(
+        get_shells_multiple_models_planned(
+            datasets, comparators, MIN_CHARACTERISATION_DATASETS, HIGH_RES_INCREMENT, None, cost_model,
+        ),
+        cost_model,
+    )
+    assert plan.total() < fixed_plan.total()
+
+
+def test_memory_cap():
+    datasets, comparators = get_datasets_and_comparators()
+    cost_model = get_cost_model(datasets)
+    uncapped_plan = ShellPlan.from_shells(
+        get_shells_multiple_models_planned(
+            datasets, comparators, MIN_CHARACTERISATION_DATASETS, HIGH_RES_INCREMENT, None, cost_model,
+        ),
+        cost_model,
+    )
+    max_shell_memory = 0.8 * uncapped_plan.max_memory() / 2 ** 30
+    plan = ShellPlan.from_shells(
+        get_shells_multiple_models_planned(
+            datasets, comparators, MIN_CHARACTERISATION_DATASETS, HIGH_RES_INCREMENT, None, cost_model,
+            max_shell_memory,
+        ),
+        cost_model,
+    )
+    assert plan.max_memory() <= max_shell_memory * 2 ** 30
+    assert len(plan.costs) > len(uncapped_plan.costs)
@@ -0,0 +1,85 @@
+from functools import partial
+
+import pytest
+
+from pandda_gemmi.processing.task_graph import GraphTask, TaskGraph
+
+
+def value(x):
+    return x
+
+
+def total(*xs):
+    return sum(xs)
+
+
+def get_graph():
+    return TaskGraph.from_tasks(
+        [
+            GraphTask("xmap_1", partial(value, 1), [], 1.0),
+            GraphTask("xmap_2", partial(value, 2), [], 1.0),
+            GraphTask("model", total, ["xmap_1", "xmap_2"], 3.0),
+            GraphTask("dataset", total, ["model", "xmap_1"], 5.0),
+            GraphTask("other_shell", partial(value, 10), [], 2.0),
+        ]
+    )
+
+
+def test_priorities():
+    priorities = get_graph().priorities()
+    assert priorities["dataset"] == 5.0
+    assert priorities["model"] == 8.0
+    assert priorities["xmap_1"] == 9.0
+    assert priorities["other_shell"] == 2.0
+
+
+@pytest.mark.parametrize("n_jobs", [1, 2])
+def test_run(n_jobs):
+    # Only the results nothing else consumes are returned
+    assert get_graph().run(n_jobs=n_jobs) == {"dataset": 4, "other_shell": 10}
+
+
+def test_cycle():
+    graph = TaskGraph.from_tasks([GraphTask("a", total, ["b"], 1.0), GraphTask("b", total, ["a"], 1.0)])
+    with pytest.raises(Exception):
+        graph.run()
+
+
+RUN_ORDER = []
+
+
+def record(key, *xs):
+    RUN_ORDER.append(key)
+    return key
+
+
+def get_shells_graph(num_shells):
+    tasks = []
+    for shell in range(num_shells):
+        tasks += [
+            GraphTask((shell, "xmap", 1), partial(record, (shell, "xmap", 1)), [], 1.0, shell),
+            GraphTask((shell, "xmap", 2), partial(record, (shell, "xmap", 2)), [], 1.0, shell),
+            GraphTask((shell, "model"), partial(record, (shell, "model")), [(shell, "xmap", 1), (shell, "xmap", 2)],
+                      0.2, shell),
+            GraphTask((shell, "dataset"), partial(record, (shell, "dataset")), [(shell, "model"), (shell, "xmap", 1)],
+                      2.0, shell),
+            GraphTask((shell, "log"), partial(record, (shell, "log")), [(shell, "dataset")], 0.01, shell),
+        ]
+    return TaskGraph.from_tasks(tasks)
+
+
+def test_shell_order():
+    # Every task of the first shell runs before the xmaps of the second shell are loaded, even though the second
+    # shell's xmaps have longer chains of work after them than the first shell's datasets
+    RUN_ORDER.clear()
+    get_shells_graph(2).run()
+    assert [key[0] for key in RUN_ORDER] == [0] * 5 + [1] * 5
+
+
+def test_run_ray():
+    ray = pytest.importorskip("ray")
+    ray.init(num_cpus=2)
+    try:
+        assert get_graph().run(method="ray") == {"dataset": 4, "other_shell": 10}
+    finally:
+        ray.shutdown()